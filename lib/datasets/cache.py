@@ -0,0 +1,99 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Content-addressed cache files for roidbs.
+
+A cache is stored under a key that fingerprints everything it was built from
+(the image set, the modification time and size of the source files, the
+config options that affect it and CACHE_VERSION), so modifying a dataset
+selects a new cache file instead of silently loading a stale one.
+"""
+
+import os
+import os.path as osp
+import cPickle
+import hashlib
+from multiprocessing.pool import ThreadPool
+from fast_rcnn.config import cfg
+
+# Bump when the format of cached roidbs changes
+CACHE_VERSION = 3
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+def stat_files(paths, num_threads=None):
+    """Return the (mtime, size) of each path, stat'ed by a thread pool."""
+    if num_threads is None:
+        num_threads = cfg.DATA_IO_THREADS
+    if len(paths) == 0:
+        return []
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(_stat, paths, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+def fingerprint(*parts):
+    """Return a hex digest of parts (strings, numbers, lists, tuples and
+    dicts thereof).
+    """
+    sha1 = hashlib.sha1(str(CACHE_VERSION))
+    for part in parts:
+        sha1.update(repr(_canonical(part)))
+    return sha1.hexdigest()
+
+def _canonical(obj):
+    if isinstance(obj, dict):
+        return sorted((k, _canonical(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    return obj
+
+def files_fingerprint(paths):
+    """Return a fingerprint of the paths and their modification times and
+    sizes.
+    """
+    return fingerprint(list(paths), stat_files(paths))
+
+def cache_dir():
+    """Return the directory holding the dataset caches, creating it if
+    needed.
+    """
+    cache_path = osp.abspath(osp.join(cfg.DATA_DIR, 'cache'))
+    if not osp.exists(cache_path):
+        os.makedirs(cache_path)
+    return cache_path
+
+def cache_file(cache_path, prefix, key):
+    """Return the path of the cache file for prefix (e.g. an imdb name
+    followed by the kind of cache) and key.
+    """
+    return osp.join(cache_path, '{}_{}.pkl'.format(prefix, key[:16]))
+
+def load(cache_file, key):
+    """Return the data cached in cache_file under key, or None."""
+    if not osp.exists(cache_file):
+        return None
+    with open(cache_file, 'rb') as fid:
+        cached = cPickle.load(fid)
+    if not isinstance(cached, dict) or cached.get('key') != key:
+        return None
+    return cached['data']
+
+def save(data, cache_file, key):
+    """Cache data in cache_file under key."""
+    write_atomic({'key': key, 'data': data}, cache_file)
+
+def write_atomic(obj, filename):
+    """Pickle obj to filename through a temporary file, so that concurrent
+    readers never see a partially written file.
+    """
+    tmp_file = '{}.{:d}.tmp'.format(filename, os.getpid())
+    with open(tmp_file, 'wb') as fid:
+        cPickle.dump(obj, fid, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, filename)
@@ -6,16 +6,20 @@
 
 from datasets.imdb import imdb
 import datasets.ds_utils as ds_utils
+import datasets.cache as cache
+from datasets.coco_index import CocoIndex
+from datasets.proposal_store import ProposalStore, write_proposal_store
+from datasets.detections import as_detections
 from fast_rcnn.config import cfg
 import os.path as osp
 import sys
 import os
 import numpy as np
-import scipy.sparse
 import scipy.io as sio
 import cPickle
 import json
 import uuid
+from functools import partial
 # COCO API
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
@@ -28,8 +32,9 @@ def _filter_crowd_proposals(roidb, crowd_thresh):
     training.
     """
     for ix, entry in enumerate(roidb):
-        overlaps = entry['gt_overlaps'].toarray()
-        crowd_inds = np.where(overlaps.max(axis=1) == -1)[0]
+        max_overlaps = entry['max_overlaps'].copy()
+        max_classes = entry['max_classes'].copy()
+        crowd_inds = np.where(max_overlaps == -1)[0]
         non_gt_inds = np.where(entry['gt_classes'] == 0)[0]
         if len(crowd_inds) == 0 or len(non_gt_inds) == 0:
             continue
@@ -38,10 +43,31 @@ def _filter_crowd_proposals(roidb, crowd_thresh):
         non_gt_boxes = ds_utils.xyxy_to_xywh(entry['boxes'][non_gt_inds, :])
         ious = COCOmask.iou(non_gt_boxes, crowd_boxes, iscrowd)
         bad_inds = np.where(ious.max(axis=1) > crowd_thresh)[0]
-        overlaps[non_gt_inds[bad_inds], :] = -1
-        roidb[ix]['gt_overlaps'] = scipy.sparse.csr_matrix(overlaps)
+        max_overlaps[non_gt_inds[bad_inds]] = -1
+        max_classes[non_gt_inds[bad_inds]] = 0
+        roidb[ix]['max_overlaps'] = max_overlaps
+        roidb[ix]['max_classes'] = max_classes
     return roidb
 
+def _load_proposal_file(box_file, method, min_size, top_k):
+    """
+    Load the proposals of an image from a .mat file, drop duplicate and very
+    small boxes and keep the top k.
+
+    A module-level function so that it can run in a process pool.
+    """
+    raw_data = sio.loadmat(box_file)['boxes']
+    boxes = np.maximum(raw_data - 1, 0).astype(np.uint32)
+    if method == 'MCG':
+        # Boxes from the MCG website are in (y1, x1, y2, x2) order
+        boxes = boxes[:, (1, 0, 3, 2)]
+    # Remove duplicate boxes and very small boxes and then take top k
+    keep = ds_utils.unique_boxes(boxes)
+    boxes = boxes[keep, :]
+    keep = ds_utils.filter_small_boxes(boxes, min_size)
+    boxes = boxes[keep, :]
+    return boxes[:top_k, :]
+
 class coco(imdb):
     def __init__(self, image_set, year):
         imdb.__init__(self, 'coco_' + year + '_' + image_set)
@@ -55,14 +81,23 @@ class coco(imdb):
         self._year = year
         self._image_set = image_set
         self._data_path = osp.join(cfg.DATA_DIR, 'coco')
-        # load COCO API, classes, class <-> id mappings
-        self._COCO = COCO(self._get_ann_file())
-        cats = self._COCO.loadCats(self._COCO.getCatIds())
-        self._classes = tuple(['__background__'] + [c['name'] for c in cats])
+        # load the annotation index, classes, class <-> id mappings; the
+        # COCO API is only loaded when it is needed (for evaluation)
+        self._coco_api = None
+        self._coco_index = self._load_coco_index()
+        cats = self._coco_index.categories
+        self._classes = tuple(['__background__'] + [name for _, name in cats])
         self._class_to_ind = dict(zip(self.classes, xrange(self.num_classes)))
-        self._class_to_coco_cat_id = dict(zip([c['name'] for c in cats],
-                                              self._COCO.getCatIds()))
+        self._class_to_coco_cat_id = dict((name, cat_id)
+                                          for cat_id, name in cats)
+        self._coco_cat_id_to_class_ind = dict(
+            (cat_id, self._class_to_ind[name]) for cat_id, name in cats)
         self._image_index = self._load_image_set_index()
+        # Image paths, indexed by a single listing of the image directory
+        # on first use
+        self._image_paths = None
+        # (roidb handler, reader) of the proposals read by proposal_boxes
+        self._proposal_reader = (None, None)
         # Default to roidb handler
         self.set_proposal_method('selective_search')
         self.competition_mode(False)
@@ -88,17 +123,38 @@ class coco(imdb):
         return osp.join(self._data_path, 'annotations',
                         prefix + '_' + self._image_set + self._year + '.json')
 
+    @property
+    def _COCO(self):
+        if self._coco_api is None:
+            self._coco_api = COCO(self._get_ann_file())
+        return self._coco_api
+
+    def _load_coco_index(self):
+        """
+        Load the annotation index (see datasets.coco_index), converting the
+        annotation file if it changed since the index was cached.
+        """
+        ann_file = self._get_ann_file()
+        key = cache.files_fingerprint([ann_file])
+        cache_file = cache.cache_file(self.cache_path,
+                                      self.name + '_coco_index', key)
+        columns = cache.load(cache_file, key)
+        if columns is not None:
+            return CocoIndex(columns)
+        print 'Indexing {}'.format(ann_file)
+        index = CocoIndex.from_json(ann_file)
+        cache.save(index.columns, cache_file, key)
+        print 'wrote COCO index to {}'.format(cache_file)
+        return index
+
     def _load_image_set_index(self):
         """
         Load image ids.
         """
-        image_ids = self._COCO.getImgIds()
-        return image_ids
+        return self._coco_index.image_index
 
-    def _get_widths(self):
-        anns = self._COCO.loadImgs(self._image_index)
-        widths = [ann['width'] for ann in anns]
-        return widths
+    def image_sizes(self):
+        return self._coco_index.image_sizes(self._image_index)
 
     def image_path_at(self, i):
         """
@@ -110,16 +166,25 @@ class coco(imdb):
         """
         Construct an image path from the image's "index" identifier.
         """
-        # Example image path for index=119993:
-        #   images/train2014/COCO_train2014_000000119993.jpg
-        file_name = ('COCO_' + self._data_name + '_' +
-                     str(index).zfill(12) + '.jpg')
-        image_path = osp.join(self._data_path, 'images',
-                              self._data_name, file_name)
+        image_dir = osp.join(self._data_path, 'images', self._data_name)
+        if self._image_paths is None:
+            self._image_paths = self._index_image_paths(
+                image_dir, dict((ix, self._image_file_name(ix))
+                                for ix in self._image_index))
+        if index in self._image_paths:
+            return self._image_paths[index]
+        # Not part of this image set
+        image_path = osp.join(image_dir, self._image_file_name(index))
         assert osp.exists(image_path), \
                 'Path does not exist: {}'.format(image_path)
         return image_path
 
+    def _image_file_name(self, index):
+        # Example image path for index=119993:
+        #   images/train2014/COCO_train2014_000000119993.jpg
+        return ('COCO_' + self._data_name + '_' +
+                str(index).zfill(12) + '.jpg')
+
     def selective_search_roidb(self):
         return self._roidb_from_proposals('selective_search')
 
@@ -134,29 +199,30 @@ class coco(imdb):
         Creates a roidb from pre-computed proposals of a particular methods.
         """
         top_k = self.config['top_k']
-        cache_file = osp.join(self.cache_path, self.name +
-                              '_{:s}_top{:d}'.format(method, top_k) +
-                              '_roidb.pkl')
-
-        if osp.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
-            print '{:s} {:s} roidb loaded from {:s}'.format(self.name, method,
-                                                            cache_file)
-            return roidb
-
-        if self._image_set in self._gt_splits:
-            gt_roidb = self.gt_roidb()
-            method_roidb = self._load_proposals(method, gt_roidb)
-            roidb = imdb.merge_roidbs(gt_roidb, method_roidb)
-            # Make sure we don't use proposals that are contained in crowds
-            roidb = _filter_crowd_proposals(roidb, self.config['crowd_thresh'])
-        else:
-            roidb = self._load_proposals(method, None)
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
-        print 'wrote {:s} roidb to {:s}'.format(method, cache_file)
-        return roidb
+        use_gt = self._image_set in self._gt_splits
+        box_files = [self._proposal_store_file(method)]
+        if not osp.exists(box_files[0]):
+            box_files = [self._get_proposal_file(method, index)
+                         for index in self._image_index]
+        key = cache.fingerprint(
+            self._gt_roidb_key() if use_gt else self._image_index,
+            cache.files_fingerprint(box_files), self.classes,
+            method, top_k, self.config['min_size'],
+            self.config['crowd_thresh'])
+
+        def build():
+            if use_gt:
+                gt_roidb = self.gt_roidb()
+                method_roidb = self._load_proposals(method, gt_roidb)
+                roidb = imdb.merge_roidbs(gt_roidb, method_roidb)
+                # Make sure we don't use proposals that are contained in crowds
+                return _filter_crowd_proposals(roidb,
+                                               self.config['crowd_thresh'])
+            return self._load_proposals(method, None)
+
+        return self._cached_roidb(
+            self.name + '_{:s}_top{:d}'.format(method, top_k) + '_roidb',
+            key, build, description=method + ' roidb')
 
     def _load_proposals(self, method, gt_roidb):
         """
@@ -167,9 +233,10 @@ class coco(imdb):
         For MCG, use boxes from http://www.eecs.berkeley.edu/Research/Projects/
           CS/vision/grouping/mcg/ and convert the file layout using
         lib/datasets/tools/mcg_munge.py.
+
+        The proposals are read from the proposal store written by
+        convert_proposals if there is one, and from the .mat files otherwise.
         """
-        box_list = []
-        top_k = self.config['top_k']
         valid_methods = [
             'MCG',
             'selective_search',
@@ -177,53 +244,121 @@ class coco(imdb):
             'edge_boxes_70']
         assert method in valid_methods
 
-        print 'Loading {} boxes'.format(method)
-        for i, index in enumerate(self._image_index):
-            if i % 1000 == 0:
-                print '{:d} / {:d}'.format(i + 1, len(self._image_index))
-
-            box_file = osp.join(
-                cfg.DATA_DIR, 'coco_proposals', method, 'mat',
-                self._get_box_file(index))
-
-            raw_data = sio.loadmat(box_file)['boxes']
-            boxes = np.maximum(raw_data - 1, 0).astype(np.uint32)
-            if method == 'MCG':
-                # Boxes from the MCG website are in (y1, x1, y2, x2) order
-                boxes = boxes[:, (1, 0, 3, 2)]
-            # Remove duplicate boxes and very small boxes and then take top k
-            keep = ds_utils.unique_boxes(boxes)
-            boxes = boxes[keep, :]
-            keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
-            boxes = boxes[keep, :]
-            boxes = boxes[:top_k, :]
-            box_list.append(boxes)
-            # Sanity check
-            im_ann = self._COCO.loadImgs(index)[0]
-            width = im_ann['width']
-            height = im_ann['height']
+        store_file = self._proposal_store_file(method)
+        if osp.exists(store_file):
+            print 'Loading {} boxes from {}'.format(method, store_file)
+            box_list = ProposalStore(store_file).box_list(self._image_index)
+        else:
+            box_list = self._read_proposal_files(method)
+        # Sanity check
+        for boxes, (width, height) in zip(box_list, self.image_sizes()):
             ds_utils.validate_boxes(boxes, width=width, height=height)
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
+    def proposal_boxes(self, i):
+        """
+        Return the precomputed proposals of image i, read straight from the
+        proposal store or the image's .mat file.
+        """
+        handler, read = self._proposal_reader
+        if handler != self.roidb_handler:
+            read = self._open_proposals()
+            self._proposal_reader = (self.roidb_handler, read)
+        if read is None:
+            return imdb.proposal_boxes(self, i)
+        return read(i)
+
+    def _open_proposals(self):
+        """
+        Return a function that reads the proposal boxes of an image of the
+        roidb handler, or None if the handler does not use proposal files.
+        """
+        methods = {self.selective_search_roidb: 'selective_search',
+                   self.edge_boxes_roidb: 'edge_boxes_AR',
+                   self.mcg_roidb: 'MCG'}
+        method = methods.get(self.roidb_handler)
+        if method is None:
+            return None
+        image_index = list(self._image_index)
+        store_file = self._proposal_store_file(method)
+        if osp.exists(store_file):
+            store = ProposalStore(store_file)
+            return lambda i: store.boxes(image_index[i])
+        return lambda i: _load_proposal_file(
+            self._get_proposal_file(method, image_index[i]), method,
+            self.config['min_size'], self.config['top_k'])
+
+    def _read_proposal_files(self, method, mat_dir=None):
+        """
+        Read the proposals of each image from its .mat file in a process pool.
+        If mat_dir is given, the files are read from that directory instead
+        of the coco_proposals tree (e.g. MCG boxes as downloaded).
+        """
+        if mat_dir is None:
+            box_files = [self._get_proposal_file(method, index)
+                         for index in self._image_index]
+        else:
+            box_files = [osp.join(mat_dir, osp.basename(
+                                      self._get_box_file(index)))
+                         for index in self._image_index]
+        print 'Loading {} boxes from {:d} files'.format(method,
+                                                       len(box_files))
+        return ds_utils.parallel_map(
+            partial(_load_proposal_file, method=method,
+                    min_size=self.config['min_size'],
+                    top_k=self.config['top_k']),
+            box_files)
+
+    def convert_proposals(self, method, mat_dir=None):
+        """
+        Write the proposals of method for this image set to a single proposal
+        store (see datasets.proposal_store), which _load_proposals then reads
+        instead of the per-image .mat files. Returns the path of the store.
+        """
+        box_list = self._read_proposal_files(method, mat_dir)
+        filename = self._proposal_store_file(method)
+        write_proposal_store(filename, self._image_index, box_list,
+                             {'method': method,
+                              'top_k': self.config['top_k'],
+                              'min_size': self.config['min_size']})
+        print 'Wrote {} proposals to {}'.format(method, filename)
+        return filename
+
+    def _proposal_store_file(self, method):
+        return osp.join(cfg.DATA_DIR, 'coco_proposals', method,
+                        '{:s}_top{:d}_min{:d}.proposals'.format(
+                            self.name, self.config['top_k'],
+                            self.config['min_size']))
+
     def gt_roidb(self):
         """
         Return the database of ground-truth regions of interest.
         This function loads/saves from/to a cache file to speed up future calls.
+        The cache is keyed by the image set, the annotation file and the
+        class list, so it is rebuilt when any of them change.
         """
-        cache_file = osp.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if osp.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
-            print '{} gt roidb loaded from {}'.format(self.name, cache_file)
-            return roidb
+        return self._cached_roidb(
+            self.name + '_gt_roidb', self._gt_roidb_key(),
+            lambda: self._coco_index.gt_roidb(self._image_index,
+                                              self._coco_cat_id_to_class_ind),
+            description='gt roidb')
 
-        gt_roidb = [self._load_coco_annotation(index)
-                    for index in self._image_index]
+    def roidb_entry_builder(self):
+        """
+        Ground-truth entries are built from the annotation index.
+        """
+        if self.roidb_handler != self.gt_roidb:
+            return None
+        image_index = list(self._image_index)
+        return lambda i: self._load_coco_annotation(image_index[i])
 
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(gt_roidb, fid, cPickle.HIGHEST_PROTOCOL)
-        print 'wrote gt roidb to {}'.format(cache_file)
-        return gt_roidb
+    def _gt_roidb_key(self):
+        """
+        Return the cache key of the gt roidb.
+        """
+        return cache.fingerprint(self._image_index,
+                                 cache.files_fingerprint([self._get_ann_file()]),
+                                 self.classes)
 
     def _load_coco_annotation(self, index):
         """
@@ -231,55 +366,8 @@ class coco(imdb):
         handled by marking their overlaps (with all categories) to -1. This
         overlap value means that crowd "instances" are excluded from training.
         """
-        im_ann = self._COCO.loadImgs(index)[0]
-        width = im_ann['width']
-        height = im_ann['height']
-
-        annIds = self._COCO.getAnnIds(imgIds=index, iscrowd=None)
-        objs = self._COCO.loadAnns(annIds)
-        # Sanitize bboxes -- some are invalid
-        valid_objs = []
-        for obj in objs:
-            x1 = np.max((0, obj['bbox'][0]))
-            y1 = np.max((0, obj['bbox'][1]))
-            x2 = np.min((width - 1, x1 + np.max((0, obj['bbox'][2] - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, obj['bbox'][3] - 1))))
-            if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
-                obj['clean_bbox'] = [x1, y1, x2, y2]
-                valid_objs.append(obj)
-        objs = valid_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint32)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
-        seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-        # Lookup table to map from COCO category ids to our internal class
-        # indices
-        coco_cat_id_to_class_ind = dict([(self._class_to_coco_cat_id[cls],
-                                          self._class_to_ind[cls])
-                                         for cls in self._classes[1:]])
-
-        for ix, obj in enumerate(objs):
-            cls = coco_cat_id_to_class_ind[obj['category_id']]
-            boxes[ix, :] = obj['clean_bbox']
-            gt_classes[ix] = cls
-            seg_areas[ix] = obj['area']
-            if obj['iscrowd']:
-                # Set overlap to -1 for all classes for crowd objects
-                # so they will be excluded during training
-                overlaps[ix, :] = -1.0
-            else:
-                overlaps[ix, cls] = 1.0
-
-        ds_utils.validate_boxes(boxes, width=width, height=height)
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-        return {'boxes' : boxes,
-                'gt_classes': gt_classes,
-                'gt_overlaps' : overlaps,
-                'flipped' : False,
-                'seg_areas' : seg_areas}
+        return self._coco_index.gt_roidb([index],
+                                         self._coco_cat_id_to_class_ind)[0]
 
     def _get_box_file(self, index):
         # first 14 chars / first 22 chars / all chars + .mat
@@ -288,6 +376,10 @@ class coco(imdb):
                      '_' + str(index).zfill(12) + '.mat')
         return osp.join(file_name[:14], file_name[:22], file_name)
 
+    def _get_proposal_file(self, method, index):
+        return osp.join(cfg.DATA_DIR, 'coco_proposals', method, 'mat',
+                        self._get_box_file(index))
+
     def _print_detection_eval_metrics(self, coco_eval):
         IoU_lo_thresh = 0.5
         IoU_hi_thresh = 0.95
@@ -333,25 +425,24 @@ class coco(imdb):
             cPickle.dump(coco_eval, fid, cPickle.HIGHEST_PROTOCOL)
         print 'Wrote COCO eval results to: {}'.format(eval_file)
 
-    def _coco_results_one_category(self, boxes, cat_id):
-        results = []
-        for im_ind, index in enumerate(self.image_index):
-            dets = boxes[im_ind].astype(np.float)
-            if dets == []:
-                continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            results.extend(
-              [{'image_id' : index,
-                'category_id' : cat_id,
-                'bbox' : [xs[k], ys[k], ws[k], hs[k]],
-                'score' : scores[k]} for k in xrange(dets.shape[0])])
-        return results
-
-    def _write_coco_results_file(self, all_boxes, res_file):
+    def _coco_results_one_category(self, detections, cls_ind, cat_id):
+        rows = detections.class_rows(cls_ind)
+        dets = detections.dets(rows).astype(np.float)
+        image_ids = np.array(self.image_index)[detections.image_inds[rows]]
+        scores = dets[:, -1]
+        xs = dets[:, 0]
+        ys = dets[:, 1]
+        ws = dets[:, 2] - xs + 1
+        hs = dets[:, 3] - ys + 1
+        return [{'image_id' : image_id,
+                 'category_id' : cat_id,
+                 'bbox' : [x, y, w, h],
+                 'score' : score}
+                for image_id, x, y, w, h, score
+                in zip(image_ids.tolist(), xs.tolist(), ys.tolist(),
+                       ws.tolist(), hs.tolist(), scores.tolist())]
+
+    def _write_coco_results_file(self, detections, res_file):
         # [{"image_id": 42,
         #   "category_id": 18,
         #   "bbox": [258.15,41.29,348.26,243.78],
@@ -363,13 +454,13 @@ class coco(imdb):
             print 'Collecting {} results ({:d}/{:d})'.format(cls, cls_ind,
                                                           self.num_classes - 1)
             coco_cat_id = self._class_to_coco_cat_id[cls]
-            results.extend(self._coco_results_one_category(all_boxes[cls_ind],
+            results.extend(self._coco_results_one_category(detections, cls_ind,
                                                            coco_cat_id))
         print 'Writing results json to {}'.format(res_file)
         with open(res_file, 'w') as fid:
             json.dump(results, fid)
 
-    def evaluate_detections(self, all_boxes, output_dir):
+    def evaluate_detections(self, detections, output_dir):
         res_file = osp.join(output_dir, ('detections_' +
                                          self._image_set +
                                          self._year +
@@ -377,7 +468,7 @@ class coco(imdb):
         if self.config['use_salt']:
             res_file += '_{}'.format(str(uuid.uuid4()))
         res_file += '.json'
-        self._write_coco_results_file(all_boxes, res_file)
+        self._write_coco_results_file(as_detections(detections), res_file)
         # Only do evaluation on non-test sets
         if self._image_set.find('test') == -1:
             self._do_detection_eval(res_file, output_dir)
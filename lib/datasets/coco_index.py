@@ -0,0 +1,184 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Compact index of a COCO annotation file.
+
+pycocotools' COCO keeps the whole annotation JSON as Python dicts, and gt
+roidb entries used to be built from it object by object with per-image
+loadImgs / getAnnIds / loadAnns lookups. CocoIndex reads the JSON once into
+NumPy columns (images sorted by id, annotations grouped by image) and builds
+the gt roidb, or a ColumnarRoidb, from them with vectorized operations. The
+index is small enough to be cached, so later runs do not parse the JSON.
+"""
+
+import json
+import numpy as np
+import datasets.ds_utils as ds_utils
+from datasets.columnar_roidb import ColumnarRoidb
+
+class CocoIndex(object):
+    """NumPy columns of the images, categories and annotations of a COCO
+    annotation file.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+
+    @classmethod
+    def from_json(cls, ann_file):
+        """Build the index in one pass over the annotation file ann_file."""
+        with open(ann_file) as f:
+            dataset = json.load(f)
+        images = dataset['images']
+        anns = dataset.get('annotations', [])
+        cats = dataset.get('categories', [])
+
+        image_ids = np.array([img['id'] for img in images], dtype=np.int64)
+        widths = np.array([img['width'] for img in images], dtype=np.int64)
+        heights = np.array([img['height'] for img in images], dtype=np.int64)
+        order = np.argsort(image_ids)
+
+        num_anns = len(anns)
+        ann_image_ids = np.fromiter((ann['image_id'] for ann in anns),
+                                    dtype=np.int64, count=num_anns)
+        bboxes = np.array([ann['bbox'] for ann in anns],
+                          dtype=np.float64).reshape(-1, 4)
+        areas = np.fromiter((ann['area'] for ann in anns),
+                            dtype=np.float64, count=num_anns)
+        iscrowd = np.fromiter((ann['iscrowd'] for ann in anns),
+                              dtype=np.bool, count=num_anns)
+        category_ids = np.fromiter((ann['category_id'] for ann in anns),
+                                   dtype=np.int64, count=num_anns)
+        # A stable sort keeps the annotations of an image in file order, the
+        # order of COCO.getAnnIds
+        ann_order = np.argsort(ann_image_ids, kind='mergesort')
+
+        columns = {
+            # Image ids in the order of COCO.getImgIds (the keys of the dict
+            # pycocotools builds in file order)
+            'image_index': dict((img['id'], None) for img in images).keys(),
+            'image_ids': image_ids[order],
+            'widths': widths[order],
+            'heights': heights[order],
+            'category_ids': [cat['id'] for cat in cats],
+            'category_names': [cat['name'] for cat in cats],
+            'ann_offsets': np.searchsorted(ann_image_ids[ann_order],
+                                           image_ids[order], side='left'),
+            'ann_ends': np.searchsorted(ann_image_ids[ann_order],
+                                        image_ids[order], side='right'),
+            'bboxes': bboxes[ann_order],
+            'areas': areas[ann_order],
+            'iscrowd': iscrowd[ann_order],
+            'category': category_ids[ann_order],
+        }
+        return cls(columns)
+
+    @property
+    def columns(self):
+        """The columns of the index, e.g. to cache it."""
+        return self._columns
+
+    @property
+    def image_index(self):
+        return list(self._columns['image_index'])
+
+    @property
+    def categories(self):
+        """Return the (id, name) of each category in file order."""
+        return zip(self._columns['category_ids'],
+                   self._columns['category_names'])
+
+    def _image_rows(self, image_ids):
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        rows = np.searchsorted(self._columns['image_ids'], image_ids)
+        rows = np.minimum(rows, len(self._columns['image_ids']) - 1)
+        assert (self._columns['image_ids'][rows] == image_ids).all(), \
+                'unknown COCO image ids'
+        return rows
+
+    def image_sizes(self, image_ids):
+        """Return the (width, height) of each of image_ids."""
+        rows = self._image_rows(image_ids)
+        return zip(self._columns['widths'][rows].tolist(),
+                   self._columns['heights'][rows].tolist())
+
+    def gt_columns(self, image_ids, cat_id_to_class_ind):
+        """Return the box offsets and per-box columns of the gt roidb of
+        image_ids: the rows offsets[i]:offsets[i + 1] are the boxes of
+        image_ids[i].
+
+        Invalid boxes are dropped. Crowd instances get a max overlap of -1 so
+        that they are excluded from training.
+        """
+        rows = self._image_rows(image_ids)
+        starts = self._columns['ann_offsets'][rows]
+        counts = self._columns['ann_ends'][rows] - starts
+        # Annotation indices of all images, one image after the other
+        image_of_ann = np.repeat(np.arange(len(rows)), counts)
+        first = np.zeros(len(rows), dtype=np.int64)
+        np.cumsum(counts[:-1], out=first[1:])
+        inds = np.arange(image_of_ann.size) - first[image_of_ann] + \
+               starts[image_of_ann]
+
+        width = self._columns['widths'][rows][image_of_ann]
+        height = self._columns['heights'][rows][image_of_ann]
+        bbox = self._columns['bboxes'][inds]
+        areas = self._columns['areas'][inds]
+        # Sanitize bboxes -- some are invalid
+        x1 = np.maximum(0, bbox[:, 0])
+        y1 = np.maximum(0, bbox[:, 1])
+        x2 = np.minimum(width - 1, x1 + np.maximum(0, bbox[:, 2] - 1))
+        y2 = np.minimum(height - 1, y1 + np.maximum(0, bbox[:, 3] - 1))
+        valid = (areas > 0) & (x2 >= x1) & (y2 >= y1)
+
+        inds = inds[valid]
+        image_of_ann = image_of_ann[valid]
+        boxes = np.vstack((x1[valid], y1[valid], x2[valid], y2[valid])) \
+                  .T.astype(np.uint32)
+        ds_utils.validate_boxes(boxes, width=width[valid],
+                                height=height[valid])
+
+        # Map COCO category ids to class indices through a lookup table
+        cat_ids = np.array(sorted(cat_id_to_class_ind.keys()), dtype=np.int64)
+        class_inds = np.array([cat_id_to_class_ind[c] for c in cat_ids],
+                              dtype=np.int32)
+        category = self._columns['category'][inds]
+        cat_rows = np.minimum(np.searchsorted(cat_ids, category),
+                              len(cat_ids) - 1)
+        assert (cat_ids[cat_rows] == category).all(), \
+                'unknown COCO category ids'
+        gt_classes = class_inds[cat_rows]
+        iscrowd = self._columns['iscrowd'][inds]
+
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(image_of_ann, minlength=len(rows)),
+                  out=offsets[1:])
+        columns = {
+            'boxes': boxes,
+            'gt_classes': gt_classes,
+            'max_overlaps': np.where(iscrowd, -1, 1).astype(np.float32),
+            'max_classes': np.where(iscrowd, 0, gt_classes).astype(np.uint16),
+            'seg_areas': areas[valid].astype(np.float32),
+        }
+        return offsets, columns
+
+    def gt_roidb(self, image_ids, cat_id_to_class_ind):
+        """Return the gt roidb of image_ids as a list of entries."""
+        offsets, columns = self.gt_columns(image_ids, cat_id_to_class_ind)
+        roidb = []
+        for i in xrange(len(offsets) - 1):
+            start, end = offsets[i], offsets[i + 1]
+            entry = dict((key, column[start:end])
+                         for key, column in columns.iteritems())
+            entry['flipped'] = False
+            roidb.append(entry)
+        return roidb
+
+    def gt_columnar_roidb(self, image_ids, cat_id_to_class_ind):
+        """Return the gt roidb of image_ids as a ColumnarRoidb."""
+        offsets, columns = self.gt_columns(image_ids, cat_id_to_class_ind)
+        return ColumnarRoidb.from_columns(
+            offsets, columns,
+            {'flipped': np.zeros(len(offsets) - 1, dtype=np.bool)})
@@ -0,0 +1,250 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Struct-of-arrays roidb that can be memory-mapped from .npy files.
+
+A roidb is normally a list of dicts of small arrays. ColumnarRoidb stores
+the same data as a few large columns instead:
+
+    per-image fields (image, width, height, flipped, ...) as arrays with one
+        element per image
+    per-box fields (boxes, gt_classes, max_overlaps, bbox_targets, ...)
+        concatenated over all images, with offsets[i]:offsets[i + 1] being
+        the rows of image i
+    scipy.sparse per-box fields as the data, indices and indptr of a single
+        CSR matrix over all boxes
+
+Saved columns can be loaded with mmap_mode='r', so forked data loader
+processes share them through the page cache instead of unsharing
+copy-on-write pages with refcount updates, and loading does not unpickle
+millions of objects.
+
+Indexing a ColumnarRoidb returns a RoidbEntry, a dict-like view of one image
+that existing roidb code (prepare_roidb, filter_roidb, the minibatch code)
+reads and writes like a dict. Writes go to an in-memory overlay and never
+modify the (possibly read-only) columns.
+"""
+
+import os
+import cPickle
+import shutil
+import numpy as np
+import scipy.sparse
+
+_IMAGE, _BOX, _SPARSE = 'image', 'box', 'sparse'
+
+class ColumnarRoidb(object):
+    """A roidb stored as columns; see the module docstring."""
+
+    def __init__(self, offsets, columns, kinds, sparse_shapes=None):
+        self._offsets = offsets
+        self._columns = columns
+        self._kinds = kinds
+        self._sparse_shapes = {} if sparse_shapes is None else sparse_shapes
+        self._overlay = {}
+
+    @classmethod
+    def from_list(cls, roidb):
+        """Build a ColumnarRoidb from a list of roidb entries."""
+        assert len(roidb) > 0
+        # Fields missing from some entries (e.g. seg_areas of flipped images)
+        # are dropped
+        keys = set(roidb[0].keys())
+        for entry in roidb:
+            keys.intersection_update(entry.keys())
+        keys = sorted(keys)
+        num_boxes = np.array([entry['boxes'].shape[0] for entry in roidb])
+        offsets = np.zeros(len(roidb) + 1, dtype=np.int64)
+        np.cumsum(num_boxes, out=offsets[1:])
+
+        columns = {}
+        kinds = {}
+        sparse_shapes = {}
+        for key in keys:
+            values = [entry[key] for entry in roidb]
+            if scipy.sparse.issparse(values[0]):
+                kinds[key] = _SPARSE
+                data, indices, indptr, num_cols = _concat_csr(values)
+                columns[key + '.data'] = data
+                columns[key + '.indices'] = indices
+                columns[key + '.indptr'] = indptr
+                sparse_shapes[key] = num_cols
+            elif isinstance(values[0], np.ndarray):
+                kinds[key] = _BOX
+                assert all(v.shape[0] == n for v, n in zip(values, num_boxes)), \
+                        'roidb field {} is not per box'.format(key)
+                columns[key] = np.concatenate(values)
+            else:
+                kinds[key] = _IMAGE
+                columns[key] = np.array(values)
+        return cls(offsets, columns, kinds, sparse_shapes)
+
+    @classmethod
+    def from_columns(cls, offsets, box_columns, image_columns):
+        """Build a ColumnarRoidb from box offsets and dense per-box and
+        per-image columns.
+        """
+        columns = {}
+        kinds = {}
+        for key, column in box_columns.iteritems():
+            assert column.shape[0] == offsets[-1], \
+                    'roidb field {} is not per box'.format(key)
+            columns[key] = column
+            kinds[key] = _BOX
+        for key, column in image_columns.iteritems():
+            assert column.shape[0] == len(offsets) - 1, \
+                    'roidb field {} is not per image'.format(key)
+            columns[key] = column
+            kinds[key] = _IMAGE
+        return cls(np.asarray(offsets, dtype=np.int64), columns, kinds)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a ColumnarRoidb saved to directory path."""
+        with open(os.path.join(path, 'columns.pkl'), 'rb') as f:
+            meta = cPickle.load(f)
+        def load_column(name):
+            column = np.load(os.path.join(path, name + '.npy'),
+                             mmap_mode=mmap_mode)
+            # Plain ndarray views: copies made by fancy indexing an np.memmap
+            # opened read-only are themselves read-only
+            return column.view(np.ndarray)
+        offsets = load_column('offsets')
+        columns = dict((name, load_column(name)) for name in meta['columns'])
+        return cls(offsets, columns, meta['kinds'], meta['sparse_shapes'])
+
+    def save(self, path):
+        """Save the columns (not the overlay) as .npy files in directory
+        path, replacing it atomically.
+        """
+        assert len(self._overlay) == 0, \
+                'Convert with from_list to save modified entries'
+        tmp_path = '{}.{:d}.tmp'.format(path.rstrip(os.sep), os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), self._offsets)
+        for name, column in self._columns.iteritems():
+            np.save(os.path.join(tmp_path, name + '.npy'), column)
+        meta = {'columns': sorted(self._columns.keys()),
+                'kinds': self._kinds,
+                'sparse_shapes': self._sparse_shapes}
+        with open(os.path.join(tmp_path, 'columns.pkl'), 'wb') as f:
+            cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @property
+    def num_boxes(self):
+        return int(self._offsets[-1])
+
+    def keys(self):
+        return sorted(self._kinds.keys())
+
+    def column(self, key):
+        """Return the concatenated values of a per-image or per-box field."""
+        assert self._kinds[key] != _SPARSE
+        return self._columns[key]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('roidb index out of range')
+        return RoidbEntry(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield RoidbEntry(self, i)
+
+    def _get(self, i, key):
+        overlay = self._overlay.get(i)
+        if overlay is not None and key in overlay:
+            return overlay[key]
+        kind = self._kinds[key]
+        if kind == _IMAGE:
+            return self._columns[key][i]
+        start, end = self._offsets[i], self._offsets[i + 1]
+        if kind == _BOX:
+            return self._columns[key][start:end]
+        indptr = self._columns[key + '.indptr'][start:end + 1]
+        first, last = indptr[0], indptr[-1]
+        return scipy.sparse.csr_matrix(
+            (self._columns[key + '.data'][first:last],
+             self._columns[key + '.indices'][first:last],
+             indptr - first),
+            shape=(end - start, self._sparse_shapes[key]))
+
+    def _set(self, i, key, value):
+        self._overlay.setdefault(i, {})[key] = value
+
+    def _has_key(self, i, key):
+        return key in self._kinds or key in self._overlay.get(i, ())
+
+    def _entry_keys(self, i):
+        return sorted(set(self._kinds.keys()) |
+                      set(self._overlay.get(i, {}).keys()))
+
+class RoidbEntry(object):
+    """Dict-like view of entry i of a ColumnarRoidb."""
+
+    __slots__ = ('_roidb', '_index')
+
+    def __init__(self, roidb, i):
+        self._roidb = roidb
+        self._index = i
+
+    def __getitem__(self, key):
+        return self._roidb._get(self._index, key)
+
+    def __setitem__(self, key, value):
+        self._roidb._set(self._index, key, value)
+
+    def __contains__(self, key):
+        return self._roidb._has_key(self._index, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return self._roidb._entry_keys(self._index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        """Return the entry as a regular dict."""
+        return dict(self.iteritems())
+
+def _concat_csr(matrices):
+    """Stack sparse matrices vertically into CSR data, indices and indptr."""
+    matrices = [m.tocsr() for m in matrices]
+    num_cols = matrices[0].shape[1]
+    assert all(m.shape[1] == num_cols for m in matrices)
+    nnz = np.array([m.nnz for m in matrices], dtype=np.int64)
+    nnz_offsets = np.zeros(len(matrices) + 1, dtype=np.int64)
+    np.cumsum(nnz, out=nnz_offsets[1:])
+    index_dtype = np.int32 if nnz_offsets[-1] < np.iinfo(np.int32).max \
+                  else np.int64
+    data = np.concatenate([m.data[:m.nnz] for m in matrices])
+    indices = np.concatenate([m.indices[:m.nnz] for m in matrices]) \
+                .astype(index_dtype)
+    indptr = np.concatenate([[0]] + [m.indptr[1:] + offset for m, offset
+                                     in zip(matrices, nnz_offsets[:-1])]) \
+               .astype(index_dtype)
+    return data, indices, indptr, num_cols
@@ -0,0 +1,312 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Detections of a test run stored as flat columns.
+
+test_net used to collect detections into all_boxes[cls][image], a list of
+lists of small N x 5 arrays (about 80 x 40k objects for COCO). Detections
+stores the same data as four columns with one row per detection:
+
+    image_inds  (N,) int32 index of the image in the imdb
+    class_inds  (N,) int32 index of the class
+    scores      (N,) float32
+    boxes       (N, 4) float32 (x1, y1, x2, y2)
+
+Detections are appended one image (or one image and class) at a time and
+saved as .npy files that can be loaded with mmap_mode='r'. class_rows and
+image_rows return the rows of one class or one image, in the order
+all_boxes would hold them, so evaluators can write the detections of a
+class with array operations instead of nested loops.
+
+DetectionWriter saves the detections of a running test in chunks of images,
+each a saved Detections, with a manifest of the chunks and of the images
+done, so an interrupted test resumes from its last chunk. Detections.load
+reads such a directory as the concatenation of its chunks.
+"""
+
+import os
+import cPickle
+import shutil
+import numpy as np
+import datasets.cache as cache
+
+_COLUMNS = ('image_inds', 'class_inds', 'scores', 'boxes')
+# Appended arrays are concatenated into a block every _BLOCK_CHUNKS appends
+_BLOCK_CHUNKS = 4096
+
+def _empty_columns():
+    return {'image_inds': np.zeros(0, dtype=np.int32),
+            'class_inds': np.zeros(0, dtype=np.int32),
+            'scores': np.zeros(0, dtype=np.float32),
+            'boxes': np.zeros((0, 4), dtype=np.float32)}
+
+class Detections(object):
+    """Detections of num_classes classes on num_images images; see the
+    module docstring.
+    """
+
+    def __init__(self, num_images, num_classes, columns=None):
+        self.num_images = num_images
+        self.num_classes = num_classes
+        self._blocks = [_empty_columns() if columns is None else columns]
+        self._chunks = []
+        # Row orders by (class, image) and by (image, class), built on demand
+        self._views = {}
+
+    @classmethod
+    def from_all_boxes(cls, all_boxes):
+        """Build Detections from all_boxes[cls][image] = [] or N x 5 array."""
+        num_classes = len(all_boxes)
+        num_images = len(all_boxes[0]) if num_classes > 0 else 0
+        detections = cls(num_images, num_classes)
+        for j in xrange(num_classes):
+            for i in xrange(num_images):
+                detections.append(i, j, all_boxes[j][i])
+        return detections
+
+    @classmethod
+    def concatenate(cls, detections_list):
+        """Return the detections of all of detections_list (e.g. the shards
+        of a test run) as one Detections.
+        """
+        num_images = detections_list[0].num_images
+        num_classes = detections_list[0].num_classes
+        assert all(d.num_images == num_images and
+                   d.num_classes == num_classes for d in detections_list)
+        columns = dict((name, np.concatenate([d.column(name)
+                                              for d in detections_list]))
+                       for name in _COLUMNS)
+        return cls(num_images, num_classes, columns)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load Detections saved to directory path, or written to it in
+        chunks by a DetectionWriter that was closed.
+        """
+        manifest = _load_manifest(path)
+        if manifest is not None:
+            assert manifest['complete'], \
+                    '{} holds detections of {:d} / {:d} images; rerun the ' \
+                    'test to complete them'.format(path,
+                                                   manifest['done'].sum(),
+                                                   len(manifest['done']))
+            chunks = [cls.load(os.path.join(path, name), mmap_mode)
+                      for name in manifest['chunks']]
+            if len(chunks) == 0:
+                return cls(manifest['num_images'], manifest['num_classes'])
+            return cls.concatenate(chunks)
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            meta = cPickle.load(f)
+        columns = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                      mmap_mode=mmap_mode).view(np.ndarray))
+                       for name in _COLUMNS)
+        return cls(meta['num_images'], meta['num_classes'], columns)
+
+    def save(self, path):
+        """Save the detections as .npy files in directory path, replacing it
+        atomically.
+        """
+        tmp_path = '{}.{:d}.tmp'.format(path.rstrip(os.sep), os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in _COLUMNS:
+            np.save(os.path.join(tmp_path, name + '.npy'), self.column(name))
+        with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+            cPickle.dump({'num_images': self.num_images,
+                          'num_classes': self.num_classes},
+                         f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def append(self, image_ind, class_ind, dets):
+        """Append the detections (N x 5 array or []) of a class on an
+        image.
+        """
+        if len(dets) == 0:
+            return
+        self._chunks.append((image_ind, class_ind,
+                             np.asarray(dets, dtype=np.float32)))
+        if len(self._chunks) >= _BLOCK_CHUNKS:
+            self._flush_chunks()
+        self._views = {}
+
+    def add(self, image_ind, cls_dets):
+        """Append the detections of an image, cls_dets[j] being those of
+        class j.
+        """
+        for j, dets in enumerate(cls_dets):
+            self.append(image_ind, j, dets)
+
+    def _flush_chunks(self):
+        if len(self._chunks) == 0:
+            return
+        dets = np.vstack([chunk[2] for chunk in self._chunks])
+        counts = [chunk[2].shape[0] for chunk in self._chunks]
+        self._blocks.append({
+            'image_inds': np.repeat([chunk[0] for chunk in self._chunks],
+                                    counts).astype(np.int32),
+            'class_inds': np.repeat([chunk[1] for chunk in self._chunks],
+                                    counts).astype(np.int32),
+            'scores': dets[:, 4].copy(),
+            'boxes': dets[:, :4].copy()})
+        self._chunks = []
+
+    def column(self, name):
+        """Return the image_inds, class_inds, scores or boxes column."""
+        if len(self._chunks) > 0 or len(self._blocks) > 1:
+            self._flush_chunks()
+            self._blocks = [dict((key, np.concatenate([block[key] for block
+                                                       in self._blocks]))
+                                 for key in _COLUMNS)]
+        return self._blocks[0][name]
+
+    @property
+    def image_inds(self):
+        return self.column('image_inds')
+
+    @property
+    def class_inds(self):
+        return self.column('class_inds')
+
+    @property
+    def scores(self):
+        return self.column('scores')
+
+    @property
+    def boxes(self):
+        return self.column('boxes')
+
+    def __len__(self):
+        return self.image_inds.shape[0]
+
+    def _view(self, major, minor, num_groups):
+        """Return the rows sorted by major then minor index (keeping the
+        order of rows with equal indices) and the offsets of each major
+        index in them.
+        """
+        key = (major, minor)
+        if key not in self._views:
+            major_inds = self.column(major)
+            order = np.lexsort((self.column(minor), major_inds))
+            offsets = np.searchsorted(major_inds[order],
+                                      np.arange(num_groups + 1))
+            self._views[key] = (order, offsets)
+        return self._views[key]
+
+    def class_rows(self, class_ind):
+        """Return the rows of class class_ind, ordered by image."""
+        order, offsets = self._view('class_inds', 'image_inds',
+                                    self.num_classes)
+        return order[offsets[class_ind]:offsets[class_ind + 1]]
+
+    def image_rows(self, image_ind):
+        """Return the rows of image image_ind, ordered by class."""
+        order, offsets = self._view('image_inds', 'class_inds',
+                                    self.num_images)
+        return order[offsets[image_ind]:offsets[image_ind + 1]]
+
+    def dets(self, rows):
+        """Return the rows as an N x 5 (x1, y1, x2, y2, score) array."""
+        return np.hstack((self.boxes[rows],
+                          self.scores[rows][:, np.newaxis]))
+
+    def to_all_boxes(self):
+        """Return the detections as all_boxes[cls][image]."""
+        all_boxes = [[[] for _ in xrange(self.num_images)]
+                     for _ in xrange(self.num_classes)]
+        for j in xrange(self.num_classes):
+            rows = self.class_rows(j)
+            image_inds = self.image_inds[rows]
+            starts = np.searchsorted(image_inds, np.arange(self.num_images))
+            ends = np.searchsorted(image_inds, np.arange(self.num_images),
+                                   side='right')
+            for i in np.where(ends > starts)[0]:
+                all_boxes[j][i] = self.dets(rows[starts[i]:ends[i]])
+        return all_boxes
+
+def _load_manifest(path):
+    manifest_file = os.path.join(path, 'manifest.pkl')
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'rb') as f:
+        return cPickle.load(f)
+
+class DetectionWriter(object):
+    """Writes the detections of a test run to directory path in chunks of
+    chunk_size images; see the module docstring.
+
+    If path holds the chunks of an interrupted run with the same run_key
+    (e.g. a fingerprint of the net, imdb and test settings), the run
+    resumes: done(i) is True for the images of its chunks, which need not be
+    tested again. Otherwise path is cleared.
+    """
+
+    def __init__(self, path, num_images, num_classes, run_key,
+                 chunk_size=1000):
+        self._path = path
+        self._chunk_size = max(1, chunk_size)
+        manifest = _load_manifest(path)
+        if manifest is not None and manifest['run_key'] == run_key and \
+                manifest['num_images'] == num_images and \
+                manifest['num_classes'] == num_classes:
+            print 'Resuming from {:d} images done in {}'.format(
+                manifest['done'].sum(), path)
+        else:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            manifest = {'run_key': run_key,
+                        'num_images': num_images,
+                        'num_classes': num_classes,
+                        'chunks': [],
+                        'done': np.zeros(num_images, dtype=np.bool),
+                        'complete': False}
+        # Chunks are only complete once listed in the manifest
+        manifest['complete'] = False
+        self._manifest = manifest
+        self._pending = Detections(num_images, num_classes)
+        self._pending_images = []
+
+    def done(self, image_ind):
+        """Return whether the detections of an image are saved."""
+        return self._manifest['done'][image_ind]
+
+    def add(self, image_ind, cls_dets):
+        """Append the detections of an image (see Detections.add), saving a
+        chunk every chunk_size images.
+        """
+        self._pending.add(image_ind, cls_dets)
+        self._pending_images.append(image_ind)
+        if len(self._pending_images) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Save the detections appended since the last chunk as a chunk."""
+        if len(self._pending_images) == 0:
+            return
+        manifest = self._manifest
+        name = 'chunk{:06d}'.format(len(manifest['chunks']))
+        self._pending.save(os.path.join(self._path, name))
+        manifest['chunks'].append(name)
+        manifest['done'][self._pending_images] = True
+        cache.write_atomic(manifest, os.path.join(self._path, 'manifest.pkl'))
+        self._pending = Detections(manifest['num_images'],
+                                   manifest['num_classes'])
+        self._pending_images = []
+
+    def close(self):
+        """Save the last chunk and mark the detections complete."""
+        self.flush()
+        self._manifest['complete'] = True
+        cache.write_atomic(self._manifest,
+                           os.path.join(self._path, 'manifest.pkl'))
+
+def as_detections(dets):
+    """Return dets (Detections or all_boxes[cls][image]) as Detections."""
+    if isinstance(dets, Detections):
+        return dets
+    return Detections.from_all_boxes(dets)
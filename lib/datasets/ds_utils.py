@@ -4,7 +4,10 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+import functools
 import numpy as np
+from multiprocessing import Pool
+from fast_rcnn.config import cfg
 
 def unique_boxes(boxes, scale=1.0):
     """Return indices of unique boxes."""
@@ -39,3 +42,65 @@ def filter_small_boxes(boxes, min_size):
     h = boxes[:, 3] - boxes[:, 1]
     keep = np.where((w >= min_size) & (h > min_size))[0]
     return keep
+
+def dense_overlaps(entry, num_classes):
+    """Return the (num_boxes, num_classes) overlap matrix of a roidb entry.
+
+    Entries only store, for each box, the maximum overlap with a
+    ground-truth box (max_overlaps) and that box's class (max_classes);
+    crowd boxes, and proposals inside crowds, have max_overlaps == -1 and
+    overlap -1 with all classes.
+    """
+    max_overlaps = entry['max_overlaps']
+    num_boxes = max_overlaps.shape[0]
+    overlaps = np.zeros((num_boxes, num_classes), dtype=np.float32)
+    overlaps[np.arange(num_boxes), entry['max_classes']] = max_overlaps
+    overlaps[max_overlaps == -1, :] = -1
+    return overlaps
+
+# Data shared with every task of the parallel_map running in this worker
+_worker_shared = None
+
+def _init_worker(shared):
+    global _worker_shared
+    _worker_shared = shared
+
+def _call_with_shared(func, item):
+    return func(_worker_shared, item)
+
+def parallel_map(func, items, num_processes=None, chunksize=None,
+                 shared=None):
+    """Return [func(item) for item in items], computed by a process pool.
+
+    func must be picklable (a module-level function or a functools.partial
+    of one). Items are sent to the workers in chunks and the results are
+    returned in the order of items.
+
+    If shared is given, [func(shared, item) for item in items] is returned
+    instead. shared (e.g. a roidb) is handed to each worker once, when the
+    pool starts, rather than pickled with every chunk: with the fork start
+    method (the only one on Python 2 / Linux) the workers inherit it without
+    copying; elsewhere it must be picklable.
+    """
+    if num_processes is None:
+        num_processes = cfg.DATA_PARSE_PROCESSES
+    num_processes = min(num_processes, len(items))
+    if num_processes <= 1:
+        if shared is not None:
+            return [func(shared, item) for item in items]
+        return map(func, items)
+    if chunksize is None:
+        # A few chunks per process balances the load without paying IPC
+        # for every item
+        chunksize = max(1, len(items) // (4 * num_processes))
+    if shared is not None:
+        pool = Pool(num_processes, initializer=_init_worker,
+                    initargs=(shared,))
+        func = functools.partial(_call_with_shared, func)
+    else:
+        pool = Pool(num_processes)
+    try:
+        return pool.map(func, items, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
@@ -7,12 +7,162 @@
 
 import os
 import os.path as osp
-import PIL
+from datasets.size_index import load_size_index
+from datasets.lazy_roidb import LazyRoidb, EntryStore
+import datasets.ds_utils as ds_utils
+import datasets.cache as cache
 from utils.cython_bbox import bbox_overlaps
 import numpy as np
-import scipy.sparse
 from fast_rcnn.config import cfg
 
+def _box_list_overlaps(box_lists, i):
+    """Return the max_overlaps and max_classes of the boxes of image i, given
+    box_lists = (box_list, gt_roidb).
+    """
+    box_list, gt_roidb = box_lists
+    boxes = box_list[i]
+    num_boxes = boxes.shape[0]
+    if gt_roidb is None or gt_roidb[i]['boxes'].size == 0:
+        return (np.zeros((num_boxes,), dtype=np.float32),
+                np.zeros((num_boxes,), dtype=np.uint16))
+    gt_classes = gt_roidb[i]['gt_classes']
+    gt_overlaps = bbox_overlaps(boxes.astype(np.float),
+                                gt_roidb[i]['boxes'].astype(np.float))
+    argmaxes = gt_overlaps.argmax(axis=1)
+    maxes = gt_overlaps.max(axis=1)
+    max_classes = np.where(maxes > 0, gt_classes[argmaxes], 0)
+    return maxes.astype(np.float32), max_classes.astype(np.uint16)
+
+def _greedy_gt_overlaps(overlaps):
+    """Greedily match gt boxes (columns of overlaps) to proposals (rows).
+
+    Repeatedly matches the remaining gt box and proposal with the largest
+    overlap, preferring the lowest gt box and then the lowest proposal index
+    among ties, and returns the overlap each gt box was matched with (0 for
+    gt boxes left unmatched when there are fewer proposals than gt boxes).
+    This is the same assignment as searching the whole overlap matrix for
+    its maximum after every match, found with a single sort of the candidate
+    (proposal, gt box) pairs.
+    """
+    num_boxes, num_gt = overlaps.shape
+    gt_overlaps = np.zeros(num_gt)
+    max_matches = min(num_boxes, num_gt)
+    if max_matches == 0:
+        return gt_overlaps
+    # Fewer than max_matches proposals are matched before any gt box, so a
+    # gt box is matched to one of its max_matches best proposals (or to one
+    # tied with the worst of them)
+    kth = -np.partition(-overlaps, max_matches - 1, axis=0)[max_matches - 1]
+    box_inds, gt_inds = np.nonzero(overlaps >= kth)
+    values = overlaps[box_inds, gt_inds]
+    # Primary key last: largest overlap, then lowest gt, then lowest box
+    order = np.lexsort((box_inds, gt_inds, -values))
+    box_used = np.zeros(num_boxes, dtype=np.bool)
+    gt_used = np.zeros(num_gt, dtype=np.bool)
+    num_matched = 0
+    for pair in order:
+        box_ind = box_inds[pair]
+        gt_ind = gt_inds[pair]
+        if box_used[box_ind] or gt_used[gt_ind]:
+            continue
+        box_used[box_ind] = True
+        gt_used[gt_ind] = True
+        gt_overlaps[gt_ind] = values[pair]
+        num_matched += 1
+        if num_matched == max_matches:
+            break
+    return gt_overlaps
+
+def _entry_gt_overlaps(entry, boxes, area_ranges, limits):
+    """Return the matched overlaps and number of gt boxes of a roidb entry
+    with the score-sorted proposals boxes for each (area range, proposal
+    limit) pair.
+
+    The overlaps of the top proposals with all gt boxes are computed once and
+    each proposal limit is matched on a prefix of their rows.
+    """
+    # Checking for max_overlaps == 1 avoids including crowd annotations
+    # (...pretty hacking :/)
+    gt_inds = np.where((entry['gt_classes'] > 0) &
+                       (entry['max_overlaps'] == 1))[0]
+    gt_boxes = entry['boxes'][gt_inds, :]
+    gt_areas = entry['seg_areas'][gt_inds]
+
+    if None not in limits:
+        boxes = boxes[:max(limits), :]
+    if boxes.shape[0] > 0:
+        overlaps = bbox_overlaps(boxes.astype(np.float),
+                                 gt_boxes.astype(np.float))
+
+    results = []
+    for area_range in area_ranges:
+        valid_gt_inds = np.where((gt_areas >= area_range[0]) &
+                                 (gt_areas <= area_range[1]))[0]
+        for limit in limits:
+            if boxes.shape[0] == 0:
+                results.append((np.zeros(0), len(valid_gt_inds)))
+            else:
+                results.append((_greedy_gt_overlaps(
+                    overlaps[:limit, valid_gt_inds]), len(valid_gt_inds)))
+    return results
+
+def _image_gt_overlaps(recall_args, i):
+    """Return _entry_gt_overlaps of image i for evaluate_recall_curves, given
+    recall_args = (roidb, candidate_boxes, area_ranges, limits).
+    """
+    roidb, candidate_boxes, area_ranges, limits = recall_args
+    entry = roidb[i]
+    if candidate_boxes is None:
+        # If candidate_boxes is not supplied, the default is to use the
+        # non-ground-truth boxes from this roidb
+        non_gt_inds = np.where(entry['gt_classes'] == 0)[0]
+        boxes = entry['boxes'][non_gt_inds, :]
+    else:
+        boxes = candidate_boxes[i]
+    return _entry_gt_overlaps(entry, boxes, area_ranges, limits)
+
+class RecallAccumulator(object):
+    """Proposal recall (over all areas) for several proposal limits,
+    accumulated one image at a time.
+
+    Only the number of gt boxes covered at each IoU threshold is kept, so
+    recall can be reported at any point while proposals are generated.
+    """
+
+    def __init__(self, limits=(None,), thresholds=None):
+        self.limits = list(limits)
+        if thresholds is None:
+            thresholds = np.arange(0.5, 0.95 + 1e-5, 0.05)
+        self.thresholds = thresholds
+        self.num_images = 0
+        self.num_pos = 0
+        self._num_covered = np.zeros((len(self.limits), len(thresholds)),
+                                     dtype=np.int64)
+
+    def add(self, gt_entry, boxes):
+        """Add an image, given its gt roidb entry and its proposals sorted
+        by decreasing score."""
+        results = _entry_gt_overlaps(gt_entry, boxes, [[0**2, 1e5**2]],
+                                     self.limits)
+        for j, (gt_overlaps, num_pos) in enumerate(results):
+            self._num_covered[j] += (gt_overlaps[:, np.newaxis] >=
+                                     self.thresholds).sum(axis=0)
+        self.num_pos += results[0][1]
+        self.num_images += 1
+
+    def recalls(self):
+        """Return the recall at each threshold (rows) of each limit."""
+        return self._num_covered / float(max(self.num_pos, 1))
+
+    def summary(self):
+        """Return a one-line summary of the average recall of each limit."""
+        ars = self.recalls().mean(axis=1)
+        return 'AR ({:d} images, {:d} gt): '.format(self.num_images,
+                                                    self.num_pos) + \
+               ' '.join('{}={:.3f}'.format('all' if limit is None else limit,
+                                           ar)
+                        for limit, ar in zip(self.limits, ars))
+
 class imdb(object):
     """Image database."""
 
@@ -59,20 +209,43 @@ class imdb(object):
     def roidb(self):
         # A roidb is a list of dictionaries, each with the following keys:
         #   boxes
-        #   gt_overlaps
+        #   max_overlaps (max overlap of each box with a gt box, -1 for crowds)
+        #   max_classes (class of that gt box)
         #   gt_classes
         #   flipped
+        #
+        # With cfg.LAZY_ROIDB, entries are built on first access if the
+        # dataset can build single entries (see roidb_entry_builder) and
+        # cached roidbs are read entry by entry.
         if self._roidb is not None:
             return self._roidb
-        self._roidb = self.roidb_handler()
+        build_entry = self.roidb_entry_builder() if cfg.LAZY_ROIDB else None
+        if build_entry is not None:
+            self._roidb = LazyRoidb(self.num_images, build_entry)
+        else:
+            self._roidb = self.roidb_handler()
         return self._roidb
 
+    def proposal_boxes(self, i):
+        """Return the proposal boxes of image i, without ground-truth boxes.
+
+        Datasets read them straight from the proposal files of the roidb
+        handler where they can, so that, e.g., testing with precomputed
+        proposals does not load annotations or compute overlaps; otherwise
+        they are taken from the roidb.
+        """
+        entry = self.roidb[i]
+        return entry['boxes'][entry['gt_classes'] == 0]
+
+    def roidb_entry_builder(self):
+        """Return a function that builds entry i of the roidb of the current
+        roidb handler on its own, or None if the handler cannot.
+        """
+        return None
+
     @property
     def cache_path(self):
-        cache_path = osp.abspath(osp.join(cfg.DATA_DIR, 'cache'))
-        if not os.path.exists(cache_path):
-            os.makedirs(cache_path)
-        return cache_path
+        return cache.cache_dir()
 
     @property
     def num_images(self):
@@ -84,9 +257,55 @@ class imdb(object):
     def default_roidb(self):
         raise NotImplementedError
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def _cached_roidb(self, prefix, key, build, description='roidb'):
+        """Return the roidb cached under key, or build() it and cache it.
+
+        With cfg.LAZY_ROIDB the roidb is cached as an indexed per-image store
+        and returned as a LazyRoidb that reads entries from it on first access.
         """
-        all_boxes is a list of length number-of-classes.
+        if cfg.LAZY_ROIDB:
+            cache_file = cache.cache_file(self.cache_path, prefix + '_entries',
+                                          key)
+            store = EntryStore.open(cache_file, key)
+            if store is None:
+                EntryStore.write(build(), cache_file, key)
+                print 'wrote {} to {}'.format(description, cache_file)
+                store = EntryStore.open(cache_file, key)
+            else:
+                print '{} {} opened from {}'.format(self.name, description,
+                                                    cache_file)
+            return LazyRoidb(len(store), store.__getitem__)
+
+        cache_file = cache.cache_file(self.cache_path, prefix, key)
+        roidb = cache.load(cache_file, key)
+        if roidb is not None:
+            print '{} {} loaded from {}'.format(self.name, description,
+                                                cache_file)
+            return roidb
+        roidb = build()
+        cache.save(roidb, cache_file, key)
+        print 'wrote {} to {}'.format(description, cache_file)
+        return roidb
+
+    def _index_image_paths(self, image_dir, file_names):
+        """Return a dict mapping each key of file_names to its image path.
+
+        image_dir is listed once and all file names are validated against the
+        listing, instead of stat'ing every image each time a path is needed.
+        """
+        listing = set(os.listdir(image_dir))
+        missing = [name for name in file_names.itervalues()
+                   if name not in listing]
+        assert len(missing) == 0, \
+                '{:d} images do not exist in {}, e.g. {}'.format(
+                    len(missing), image_dir, missing[0])
+        return dict((key, osp.join(image_dir, name))
+                    for key, name in file_names.iteritems())
+
+    def evaluate_detections(self, detections, output_dir=None):
+        """
+        detections is a datasets.detections.Detections, or all_boxes:
+        a list of length number-of-classes.
         Each list element is a list of length number-of-images.
         Each of those list elements is either an empty list []
         or a numpy array of detection.
@@ -95,25 +314,42 @@ class imdb(object):
         """
         raise NotImplementedError
 
+    def image_sizes(self):
+        """Return the (width, height) of each image in the image sequence.
+
+        Sizes are read from the image headers by a thread pool and kept in a
+        size index in the cache directory, so later calls only stat the images.
+        """
+        paths = [self.image_path_at(i) for i in xrange(self.num_images)]
+        cache_file = osp.join(self.cache_path, self.name + '_image_sizes.pkl')
+        sizes = load_size_index(paths, cache_file)
+        return [sizes[path] for path in paths]
+
     def _get_widths(self):
-      return [PIL.Image.open(self.image_path_at(i)).size[0]
-              for i in xrange(self.num_images)]
+      return [size[0] for size in self.image_sizes()]
 
     def append_flipped_images(self):
         num_images = self.num_images
         widths = self._get_widths()
-        for i in xrange(num_images):
-            boxes = self.roidb[i]['boxes'].copy()
+        roidb = self.roidb
+        def flipped_entry(i):
+            boxes = roidb[i]['boxes'].copy()
             oldx1 = boxes[:, 0].copy()
             oldx2 = boxes[:, 2].copy()
             boxes[:, 0] = widths[i] - oldx2 - 1
             boxes[:, 2] = widths[i] - oldx1 - 1
             assert (boxes[:, 2] >= boxes[:, 0]).all()
-            entry = {'boxes' : boxes,
-                     'gt_overlaps' : self.roidb[i]['gt_overlaps'],
-                     'gt_classes' : self.roidb[i]['gt_classes'],
-                     'flipped' : True}
-            self.roidb.append(entry)
+            return {'boxes' : boxes,
+                    'max_overlaps' : roidb[i]['max_overlaps'],
+                    'max_classes' : roidb[i]['max_classes'],
+                    'gt_classes' : roidb[i]['gt_classes'],
+                    'flipped' : True}
+        if isinstance(roidb, LazyRoidb):
+            # Flip entries when they are first accessed
+            roidb.extend(LazyRoidb(num_images, flipped_entry))
+        else:
+            for i in xrange(num_images):
+                roidb.append(flipped_entry(i))
         self._image_index = self._image_index * 2
 
     def evaluate_recall(self, candidate_boxes=None, thresholds=None,
@@ -126,11 +362,30 @@ class imdb(object):
                 'recalls': vector recalls at each IoU overlap threshold
                 'thresholds': vector of IoU overlap thresholds
                 'gt_overlaps': vector of all ground-truth overlaps
+                'num_pos': number of ground-truth boxes
+        """
+        return self.evaluate_recall_curves(candidate_boxes=candidate_boxes,
+                                           thresholds=thresholds,
+                                           areas=(area,),
+                                           limits=(limit,))[area][limit]
+
+    def evaluate_recall_curves(self, candidate_boxes=None, thresholds=None,
+                               areas=('all',), limits=(None,)):
+        """Evaluate proposal recall for several area ranges and proposal
+        limits (budgets) in one pass over the images.
+
+        candidate_boxes[i] (or the non-gt boxes of roidb[i]) must be sorted
+        by decreasing score, so that the top limit proposals are a prefix. A
+        limit of None uses all proposals.
+
+        Returns:
+            results: results[area][limit] is the evaluate_recall result for
+                that area range and limit
         """
         # Record max overlap value for each gt box
         # Return vector of overlap values
-        areas = { 'all': 0, 'small': 1, 'medium': 2, 'large': 3,
-                  '96-128': 4, '128-256': 5, '256-512': 6, '512-inf': 7}
+        area_inds = { 'all': 0, 'small': 1, 'medium': 2, 'large': 3,
+                      '96-128': 4, '128-256': 5, '256-512': 6, '512-inf': 7}
         area_ranges = [ [0**2, 1e5**2],    # all
                         [0**2, 32**2],     # small
                         [32**2, 96**2],    # medium
@@ -140,96 +395,58 @@ class imdb(object):
                         [256**2, 512**2],  # 256-512
                         [512**2, 1e5**2],  # 512-inf
                       ]
-        assert areas.has_key(area), 'unknown area range: {}'.format(area)
-        area_range = area_ranges[areas[area]]
-        gt_overlaps = np.zeros(0)
-        num_pos = 0
-        for i in xrange(self.num_images):
-            # Checking for max_overlaps == 1 avoids including crowd annotations
-            # (...pretty hacking :/)
-            max_gt_overlaps = self.roidb[i]['gt_overlaps'].toarray().max(axis=1)
-            gt_inds = np.where((self.roidb[i]['gt_classes'] > 0) &
-                               (max_gt_overlaps == 1))[0]
-            gt_boxes = self.roidb[i]['boxes'][gt_inds, :]
-            gt_areas = self.roidb[i]['seg_areas'][gt_inds]
-            valid_gt_inds = np.where((gt_areas >= area_range[0]) &
-                                     (gt_areas <= area_range[1]))[0]
-            gt_boxes = gt_boxes[valid_gt_inds, :]
-            num_pos += len(valid_gt_inds)
-
-            if candidate_boxes is None:
-                # If candidate_boxes is not supplied, the default is to use the
-                # non-ground-truth boxes from this roidb
-                non_gt_inds = np.where(self.roidb[i]['gt_classes'] == 0)[0]
-                boxes = self.roidb[i]['boxes'][non_gt_inds, :]
-            else:
-                boxes = candidate_boxes[i]
-            if boxes.shape[0] == 0:
-                continue
-            if limit is not None and boxes.shape[0] > limit:
-                boxes = boxes[:limit, :]
-
-            overlaps = bbox_overlaps(boxes.astype(np.float),
-                                     gt_boxes.astype(np.float))
-
-            _gt_overlaps = np.zeros((gt_boxes.shape[0]))
-            for j in xrange(gt_boxes.shape[0]):
-                # find which proposal box maximally covers each gt box
-                argmax_overlaps = overlaps.argmax(axis=0)
-                # and get the iou amount of coverage for each gt box
-                max_overlaps = overlaps.max(axis=0)
-                # find which gt box is 'best' covered (i.e. 'best' = most iou)
-                gt_ind = max_overlaps.argmax()
-                gt_ovr = max_overlaps.max()
-                assert(gt_ovr >= 0)
-                # find the proposal box that covers the best covered gt box
-                box_ind = argmax_overlaps[gt_ind]
-                # record the iou coverage of this gt box
-                _gt_overlaps[j] = overlaps[box_ind, gt_ind]
-                assert(_gt_overlaps[j] == gt_ovr)
-                # mark the proposal box and the gt box as used
-                overlaps[box_ind, :] = -1
-                overlaps[:, gt_ind] = -1
-            # append recorded iou coverage level
-            gt_overlaps = np.hstack((gt_overlaps, _gt_overlaps))
-
-        gt_overlaps = np.sort(gt_overlaps)
+        for area in areas:
+            assert area_inds.has_key(area), \
+                    'unknown area range: {}'.format(area)
+        # Images are matched in a process pool; the roidb and proposals are
+        # shared with the workers once, not pickled with every chunk
+        recall_args = (self.roidb, candidate_boxes,
+                       [area_ranges[area_inds[area]] for area in areas],
+                       list(limits))
+        image_results = ds_utils.parallel_map(_image_gt_overlaps,
+                                              range(self.num_images),
+                                              shared=recall_args)
+
         if thresholds is None:
             step = 0.05
             thresholds = np.arange(0.5, 0.95 + 1e-5, step)
-        recalls = np.zeros_like(thresholds)
-        # compute recall for each iou threshold
-        for i, t in enumerate(thresholds):
-            recalls[i] = (gt_overlaps >= t).sum() / float(num_pos)
-        # ar = 2 * np.trapz(recalls, thresholds)
-        ar = recalls.mean()
-        return {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
-                'gt_overlaps': gt_overlaps}
+        results = {}
+        for j, (area, limit) in enumerate((area, limit) for area in areas
+                                          for limit in limits):
+            gt_overlaps = np.concatenate(
+                [np.zeros(0)] + [r[j][0] for r in image_results])
+            num_pos = sum(r[j][1] for r in image_results)
+            gt_overlaps = np.sort(gt_overlaps)
+            recalls = np.zeros_like(thresholds)
+            # compute recall for each iou threshold
+            for i, t in enumerate(thresholds):
+                recalls[i] = (gt_overlaps >= t).sum() / float(num_pos)
+            # ar = 2 * np.trapz(recalls, thresholds)
+            ar = recalls.mean()
+            results.setdefault(area, {})[limit] = \
+                    {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
+                     'gt_overlaps': gt_overlaps, 'num_pos': num_pos}
+        return results
 
     def create_roidb_from_box_list(self, box_list, gt_roidb):
         assert len(box_list) == self.num_images, \
                 'Number of boxes must match number of ground-truth images'
+        # The boxes are shared with the pool workers once, not pickled with
+        # every chunk of images
+        overlaps = ds_utils.parallel_map(_box_list_overlaps,
+                                         range(self.num_images),
+                                         shared=(box_list, gt_roidb))
+
         roidb = []
         for i in xrange(self.num_images):
             boxes = box_list[i]
             num_boxes = boxes.shape[0]
-            overlaps = np.zeros((num_boxes, self.num_classes), dtype=np.float32)
-
-            if gt_roidb is not None and gt_roidb[i]['boxes'].size > 0:
-                gt_boxes = gt_roidb[i]['boxes']
-                gt_classes = gt_roidb[i]['gt_classes']
-                gt_overlaps = bbox_overlaps(boxes.astype(np.float),
-                                            gt_boxes.astype(np.float))
-                argmaxes = gt_overlaps.argmax(axis=1)
-                maxes = gt_overlaps.max(axis=1)
-                I = np.where(maxes > 0)[0]
-                overlaps[I, gt_classes[argmaxes[I]]] = maxes[I]
-
-            overlaps = scipy.sparse.csr_matrix(overlaps)
+            max_overlaps, max_classes = overlaps[i]
             roidb.append({
                 'boxes' : boxes,
                 'gt_classes' : np.zeros((num_boxes,), dtype=np.int32),
-                'gt_overlaps' : overlaps,
+                'max_overlaps' : max_overlaps,
+                'max_classes' : max_classes,
                 'flipped' : False,
                 'seg_areas' : np.zeros((num_boxes,), dtype=np.float32),
             })
@@ -242,8 +459,10 @@ class imdb(object):
             a[i]['boxes'] = np.vstack((a[i]['boxes'], b[i]['boxes']))
             a[i]['gt_classes'] = np.hstack((a[i]['gt_classes'],
                                             b[i]['gt_classes']))
-            a[i]['gt_overlaps'] = scipy.sparse.vstack([a[i]['gt_overlaps'],
-                                                       b[i]['gt_overlaps']])
+            a[i]['max_overlaps'] = np.hstack((a[i]['max_overlaps'],
+                                              b[i]['max_overlaps']))
+            a[i]['max_classes'] = np.hstack((a[i]['max_classes'],
+                                             b[i]['max_classes']))
             a[i]['seg_areas'] = np.hstack((a[i]['seg_areas'],
                                            b[i]['seg_areas']))
         return a
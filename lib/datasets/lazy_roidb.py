@@ -0,0 +1,130 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Roidbs whose entries are built or loaded on first access.
+
+LazyRoidb is a list-like roidb that calls a per-image function the first
+time an entry is accessed and keeps the result, so tools that only touch
+some images (or start consuming images before they have all been seen) do
+not pay for building the whole roidb up front.
+
+EntryStore is an indexed per-image store of roidb entries: a single file of
+separately pickled entries followed by a table of their offsets, so any
+entry can be read without unpickling the others.
+"""
+
+import os
+import struct
+import bisect
+import cPickle
+import numpy as np
+
+class LazyRoidb(object):
+    """A roidb whose entry i is built by build_entry(i) on first access."""
+
+    def __init__(self, num_entries, build_entry):
+        self._entries = [None] * num_entries
+        # (first entry, builder) of each run of entries; a run covers the
+        # entries up to the first entry of the next run
+        self._starts = [0]
+        self._builders = [build_entry]
+
+    @property
+    def num_loaded(self):
+        return sum(1 for entry in self._entries if entry is not None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_index(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('roidb index out of range')
+        return i
+
+    def __getitem__(self, i):
+        i = self._check_index(i)
+        entry = self._entries[i]
+        if entry is None:
+            run = bisect.bisect_right(self._starts, i) - 1
+            entry = self._builders[run](i - self._starts[run])
+            self._entries[i] = entry
+        return entry
+
+    def __setitem__(self, i, entry):
+        self._entries[self._check_index(i)] = entry
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def append(self, entry):
+        self._entries.append(entry)
+
+    def extend(self, entries):
+        """Append entries; the entries of a LazyRoidb stay lazy."""
+        if not isinstance(entries, LazyRoidb):
+            self._entries.extend(entries)
+            return
+        offset = len(self._entries)
+        self._entries.extend(entries._entries)
+        for start, builder in zip(entries._starts, entries._builders):
+            self._starts.append(offset + start)
+            self._builders.append(builder)
+
+# Trailer of an EntryStore file: offset of the index
+_TRAILER = struct.Struct('<q')
+
+class EntryStore(object):
+    """Read-only indexed per-image store of roidb entries."""
+
+    def __init__(self, filename, offsets):
+        self._filename = filename
+        self._offsets = offsets
+        self._file = None
+        self._pid = None
+
+    @classmethod
+    def open(cls, filename, key):
+        """Return the store written to filename under key, or None."""
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            index_offset, = _TRAILER.unpack(f.read(_TRAILER.size))
+            f.seek(index_offset)
+            index = cPickle.load(f)
+        if index.get('key') != key:
+            return None
+        return cls(filename, index['offsets'])
+
+    @staticmethod
+    def write(entries, filename, key):
+        """Write entries to filename under key through a temporary file."""
+        tmp_file = '{}.{:d}.tmp'.format(filename, os.getpid())
+        offsets = [0]
+        with open(tmp_file, 'wb') as f:
+            for entry in entries:
+                f.write(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+                offsets.append(f.tell())
+            cPickle.dump({'key': key,
+                          'offsets': np.array(offsets, dtype=np.int64)},
+                         f, cPickle.HIGHEST_PROTOCOL)
+            f.write(_TRAILER.pack(offsets[-1]))
+        os.rename(tmp_file, filename)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        # Forked processes (e.g. prefetch workers) must not share the file
+        # position of their parent's file object
+        if self._pid != os.getpid():
+            self._file = open(self._filename, 'rb')
+            self._pid = os.getpid()
+        start, end = self._offsets[i], self._offsets[i + 1]
+        self._file.seek(start)
+        return cPickle.loads(self._file.read(end - start))
@@ -8,17 +8,66 @@
 import os
 from datasets.imdb import imdb
 import datasets.ds_utils as ds_utils
+import datasets.cache as cache
+from datasets.size_index import load_size_index, probe_image_size
+from datasets.proposal_store import ProposalStore, write_proposal_store
+from datasets.rpn_proposals import RpnProposalFile, is_rpn_proposal_file
+from datasets.detections import as_detections
 import xml.etree.ElementTree as ET
 import numpy as np
-import scipy.sparse
 import scipy.io as sio
 import utils.cython_bbox
 import cPickle
 import subprocess
 import uuid
+from functools import partial
 from voc_eval import voc_eval
 from fast_rcnn.config import cfg
 
+def _load_pascal_annotation(filename, class_to_ind, use_diff):
+    """
+    Load the bounding boxes of a PASCAL VOC annotation file.
+
+    A module-level function so that it can run in a process pool.
+    """
+    objs = []
+    # Stream the file and keep only the fields used below
+    for _, obj in ET.iterparse(filename):
+        if obj.tag != 'object':
+            continue
+        # Exclude the samples labeled as difficult
+        if use_diff or int(obj.find('difficult').text) == 0:
+            bbox = obj.find('bndbox')
+            objs.append((obj.find('name').text,
+                         bbox.find('xmin').text, bbox.find('ymin').text,
+                         bbox.find('xmax').text, bbox.find('ymax').text))
+        obj.clear()
+    num_objs = len(objs)
+
+    boxes = np.zeros((num_objs, 4), dtype=np.int32)
+    gt_classes = np.zeros((num_objs), dtype=np.int32)
+    # "Seg" area for pascal is just the box area
+    seg_areas = np.zeros((num_objs), dtype=np.float32)
+
+    # Load object bounding boxes into a data frame.
+    for ix, (name, xmin, ymin, xmax, ymax) in enumerate(objs):
+        # Make pixel indexes 0-based
+        x1 = float(xmin) - 1
+        y1 = float(ymin) - 1
+        x2 = float(xmax) - 1
+        y2 = float(ymax) - 1
+        cls = class_to_ind[name.lower().strip()]
+        boxes[ix, :] = [x1, y1, x2, y2]
+        gt_classes[ix] = cls
+        seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    return {'boxes' : boxes,
+            'gt_classes': gt_classes,
+            'max_overlaps' : np.ones((num_objs), dtype=np.float32),
+            'max_classes' : gt_classes.astype(np.uint16),
+            'flipped' : False,
+            'seg_areas' : seg_areas}
+
 class pascal_voc(imdb):
     def __init__(self, image_set, year, devkit_path=None):
         imdb.__init__(self, 'voc_' + year + '_' + image_set)
@@ -49,6 +98,10 @@ class pascal_voc(imdb):
         self._class_to_ind = dict(zip(self.classes, xrange(self.num_classes)))
         self._image_ext = '.jpg'
         self._image_index = self._load_image_set_index()
+        # Image paths, indexed by a single listing of JPEGImages on first use
+        self._image_paths = None
+        # (roidb handler, reader) of the proposals read by proposal_boxes
+        self._proposal_reader = (None, None)
         # Default to roidb handler
         self._roidb_handler = self.selective_search_roidb
         self._salt = str(uuid.uuid4())
@@ -60,6 +113,7 @@ class pascal_voc(imdb):
                        'use_diff'    : False,
                        'matlab_eval' : False,
                        'rpn_file'    : None,
+                       'rpn_top_k'   : None,
                        'min_size'    : 2}
 
         assert os.path.exists(self._devkit_path), \
@@ -77,12 +131,55 @@ class pascal_voc(imdb):
         """
         Construct an image path from the image's "index" identifier.
         """
+        if self._image_paths is None:
+            self._image_paths = self._index_image_paths(
+                os.path.join(self._data_path, 'JPEGImages'),
+                dict((ix, ix + self._image_ext) for ix in self._image_index))
+        if index in self._image_paths:
+            return self._image_paths[index]
+        # Not part of this image set
         image_path = os.path.join(self._data_path, 'JPEGImages',
                                   index + self._image_ext)
         assert os.path.exists(image_path), \
                 'Path does not exist: {}'.format(image_path)
         return image_path
 
+    def image_sizes(self):
+        """
+        Return the (width, height) of each image in the image sequence.
+
+        Sizes are taken from the <size> element of the annotation files, so
+        the images are not opened; image headers are only read for
+        annotations that do not record a size.
+        """
+        if not os.path.isdir(os.path.join(self._data_path, 'Annotations')):
+            return imdb.image_sizes(self)
+        filenames = [self._annotation_path(index)
+                     for index in self.image_index]
+        cache_file = os.path.join(self.cache_path,
+                                  self.name + '_image_sizes.pkl')
+        sizes = load_size_index(filenames, cache_file,
+                                probe=self._load_annotation_size)
+        return [sizes[filename] for filename in filenames]
+
+    def _annotation_path(self, index):
+        return os.path.join(self._data_path, 'Annotations', index + '.xml')
+
+    def _load_annotation_size(self, filename):
+        """
+        Return the image size recorded in a PASCAL VOC annotation file.
+        """
+        # <size> precedes the objects, so stop parsing once it is read
+        for _, elem in ET.iterparse(filename):
+            if elem.tag == 'size':
+                width = int(float(elem.findtext('width', 0)))
+                height = int(float(elem.findtext('height', 0)))
+                if width > 0 and height > 0:
+                    return width, height
+                break
+        index = os.path.splitext(os.path.basename(filename))[0]
+        return probe_image_size(self.image_path_from_index(index))
+
     def _load_image_set_index(self):
         """
         Load the indexes listed in this dataset's image set file.
@@ -108,22 +205,59 @@ class pascal_voc(imdb):
         Return the database of ground-truth regions of interest.
 
         This function loads/saves from/to a cache file to speed up future calls.
+        Entries are cached per image along with the modification time and
+        size of their annotation file, so only annotations that were added
+        or modified since the cache was written are parsed, and entries of
+        images removed from the image set are dropped.
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
+        key = cache.fingerprint(self.classes, self.config['use_diff'])
+        cache_file = cache.cache_file(self.cache_path,
+                                      self.name + '_gt_roidb', key)
+        cached = cache.load(cache_file, key)
+        if cached is None:
+            cached = {}
+
+        annotations = [self._annotation_path(index)
+                       for index in self.image_index]
+        stats = cache.stat_files(annotations)
+        stale = [i for i, (index, stat) in enumerate(zip(self.image_index,
+                                                          stats))
+                 if index not in cached or cached[index][0] != stat]
+        # Parse the added and modified annotations in a process pool
+        parsed = ds_utils.parallel_map(
+            partial(_load_pascal_annotation, class_to_ind=self._class_to_ind,
+                    use_diff=self.config['use_diff']),
+            [annotations[i] for i in stale])
+        parsed = dict(zip(stale, parsed))
+        num_parsed = len(parsed)
+
+        entries = {}
+        gt_roidb = []
+        for i, (index, stat) in enumerate(zip(self.image_index, stats)):
+            entry = parsed[i] if i in parsed else cached[index][1]
+            entries[index] = (stat, entry)
+            gt_roidb.append(entry)
+        num_removed = len(set(cached.keys()) - set(entries.keys()))
+        if num_parsed == 0 and num_removed == 0:
             print '{} gt roidb loaded from {}'.format(self.name, cache_file)
-            return roidb
-
-        gt_roidb = [self._load_pascal_annotation(index)
-                    for index in self.image_index]
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(gt_roidb, fid, cPickle.HIGHEST_PROTOCOL)
-        print 'wrote gt roidb to {}'.format(cache_file)
+        else:
+            cache.save(entries, cache_file, key)
+            print ('wrote gt roidb to {} ({:d} annotations parsed, {:d} '
+                   'cached, {:d} removed)').format(
+                       cache_file, num_parsed, len(entries) - num_parsed,
+                       num_removed)
 
         return gt_roidb
 
+    def roidb_entry_builder(self):
+        """
+        Ground-truth entries are built by parsing only their own annotation.
+        """
+        if self.roidb_handler != self.gt_roidb:
+            return None
+        image_index = list(self.image_index)
+        return lambda i: self._load_pascal_annotation(image_index[i])
+
     def selective_search_roidb(self):
         """
         Return the database of selective search regions of interest.
@@ -131,26 +265,21 @@ class pascal_voc(imdb):
 
         This function loads/saves from/to a cache file to speed up future calls.
         """
-        cache_file = os.path.join(self.cache_path,
-                                  self.name + '_selective_search_roidb.pkl')
-
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = cPickle.load(fid)
-            print '{} ss roidb loaded from {}'.format(self.name, cache_file)
-            return roidb
-
-        if int(self._year) == 2007 or self._image_set != 'test':
-            gt_roidb = self.gt_roidb()
-            ss_roidb = self._load_selective_search_roidb(gt_roidb)
-            roidb = imdb.merge_roidbs(gt_roidb, ss_roidb)
-        else:
-            roidb = self._load_selective_search_roidb(None)
-        with open(cache_file, 'wb') as fid:
-            cPickle.dump(roidb, fid, cPickle.HIGHEST_PROTOCOL)
-        print 'wrote ss roidb to {}'.format(cache_file)
-
-        return roidb
+        use_gt = int(self._year) == 2007 or self._image_set != 'test'
+        key = cache.fingerprint(
+            self._gt_roidb_key() if use_gt else self.image_index,
+            cache.files_fingerprint([self._selective_search_source()]),
+            self.classes, self.config['min_size'])
+
+        def build():
+            if use_gt:
+                gt_roidb = self.gt_roidb()
+                ss_roidb = self._load_selective_search_roidb(gt_roidb)
+                return imdb.merge_roidbs(gt_roidb, ss_roidb)
+            return self._load_selective_search_roidb(None)
+
+        return self._cached_roidb(self.name + '_selective_search_roidb', key,
+                                  build, description='ss roidb')
 
     def rpn_roidb(self):
         if self._image_set != 'test' or int(self._year) == 2007:
@@ -163,18 +292,87 @@ class pascal_voc(imdb):
         return roidb
 
     def _load_rpn_roidb(self, gt_roidb):
+        return self.create_roidb_from_box_list(self._rpn_box_list(), gt_roidb)
+
+    def _rpn_box_list(self):
         filename = self.config['rpn_file']
         print 'loading {}'.format(filename)
         assert os.path.exists(filename), \
                'rpn data not found at: {}'.format(filename)
+        top_k = self.config['rpn_top_k']
+        if is_rpn_proposal_file(filename):
+            # Boxes are read from the memory-mapped file image by image
+            return RpnProposalFile(filename, top_k=top_k)
+        # Pickled list of box arrays written by older versions
         with open(filename, 'rb') as f:
             box_list = cPickle.load(f)
-        return self.create_roidb_from_box_list(box_list, gt_roidb)
+        if top_k is not None:
+            box_list = [boxes[:top_k, :] for boxes in box_list]
+        return box_list
 
-    def _load_selective_search_roidb(self, gt_roidb):
-        filename = os.path.abspath(os.path.join(cfg.DATA_DIR,
-                                                'selective_search_data',
-                                                self.name + '.mat'))
+    def proposal_boxes(self, i):
+        """
+        Return the selective search or RPN boxes of image i, read straight
+        from the proposal store, .mat or RPN proposal file.
+        """
+        handler, read = self._proposal_reader
+        if handler != self.roidb_handler:
+            read = self._open_proposals()
+            self._proposal_reader = (self.roidb_handler, read)
+        if read is None:
+            return imdb.proposal_boxes(self, i)
+        return read(i)
+
+    def _open_proposals(self):
+        """
+        Return a function that reads the proposal boxes of an image of the
+        roidb handler, or None if the handler does not use proposal files.
+        """
+        if self.roidb_handler == self.rpn_roidb:
+            return self._rpn_box_list().__getitem__
+        if self.roidb_handler != self.selective_search_roidb:
+            return None
+        store_file = self._proposal_store_file()
+        if os.path.exists(store_file):
+            store = ProposalStore(store_file)
+            image_index = list(self.image_index)
+            return lambda i: store.boxes(image_index[i])
+        return self._read_selective_search_file().__getitem__
+
+    def _gt_roidb_key(self):
+        """
+        Return the cache key of the gt roidb: a fingerprint of the image set,
+        the annotation files and the options used to parse them.
+        """
+        annotations = [self._annotation_path(index)
+                       for index in self.image_index]
+        return cache.fingerprint(self.image_index,
+                                 cache.stat_files(annotations),
+                                 self.classes, self.config['use_diff'])
+
+    def _selective_search_file(self, mat_dir=None):
+        if mat_dir is None:
+            mat_dir = os.path.join(cfg.DATA_DIR, 'selective_search_data')
+        return os.path.abspath(os.path.join(mat_dir, self.name + '.mat'))
+
+    def _proposal_store_file(self):
+        return os.path.abspath(os.path.join(
+            cfg.DATA_DIR, 'selective_search_data',
+            '{:s}_min{:d}.proposals'.format(self.name,
+                                            self.config['min_size'])))
+
+    def _selective_search_source(self):
+        """
+        Return the proposal store of the selective search boxes if there is
+        one, and their .mat file otherwise.
+        """
+        store_file = self._proposal_store_file()
+        if os.path.exists(store_file):
+            return store_file
+        return self._selective_search_file()
+
+    def _read_selective_search_file(self, mat_dir=None):
+        filename = self._selective_search_file(mat_dir)
         assert os.path.exists(filename), \
                'Selective search data not found at: {}'.format(filename)
         raw_data = sio.loadmat(filename)['boxes'].ravel()
@@ -187,54 +385,42 @@ class pascal_voc(imdb):
             keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
             boxes = boxes[keep, :]
             box_list.append(boxes)
+        return box_list
+
+    def _load_selective_search_roidb(self, gt_roidb):
+        store_file = self._proposal_store_file()
+        if os.path.exists(store_file):
+            print 'Loading selective search boxes from {}'.format(store_file)
+            box_list = ProposalStore(store_file).box_list(self.image_index)
+        else:
+            box_list = self._read_selective_search_file()
 
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
+    def convert_proposals(self, method='selective_search', mat_dir=None):
+        """
+        Write the selective search boxes of this image set to a proposal
+        store (see datasets.proposal_store), which is then read instead of
+        the .mat file. Returns the path of the store.
+        """
+        assert method == 'selective_search', \
+               'Only selective search proposals are provided as .mat files'
+        box_list = self._read_selective_search_file(mat_dir)
+        filename = self._proposal_store_file()
+        write_proposal_store(filename, self.image_index, box_list,
+                             {'method': method,
+                              'min_size': self.config['min_size']})
+        print 'Wrote {} proposals to {}'.format(method, filename)
+        return filename
+
     def _load_pascal_annotation(self, index):
         """
         Load image and bounding boxes info from XML file in the PASCAL VOC
         format.
         """
-        filename = os.path.join(self._data_path, 'Annotations', index + '.xml')
-        tree = ET.parse(filename)
-        objs = tree.findall('object')
-        if not self.config['use_diff']:
-            # Exclude the samples labeled as difficult
-            non_diff_objs = [
-                obj for obj in objs if int(obj.find('difficult').text) == 0]
-            # if len(non_diff_objs) != len(objs):
-            #     print 'Removed {} difficult objects'.format(
-            #         len(objs) - len(non_diff_objs))
-            objs = non_diff_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.int32)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
-        # "Seg" area for pascal is just the box area
-        seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-        # Load object bounding boxes into a data frame.
-        for ix, obj in enumerate(objs):
-            bbox = obj.find('bndbox')
-            # Make pixel indexes 0-based
-            x1 = float(bbox.find('xmin').text) - 1
-            y1 = float(bbox.find('ymin').text) - 1
-            x2 = float(bbox.find('xmax').text) - 1
-            y2 = float(bbox.find('ymax').text) - 1
-            cls = self._class_to_ind[obj.find('name').text.lower().strip()]
-            boxes[ix, :] = [x1, y1, x2, y2]
-            gt_classes[ix] = cls
-            overlaps[ix, cls] = 1.0
-            seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-
-        return {'boxes' : boxes,
-                'gt_classes': gt_classes,
-                'gt_overlaps' : overlaps,
-                'flipped' : False,
-                'seg_areas' : seg_areas}
+        return _load_pascal_annotation(self._annotation_path(index),
+                                       self._class_to_ind,
+                                       self.config['use_diff'])
 
     def _get_comp_id(self):
         comp_id = (self._comp_id + '_' + self._salt if self.config['use_salt']
@@ -252,23 +438,24 @@ class pascal_voc(imdb):
             filename)
         return path
 
-    def _write_voc_results_file(self, all_boxes):
+    def _write_voc_results_file(self, detections):
+        image_index = np.array(self.image_index)
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
                 continue
             print 'Writing {} VOC results file'.format(cls)
             filename = self._get_voc_results_file_template().format(cls)
+            rows = detections.class_rows(cls_ind)
+            # the VOCdevkit expects 1-based indices
+            boxes = detections.boxes[rows] + 1
+            fields = [np.char.mod('%.3f', detections.scores[rows])] + \
+                     [np.char.mod('%.1f', boxes[:, k]) for k in xrange(4)]
+            lines = image_index[detections.image_inds[rows]]
+            for field in fields:
+                lines = np.char.add(np.char.add(lines, ' '), field)
             with open(filename, 'wt') as f:
-                for im_ind, index in enumerate(self.image_index):
-                    dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
-                        continue
-                    # the VOCdevkit expects 1-based indices
-                    for k in xrange(dets.shape[0]):
-                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                                format(index, dets[k, -1],
-                                       dets[k, 0] + 1, dets[k, 1] + 1,
-                                       dets[k, 2] + 1, dets[k, 3] + 1))
+                for line in lines:
+                    f.write(line + '\n')
 
     def _do_python_eval(self, output_dir = 'output'):
         annopath = os.path.join(
@@ -330,8 +517,8 @@ class pascal_voc(imdb):
         print('Running:\n{}'.format(cmd))
         status = subprocess.call(cmd, shell=True)
 
-    def evaluate_detections(self, all_boxes, output_dir):
-        self._write_voc_results_file(all_boxes)
+    def evaluate_detections(self, detections, output_dir):
+        self._write_voc_results_file(as_detections(detections))
         self._do_python_eval(output_dir)
         if self.config['matlab_eval']:
             self._do_matlab_eval(output_dir)
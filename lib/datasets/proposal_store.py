@@ -0,0 +1,102 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Indexed store of precomputed object proposals.
+
+Precomputed proposals come as one .mat file per image (COCO) or as one .mat
+file holding the boxes of all images (PASCAL VOC selective search), and are
+deduplicated, filtered and truncated to the top k boxes every time a roidb
+is built from them. A proposal store holds the boxes after that processing
+in a single file:
+
+    8 bytes     length of the header
+    header      pickled dict: image keys, box offsets, dtypes and the
+                options the boxes were processed with
+    padding     to a multiple of 16 bytes
+    boxes       (num_boxes, 4) array; the boxes of image keys[i] are rows
+                offsets[i]:offsets[i + 1]
+
+The boxes are memory-mapped, so the boxes of any image are read without
+reading the others.
+"""
+
+import os
+import struct
+import cPickle
+import numpy as np
+
+_LENGTH = struct.Struct('<q')
+_ALIGN = 16
+
+def write_proposal_store(filename, keys, box_list, options):
+    """Write the boxes box_list[i] of image keys[i] to filename.
+
+    options (e.g. top_k, min_size) is stored with the boxes. Boxes are stored
+    as uint16 when that is lossless, and read back in their original dtype.
+    """
+    assert len(keys) == len(box_list)
+    offsets = np.zeros(len(box_list) + 1, dtype=np.int64)
+    np.cumsum([boxes.shape[0] for boxes in box_list], out=offsets[1:])
+    dtype = box_list[0].dtype if len(box_list) > 0 else np.dtype(np.uint16)
+    boxes = np.vstack(box_list).reshape(-1, 4) if len(box_list) > 0 \
+            else np.zeros((0, 4), dtype=dtype)
+    stored = boxes.astype(np.uint16)
+    if not (stored == boxes).all():
+        stored = boxes
+    header = cPickle.dumps({'keys': list(keys),
+                            'offsets': offsets,
+                            'dtype': np.dtype(dtype).str,
+                            'stored_dtype': stored.dtype.str,
+                            'options': options},
+                           cPickle.HIGHEST_PROTOCOL)
+    tmp_file = '{}.{:d}.tmp'.format(filename, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(_LENGTH.pack(len(header)))
+        f.write(header)
+        f.write('\0' * (-f.tell() % _ALIGN))
+        f.write(np.ascontiguousarray(stored).tobytes())
+    os.rename(tmp_file, filename)
+
+class ProposalStore(object):
+    """Read-only view of a proposal store file."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            length, = _LENGTH.unpack(f.read(_LENGTH.size))
+            header = cPickle.loads(f.read(length))
+            data_offset = f.tell() + (-f.tell() % _ALIGN)
+        self._filename = filename
+        self._keys = header['keys']
+        self._rows = dict((key, i) for i, key in enumerate(self._keys))
+        self._offsets = header['offsets']
+        self._dtype = np.dtype(header['dtype'])
+        self.options = header['options']
+        num_boxes = int(self._offsets[-1])
+        if num_boxes > 0:
+            self._boxes = np.memmap(filename, mode='r',
+                                    dtype=np.dtype(header['stored_dtype']),
+                                    offset=data_offset, shape=(num_boxes, 4))
+        else:
+            self._boxes = np.zeros((0, 4), dtype=self._dtype)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def boxes(self, key):
+        """Return the boxes of the image key."""
+        i = self._rows[key]
+        return np.array(self._boxes[self._offsets[i]:self._offsets[i + 1]],
+                        dtype=self._dtype)
+
+    def box_list(self, keys):
+        """Return the boxes of each of keys."""
+        return [self.boxes(key) for key in keys]
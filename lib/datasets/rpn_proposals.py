@@ -0,0 +1,151 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Compact, random-access file of RPN proposals.
+
+RPN proposals used to be written as one pickled list of float32 (N x 4) box
+arrays, which has to be unpickled as a whole before any image is used and
+drops the proposal scores. An RPN proposal file instead holds, for each image
+in turn, its boxes quantized to 1 / BOX_SCALE pixels as uint16 followed by
+its scores as float16, then an index of where each image's proposals start:
+
+    8 bytes     MAGIC
+    records     boxes ((n, 4) uint16) and scores ((n,) float16) of each image,
+                sorted by decreasing score
+    index       pickled dict with the number of proposals of each image and
+                the offsets of their records
+    8 bytes     offset of the index
+
+RpnProposalWriter appends one image at a time and RpnProposalFile
+memory-maps the file, so neither holds the proposals of all images in
+memory. Since the proposals of an image are sorted by score, the top k are
+its first k records.
+"""
+
+import os
+import struct
+import cPickle
+import numpy as np
+
+MAGIC = 'RPNPROP1'
+# Boxes are stored in units of 1 / BOX_SCALE pixels, which covers images of
+# up to 65535 / BOX_SCALE pixels
+BOX_SCALE = 4
+_TRAILER = struct.Struct('<q')
+
+def is_rpn_proposal_file(filename):
+    """Return whether filename is an RPN proposal file (and not a pickle)."""
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class RpnProposalWriter(object):
+    """Writes an RPN proposal file one image at a time.
+
+    The file is written to a temporary file that is renamed to filename by
+    close(), so readers never see a partial file.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._tmp_file = '{}.{:d}.tmp'.format(filename, os.getpid())
+        self._file = open(self._tmp_file, 'wb')
+        self._file.write(MAGIC)
+        self._num_boxes = []
+        self._offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, boxes, scores):
+        """Append the proposals (boxes and scores) of the next image."""
+        scores = np.asarray(scores, dtype=np.float32).ravel()
+        assert boxes.shape[0] == scores.shape[0]
+        order = np.argsort(-scores, kind='mergesort')
+        quantized = np.round(boxes[order, :4] * BOX_SCALE)
+        assert quantized.size == 0 or \
+               (quantized.min() >= 0 and quantized.max() <= 65535), \
+               'RPN boxes outside of [0, {:d}]'.format(65535 // BOX_SCALE)
+        self._offsets.append(self._file.tell())
+        self._num_boxes.append(boxes.shape[0])
+        self._file.write(quantized.astype(np.uint16).tobytes())
+        self._file.write(scores[order].astype(np.float16).tobytes())
+
+    def abort(self):
+        """Discard the file written so far."""
+        self._file.close()
+        os.remove(self._tmp_file)
+
+    def close(self):
+        index_offset = self._file.tell()
+        cPickle.dump({'num_boxes': np.array(self._num_boxes, dtype=np.int64),
+                      'offsets': np.array(self._offsets, dtype=np.int64),
+                      'box_scale': BOX_SCALE},
+                     self._file, cPickle.HIGHEST_PROTOCOL)
+        self._file.write(_TRAILER.pack(index_offset))
+        self._file.close()
+        os.rename(self._tmp_file, self._filename)
+
+class RpnProposalFile(object):
+    """Memory-mapped RPN proposal file.
+
+    Indexing returns the boxes (float32) of an image, limited to the top_k
+    highest scoring proposals if top_k is given, so the file can be used in
+    place of a list of box arrays.
+    """
+
+    def __init__(self, filename, top_k=None):
+        with open(filename, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, \
+                   '{} is not an RPN proposal file'.format(filename)
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            index_offset, = _TRAILER.unpack(f.read(_TRAILER.size))
+            f.seek(index_offset)
+            index = cPickle.load(f)
+        self._num_boxes = index['num_boxes']
+        self._offsets = index['offsets']
+        self._box_scale = float(index['box_scale'])
+        self._data = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.top_k = top_k
+
+    def __len__(self):
+        return len(self._num_boxes)
+
+    def _num_records(self, i, top_k):
+        n = int(self._num_boxes[i])
+        if top_k is None:
+            top_k = self.top_k
+        return n if top_k is None else min(n, top_k)
+
+    def boxes(self, i, top_k=None):
+        """Return the boxes of image i (the top_k highest scoring ones, if
+        given, or self.top_k)."""
+        n = self._num_records(i, top_k)
+        start = self._offsets[i]
+        quantized = self._data[start:start + n * 8].view(np.uint16)
+        return quantized.reshape(n, 4).astype(np.float32) / self._box_scale
+
+    def scores(self, i, top_k=None):
+        """Return the scores of the boxes returned by boxes(i, top_k)."""
+        n = self._num_records(i, top_k)
+        start = self._offsets[i] + int(self._num_boxes[i]) * 8
+        return self._data[start:start + n * 2].view(np.float16) \
+                   .astype(np.float32)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('proposal index out of range')
+        return self.boxes(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.boxes(i)
@@ -0,0 +1,66 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Persistent index of image sizes.
+
+Reading the size of every image of a dataset from network storage is slow,
+so sizes are probed in parallel from the file headers only and stored in a
+size index file next to the roidb caches. An entry is reused for as long as
+the modification time of the file it was read from does not change.
+"""
+
+import os
+import cPickle
+from multiprocessing.pool import ThreadPool
+import PIL.Image
+from datasets.cache import write_atomic
+from fast_rcnn.config import cfg
+
+def probe_image_size(path):
+    """Return the (width, height) of an image reading only its header."""
+    with open(path, 'rb') as f:
+        # PIL parses the header on open and only decodes on load()
+        return PIL.Image.open(f).size
+
+def _stat_mtime(path):
+    return os.stat(path).st_mtime
+
+def load_size_index(files, cache_file, probe=probe_image_size,
+                    num_threads=None):
+    """Return a dict mapping each of files to a (width, height) tuple.
+
+    probe(file) returns the size recorded in file (the image itself or,
+    e.g., its annotation). Entries of cache_file whose file has not been
+    modified since are reused; the others are probed with a thread pool and
+    cache_file is rewritten.
+    """
+    if num_threads is None:
+        num_threads = cfg.DATA_IO_THREADS
+    files = sorted(set(files))
+    index = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as fid:
+            index = cPickle.load(fid)
+
+    pool = ThreadPool(num_threads)
+    try:
+        mtimes = pool.map(_stat_mtime, files, chunksize=64)
+        stale = [f for f, mtime in zip(files, mtimes)
+                 if f not in index or index[f][0] != mtime]
+        if len(stale) > 0:
+            print 'Probing the size of {:d} / {:d} images'.format(
+                len(stale), len(files))
+            sizes = pool.map(probe, stale, chunksize=16)
+            file_mtimes = dict(zip(files, mtimes))
+            for f, size in zip(stale, sizes):
+                index[f] = (file_mtimes[f], size[0], size[1])
+            # Concurrent training processes never read a partial index
+            write_atomic(index, cache_file)
+            print 'Wrote image size index to {}'.format(cache_file)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict((f, index[f][1:]) for f in files)
@@ -0,0 +1,146 @@
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Synthetic VOC-like image database for benchmarking the data pipeline.
+
+Images are random smooth JPEGs with PASCAL VOC-like sizes, ground-truth
+boxes are drawn at random and object proposals are a mix of jittered
+ground-truth boxes and random boxes. Nothing here needs Caffe or a GPU.
+"""
+
+import os
+import os.path as osp
+from datasets.imdb import imdb
+import numpy as np
+import cv2
+from fast_rcnn.config import cfg
+
+class synthetic(imdb):
+    def __init__(self, num_images, num_classes=21, num_proposals=2000,
+                 data_dir=None, seed=None, write_images=True):
+        imdb.__init__(self, 'synthetic_{:d}'.format(num_images))
+        self._classes = tuple(['__background__'] +
+                              ['class{:d}'.format(i)
+                               for i in xrange(1, num_classes)])
+        self._image_index = ['{:06d}'.format(i) for i in xrange(num_images)]
+        self._data_path = osp.join(cfg.DATA_DIR, 'synthetic') \
+                          if data_dir is None else data_dir
+        self._image_ext = '.jpg'
+        self._seed = cfg.RNG_SEED if seed is None else seed
+        self._roidb_handler = self.proposals_roidb
+
+        # Synthetic dataset specific config options
+        self.config = {'num_proposals' : num_proposals,
+                       'max_objects'   : 8}
+
+        # PASCAL VOC images are mostly 500 x 375 or 375 x 500
+        rng = np.random.RandomState(self._seed)
+        long_side = rng.randint(334, 501, size=num_images)
+        short_side = rng.randint(250, 376, size=num_images)
+        horz = rng.rand(num_images) < 0.7
+        self._widths = np.where(horz, long_side, short_side)
+        self._heights = np.where(horz, short_side, long_side)
+
+        if write_images:
+            self._write_images()
+
+    def image_path_at(self, i):
+        """
+        Return the absolute path to image i in the image sequence.
+        """
+        return self.image_path_from_index(self._image_index[i])
+
+    def image_path_from_index(self, index):
+        """
+        Construct an image path from the image's "index" identifier.
+        """
+        return osp.join(self._data_path, 'JPEGImages',
+                        index + self._image_ext)
+
+    def image_sizes(self):
+        return [(int(self._widths[int(index)]), int(self._heights[int(index)]))
+                for index in self.image_index]
+
+    def _write_images(self):
+        """Write the JPEGs that do not exist yet."""
+        image_dir = osp.join(self._data_path, 'JPEGImages')
+        if not osp.exists(image_dir):
+            os.makedirs(image_dir)
+        rng = np.random.RandomState(self._seed)
+        for i, index in enumerate(self._image_index):
+            path = self.image_path_from_index(index)
+            if osp.exists(path):
+                continue
+            # Upsampled low resolution noise compresses (and decodes) more
+            # like a natural image than per-pixel noise
+            small = rng.randint(0, 256, size=(12, 16, 3)).astype(np.uint8)
+            im = cv2.resize(small, (int(self._widths[i]),
+                                    int(self._heights[i])),
+                            interpolation=cv2.INTER_CUBIC)
+            cv2.imwrite(path, im)
+        print 'Wrote {:d} synthetic images to {:s}'.format(self.num_images,
+                                                           image_dir)
+
+    def _random_boxes(self, rng, num_boxes, width, height):
+        x = np.sort(rng.randint(0, width, size=(num_boxes, 2)), axis=1)
+        y = np.sort(rng.randint(0, height, size=(num_boxes, 2)), axis=1)
+        return np.hstack((x[:, :1], y[:, :1], x[:, 1:], y[:, 1:]))
+
+    def gt_roidb(self):
+        """
+        Return the database of (random) ground-truth regions of interest.
+        """
+        rng = np.random.RandomState(self._seed + 1)
+        gt_roidb = []
+        for i in xrange(self.num_images):
+            num_objs = rng.randint(1, self.config['max_objects'] + 1)
+            boxes = self._random_boxes(rng, num_objs, self._widths[i],
+                                       self._heights[i]).astype(np.int32)
+            gt_classes = rng.randint(1, self.num_classes,
+                                     size=num_objs).astype(np.int32)
+            seg_areas = ((boxes[:, 2] - boxes[:, 0] + 1.0) *
+                         (boxes[:, 3] - boxes[:, 1] + 1.0)).astype(np.float32)
+            gt_roidb.append({'boxes' : boxes,
+                             'gt_classes' : gt_classes,
+                             'max_overlaps' : np.ones(num_objs,
+                                                      dtype=np.float32),
+                             'max_classes' : gt_classes.astype(np.uint16),
+                             'flipped' : False,
+                             'seg_areas' : seg_areas})
+        return gt_roidb
+
+    def proposal_box_list(self, gt_roidb):
+        """Return random proposals, half of them jittered ground truth."""
+        rng = np.random.RandomState(self._seed + 2)
+        num_proposals = self.config['num_proposals']
+        box_list = []
+        for i in xrange(self.num_images):
+            width = self._widths[i]
+            height = self._heights[i]
+            gt_boxes = gt_roidb[i]['boxes'].astype(np.float32)
+            num_jittered = num_proposals // 2
+            jittered = gt_boxes[rng.randint(0, gt_boxes.shape[0],
+                                            size=num_jittered)]
+            sizes = np.tile(jittered[:, 2:] - jittered[:, :2] + 1, (1, 2))
+            jittered += rng.randn(num_jittered, 4) * 0.1 * sizes
+            boxes = np.vstack((
+                jittered,
+                self._random_boxes(rng, num_proposals - num_jittered,
+                                   width, height)))
+            boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, width - 1)
+            boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, height - 1)
+            boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2])
+            box_list.append(np.round(boxes).astype(np.uint16))
+        return box_list
+
+    def proposals_roidb(self):
+        """
+        Return the database of proposal regions of interest. Ground-truth
+        ROIs are also included.
+        """
+        gt_roidb = self.gt_roidb()
+        box_list = self.proposal_box_list(gt_roidb)
+        roidb = self.create_roidb_from_box_list(box_list, gt_roidb)
+        return imdb.merge_roidbs(gt_roidb, roidb)
@@ -8,12 +8,15 @@ import xml.etree.ElementTree as ET
 import os
 import cPickle
 import numpy as np
+from datasets.ds_utils import parallel_map
 
 def parse_rec(filename):
     """ Parse a PASCAL VOC xml file """
-    tree = ET.parse(filename)
     objects = []
-    for obj in tree.findall('object'):
+    # Stream the file, keeping only the objects
+    for _, obj in ET.iterparse(filename):
+        if obj.tag != 'object':
+            continue
         obj_struct = {}
         obj_struct['name'] = obj.find('name').text
         obj_struct['pose'] = obj.find('pose').text
@@ -25,6 +28,7 @@ def parse_rec(filename):
                               int(bbox.find('xmax').text),
                               int(bbox.find('ymax').text)]
         objects.append(obj_struct)
+        obj.clear()
 
     return objects
 
@@ -104,12 +108,9 @@ def voc_eval(detpath,
 
     if not os.path.isfile(cachefile):
         # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                print 'Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(imagenames))
+        print 'Reading annotations for {:d} images'.format(len(imagenames))
+        recs = dict(zip(imagenames, parallel_map(
+            parse_rec, [annopath.format(x) for x in imagenames])))
         # save
         print 'Saving cached annotations to {:s}'.format(cachefile)
         with open(cachefile, 'w') as f:
@@ -77,6 +77,12 @@ __C.TRAIN.SNAPSHOT_INFIX = ''
 # Use a prefetch thread in roi_data_layer.layer
 # So far I haven't found this useful; likely more engineering work is required
 __C.TRAIN.USE_PREFETCH = False
+# Number of prefetch processes (each builds every PREFETCH_WORKERS-th minibatch)
+__C.TRAIN.PREFETCH_WORKERS = 1
+
+# Hand the data layer a memory-mapped columnar copy of the roidb (see
+# datasets.columnar_roidb) that prefetch processes share instead of copying
+__C.TRAIN.COLUMNAR_ROIDB = False
 
 # Normalize the targets (subtract empirical mean, divide by empirical stddev)
 __C.TRAIN.BBOX_NORMALIZE_TARGETS = True
@@ -95,6 +101,17 @@ __C.TRAIN.PROPOSAL_METHOD = 'selective_search'
 # tall and thin or both short and wide) in order to avoid wasting computation
 # on zero-padding.
 __C.TRAIN.ASPECT_GROUPING = True
+# How images are grouped when ASPECT_GROUPING is on:
+#   'orientation': horizontal with horizontal, vertical with vertical
+#   'shape': identical resized blob shapes only (no padding, fewer reshapes)
+#   'bins': same bin out of ASPECT_BINS quantized log aspect ratios
+__C.TRAIN.ASPECT_GROUPING_MODE = 'orientation'
+__C.TRAIN.ASPECT_BINS = 8
+
+# Distributed training: this process draws the RANK-th of WORLD_SIZE disjoint
+# shards of every epoch (all processes must use the same RNG_SEED)
+__C.TRAIN.RANK = 0
+__C.TRAIN.WORLD_SIZE = 1
 
 # Use RPN to detect objects
 __C.TRAIN.HAS_RPN = False
@@ -162,6 +179,27 @@ __C.TEST.RPN_PRE_NMS_TOP_N = 6000
 __C.TEST.RPN_POST_NMS_TOP_N = 300
 # Proposal height and width both need to be greater than RPN_MIN_SIZE (at orig image scale)
 __C.TEST.RPN_MIN_SIZE = 16
+## Measure the recall of RPN proposals against the gt roidb while they are
+## generated (rpn.generate.imdb_proposals)
+__C.TEST.RPN_EVAL_RECALL = False
+## Proposal limits to measure the recall of (None for all proposals)
+__C.TEST.RPN_RECALL_LIMITS = [50, 100, 300, 1000, None]
+## Log the running average recall every RPN_RECALL_PERIOD images
+__C.TEST.RPN_RECALL_PERIOD = 500
+
+# Number of threads that read and preprocess test images ahead of the network
+# (0 to do it in the main thread)
+__C.TEST.LOAD_THREADS = 2
+# Number of threads that threshold and NMS the detections of tested images
+# (0 to do it in the main thread). The threads always use CPU NMS, so set 0 to
+# honour USE_GPU_NMS
+__C.TEST.POSTPROCESS_THREADS = 2
+# Max number of images read ahead of the network, and of images waiting for
+# post-processing
+__C.TEST.PIPELINE_DEPTH = 4
+# Save the detections of test_net every CHECKPOINT_IMAGES images, so that an
+# interrupted test resumes from there
+__C.TEST.CHECKPOINT_IMAGES = 1000
 
 
 #
@@ -192,6 +230,18 @@ __C.ROOT_DIR = osp.abspath(osp.join(osp.dirname(__file__), '..', '..'))
 # Data directory
 __C.DATA_DIR = osp.abspath(osp.join(__C.ROOT_DIR, 'data'))
 
+# Number of threads used to read image headers and annotation files, which
+# mostly wait on (network) storage
+__C.DATA_IO_THREADS = 16
+
+# Number of processes used to parse annotation files and to match proposals
+# to ground-truth boxes
+__C.DATA_PARSE_PROCESSES = 8
+
+# Build (or load) roidb entries on first access instead of all at once (see
+# datasets.lazy_roidb); cached roidbs are stored as indexed per-image stores
+__C.LAZY_ROIDB = False
+
 # Model directory
 __C.MODELS_DIR = osp.abspath(osp.join(__C.ROOT_DIR, 'models', 'pascal_voc'))
 
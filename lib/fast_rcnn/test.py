@@ -16,8 +16,12 @@ import numpy as np
 import cv2
 import caffe
 from fast_rcnn.nms_wrapper import nms
-import cPickle
+from datasets.detections import Detections, DetectionWriter, as_detections
+import datasets.cache as cache
 from utils.blob import im_list_to_blob
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import time
 import os
 
 def _get_image_blob(im):
@@ -106,20 +110,16 @@ def _get_blobs(im, rois):
         blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
     return blobs, im_scale_factors
 
-def im_detect(net, im, boxes=None):
-    """Detect object classes in an image given object proposals.
-
-    Arguments:
-        net (caffe.Net): Fast R-CNN network to use
-        im (ndarray): color image to test (in BGR order)
-        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
+def _im_detect_inputs(im, boxes=None):
+    """Compute the network inputs of im_detect (no network access).
 
     Returns:
-        scores (ndarray): R x K array of object class scores (K includes
-            background as object category 0)
-        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+        inputs (dict): the network input blobs ('blobs'), the image scales
+            ('im_scales'), the proposals left after deduplication ('boxes')
+            and the map back to all proposals ('inv_index')
     """
     blobs, im_scales = _get_blobs(im, boxes)
+    inv_index = None
 
     # When mapping from image ROIs to feature map ROIs, there's some aliasing
     # (some distinct image ROIs get mapped to the same feature ROI).
@@ -139,6 +139,22 @@ def im_detect(net, im, boxes=None):
             [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
             dtype=np.float32)
 
+    # Convert once here instead of in the forward pass
+    for key in blobs.keys():
+        if blobs[key] is not None:
+            blobs[key] = blobs[key].astype(np.float32, copy=False)
+
+    return {'blobs': blobs, 'im_scales': im_scales, 'boxes': boxes,
+            'inv_index': inv_index}
+
+def _im_detect_forward(net, inputs):
+    """Run the network on the inputs of _im_detect_inputs.
+
+    Returns copies of the outputs of the network used by _im_detect_outputs,
+    which stay valid after the next forward pass.
+    """
+    blobs = inputs['blobs']
+
     # reshape network inputs
     net.blobs['data'].reshape(*(blobs['data'].shape))
     if cfg.TEST.HAS_RPN:
@@ -147,43 +163,76 @@ def im_detect(net, im, boxes=None):
         net.blobs['rois'].reshape(*(blobs['rois'].shape))
 
     # do forward
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
+    forward_kwargs = {'data': blobs['data']}
     if cfg.TEST.HAS_RPN:
-        forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
+        forward_kwargs['im_info'] = blobs['im_info']
     else:
-        forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
+        forward_kwargs['rois'] = blobs['rois']
     blobs_out = net.forward(**forward_kwargs)
 
+    outputs = {}
     if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
-        rois = net.blobs['rois'].data.copy()
-        # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
-
+        outputs['rois'] = net.blobs['rois'].data.copy()
     if cfg.TEST.SVM:
         # use the raw scores before softmax under the assumption they
         # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
+        outputs['scores'] = net.blobs['cls_score'].data.copy()
     else:
         # use softmax estimated probabilities
-        scores = blobs_out['cls_prob']
+        outputs['scores'] = blobs_out['cls_prob'].copy()
+    if cfg.TEST.BBOX_REG:
+        outputs['bbox_pred'] = blobs_out['bbox_pred'].copy()
+    return outputs
+
+def _im_detect_outputs(inputs, outputs, im_shape):
+    """Turn the network outputs of an image of shape im_shape into the
+    scores and boxes returned by im_detect (no network access).
+    """
+    im_scales = inputs['im_scales']
+    if cfg.TEST.HAS_RPN:
+        assert len(im_scales) == 1, "Only single-image batch implemented"
+        rois = outputs['rois']
+        # unscale back to raw image space
+        boxes = rois[:, 1:5] / im_scales[0]
+    else:
+        boxes = inputs['boxes']
+
+    scores = outputs['scores']
 
     if cfg.TEST.BBOX_REG:
         # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
+        box_deltas = outputs['bbox_pred']
         pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
+        pred_boxes = clip_boxes(pred_boxes, im_shape)
     else:
         # Simply repeat the boxes, once for each class
         pred_boxes = np.tile(boxes, (1, scores.shape[1]))
 
     if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
         # Map scores and predictions back to the original set of boxes
+        inv_index = inputs['inv_index']
         scores = scores[inv_index, :]
         pred_boxes = pred_boxes[inv_index, :]
 
     return scores, pred_boxes
 
+def im_detect(net, im, boxes=None):
+    """Detect object classes in an image given object proposals.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        im (ndarray): color image to test (in BGR order)
+        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
+
+    Returns:
+        scores (ndarray): R x K array of object class scores (K includes
+            background as object category 0)
+        boxes (ndarray): R x (4*K) array of predicted bounding boxes
+    """
+    inputs = _im_detect_inputs(im, boxes)
+    outputs = _im_detect_forward(net, inputs)
+    return _im_detect_outputs(inputs, outputs, im.shape)
+
 def vis_detections(im, class_name, dets, thresh=0.3):
     """Visual debugging of detections."""
     import matplotlib.pyplot as plt
@@ -203,94 +252,256 @@ def vis_detections(im, class_name, dets, thresh=0.3):
             plt.title('{}  {:.3f}'.format(class_name, score))
             plt.show()
 
-def apply_nms(all_boxes, thresh):
+def apply_nms(detections, thresh):
     """Apply non-maximum suppression to all predicted boxes output by the
-    test_net method.
+    test_net method (Detections or all_boxes[cls][image]), and return them
+    as Detections.
     """
-    num_classes = len(all_boxes)
-    num_images = len(all_boxes[0])
-    nms_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
+    detections = as_detections(detections)
+    nms_dets = Detections(detections.num_images, detections.num_classes)
+    for cls_ind in xrange(detections.num_classes):
+        rows = detections.class_rows(cls_ind)
+        image_inds = detections.image_inds[rows]
+        # Boundaries of the runs of rows of each image
+        bounds = np.concatenate(([0], np.where(np.diff(image_inds))[0] + 1,
+                                 [len(rows)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end == start:
                 continue
+            dets = detections.dets(rows[start:end])
             # CPU NMS is much faster than GPU NMS when the number of boxes
             # is relative small (e.g., < 10k)
             # TODO(rbg): autotune NMS dispatch
             keep = nms(dets, thresh, force_cpu=True)
-            if len(keep) == 0:
-                continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
-    return nms_boxes
+            nms_dets.append(image_inds[start], cls_ind, dets[keep, :])
+    return nms_dets
 
-def test_net(net, imdb, max_per_image=100, thresh=0.05, vis=False):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
+def _load_test_image(image_path, box_proposals):
+    """Read an image and compute its network inputs."""
+    im = cv2.imread(image_path)
+    return im, _im_detect_inputs(im, box_proposals)
+
+def _image_detections(scores, boxes, num_classes, max_per_image, thresh,
+                      force_cpu_nms=False):
+    """Threshold and NMS the detections of one image.
+
+    Returns the per-class detections (N x 5 arrays, with class 0 empty) and
+    the time spent.
+    """
+    start = time.time()
+    dets = [[] for _ in xrange(num_classes)]
+    # skip j = 0, because it's the background class
+    for j in xrange(1, num_classes):
+        inds = np.where(scores[:, j] > thresh)[0]
+        cls_scores = scores[inds, j]
+        cls_boxes = boxes[inds, j*4:(j+1)*4]
+        cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
+            .astype(np.float32, copy=False)
+        keep = nms(cls_dets, cfg.TEST.NMS, force_cpu=force_cpu_nms)
+        dets[j] = cls_dets[keep, :]
+
+    # Limit to max_per_image detections *over all classes*
+    if max_per_image > 0:
+        image_scores = np.hstack([dets[j][:, -1]
+                                  for j in xrange(1, num_classes)])
+        if len(image_scores) > max_per_image:
+            image_thresh = np.sort(image_scores)[-max_per_image]
+            for j in xrange(1, num_classes):
+                keep = np.where(dets[j][:, -1] >= image_thresh)[0]
+                dets[j] = dets[j][keep, :]
+    return dets, time.time() - start
+
+def _postprocess(im, inputs, outputs, num_classes, max_per_image, thresh,
+                 force_cpu_nms):
+    """Compute the detections of an image from its network outputs.
+
+    Returns the image, its per-class detections and the time spent.
+    """
+    scores, boxes = _im_detect_outputs(inputs, outputs, im.shape)
+    dets, post_time = _image_detections(scores, boxes, num_classes,
+                                        max_per_image, thresh, force_cpu_nms)
+    return im, dets, post_time
+
+def _ordered_map(pool, func, args_iter, depth):
+    """Yield func(*args) for each args of args_iter, in order.
+
+    The calls run in pool (or in the calling thread if pool is None), at
+    most depth of them ahead of the caller. args_iter is consumed in the
+    calling thread.
+    """
+    pending = deque()
+    for args in args_iter:
+        if pool is None:
+            yield func(*args)
+            continue
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def shard_image_inds(num_images, shard):
+    """Return the indices of the images tested by shard (index, num_shards).
+
+    Shard k tests every num_shards-th image starting at image k, which
+    spreads images of similar size (and cost) over the shards.
+    """
+    shard_index, num_shards = shard
+    assert 0 <= shard_index < num_shards, \
+            'invalid shard {:d}/{:d}'.format(shard_index, num_shards)
+    return range(shard_index, num_images, num_shards)
+
+def shard_detections_dir(output_dir, shard):
+    """Return the directory of the partial detections of a shard."""
+    return os.path.join(output_dir, 'detections_shard{:d}of{:d}'
+                                    .format(shard[0], shard[1]))
+
+def merge_detection_shards(output_dir, num_shards, num_images, num_classes):
+    """Return the Detections of all images, assembled from the partial
+    detections written to output_dir by test_net for shards 0 to
+    num_shards - 1.
+    """
+    partials = []
+    for shard_index in xrange(num_shards):
+        shard = (shard_index, num_shards)
+        shard_dir = shard_detections_dir(output_dir, shard)
+        assert os.path.exists(shard_dir), \
+                'Missing detections of shard {:d}/{:d}: {}'.format(
+                    shard_index, num_shards, shard_dir)
+        partial = Detections.load(shard_dir)
+        assert partial.num_images == num_images and \
+               partial.num_classes == num_classes, \
+                '{} holds detections of {:d} images and {:d} classes, ' \
+                'not {:d} and {:d}'.format(shard_dir, partial.num_images,
+                                           partial.num_classes, num_images,
+                                           num_classes)
+        assert (partial.image_inds % num_shards == shard_index).all(), \
+                '{} holds detections of images of other shards'.format(
+                    shard_dir)
+        partials.append(partial)
+    return Detections.concatenate(partials)
+
+def evaluate_detection_shards(imdb, output_dir, num_shards):
+    """Merge the detections of all shards in output_dir, save them to
+    output_dir/detections and evaluate them.
+    """
+    detections = merge_detection_shards(output_dir, num_shards,
+                                        imdb.num_images, imdb.num_classes)
+    detections.save(os.path.join(output_dir, 'detections'))
 
+    print 'Evaluating detections'
+    imdb.evaluate_detections(detections, output_dir)
+
+# Test settings that do not change the detections, and can differ between an
+# interrupted test and the test resuming it
+_RESUMABLE_TEST_KEYS = ('LOAD_THREADS', 'POSTPROCESS_THREADS',
+                        'PIPELINE_DEPTH', 'CHECKPOINT_IMAGES')
+
+def test_net(net, imdb, max_per_image=100, thresh=0.05, vis=False,
+             shard=None, model_files=None):
+    """Test a Fast R-CNN network on an image database.
+
+    Images are read and preprocessed ahead by cfg.TEST.LOAD_THREADS threads
+    and their detections are thresholded and NMSed by
+    cfg.TEST.POSTPROCESS_THREADS threads, so the main thread only runs the
+    network. The detections are the same as when testing one image at a
+    time. The post-processing threads NMS on the CPU, since the GPU is not
+    shared with the thread running the network; with
+    cfg.TEST.POSTPROCESS_THREADS = 0, cfg.USE_GPU_NMS is honoured.
+
+    If shard is given as (index, num_shards), only the images of that shard
+    are tested and their detections are saved as partial detections
+    instead of being evaluated; see merge_detection_shards.
+
+    Detections are saved every cfg.TEST.CHECKPOINT_IMAGES images. Testing
+    again with the same net, imdb and settings after an interruption skips
+    the images whose detections were saved. model_files (e.g. the prototxt
+    and caffemodel the net was loaded from) are fingerprinted by
+    modification time and size, so retrained weights are not resumed from
+    the detections of the old ones.
+    """
+    num_images = len(imdb.image_index)
     output_dir = get_output_dir(imdb, net)
+    # all detections are written to a DetectionWriter, holding the N x 5
+    # arrays of detections in (x1, y1, x2, y2, score) of each class and image
+    det_dir = os.path.join(output_dir, 'detections') if shard is None \
+              else shard_detections_dir(output_dir, shard)
+    # Detections are visualized in the main thread
+    threaded_post = cfg.TEST.POSTPROCESS_THREADS > 0 and not vis
+    use_gpu_nms = cfg.USE_GPU_NMS and not threaded_post
+    test_cfg = dict((key, value) for key, value in cfg.TEST.iteritems()
+                    if key not in _RESUMABLE_TEST_KEYS)
+    model_key = None if model_files is None \
+                else cache.files_fingerprint(model_files)
+    run_key = cache.fingerprint(imdb.name, list(imdb.image_index), net.name,
+                                model_key, shard, max_per_image, thresh,
+                                test_cfg, cfg.PIXEL_MEANS.tolist(),
+                                cfg.DEDUP_BOXES, use_gpu_nms)
+    writer = DetectionWriter(det_dir, num_images, imdb.num_classes, run_key,
+                             cfg.TEST.CHECKPOINT_IMAGES)
+    image_inds = range(num_images) if shard is None \
+                 else shard_image_inds(num_images, shard)
+    image_inds = [i for i in image_inds if not writer.done(i)]
 
     # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
-
-    if not cfg.TEST.HAS_RPN:
-        roidb = imdb.roidb
-
-    for i in xrange(num_images):
-        # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        im = cv2.imread(imdb.image_path_at(i))
-        _t['im_detect'].tic()
-        scores, boxes = im_detect(net, im, box_proposals)
-        _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
+    _t = {'im_detect' : Timer()}
+    misc_time = 0.0
+
+    def load_args():
+        for i in image_inds:
+            # filter out any ground truth boxes
+            if cfg.TEST.HAS_RPN:
+                box_proposals = None
+            else:
+                # The roidb may contain ground-truth rois (for example, if the
+                # roidb comes from the training or val split). We only want to
+                # evaluate detection on the *non*-ground-truth rois, which the
+                # imdb reads straight from its proposal files without building
+                # the roidb.
+                box_proposals = imdb.proposal_boxes(i)
+            yield imdb.image_path_at(i), box_proposals
+
+    def forward(loaded):
+        for im, inputs in loaded:
+            _t['im_detect'].tic()
+            outputs = _im_detect_forward(net, inputs)
+            _t['im_detect'].toc()
+            yield (im, inputs, outputs, imdb.num_classes, max_per_image,
+                   thresh, not use_gpu_nms)
+
+    depth = max(1, cfg.TEST.PIPELINE_DEPTH)
+    load_pool = ThreadPool(cfg.TEST.LOAD_THREADS) \
+                if cfg.TEST.LOAD_THREADS > 0 else None
+    post_pool = ThreadPool(cfg.TEST.POSTPROCESS_THREADS) \
+                if threaded_post else None
+    try:
+        loaded = _ordered_map(load_pool, _load_test_image, load_args(), depth)
+        for k, (im, dets, post_time) in enumerate(
+                _ordered_map(post_pool, _postprocess, forward(loaded), depth)):
+            i = image_inds[k]
             if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
                 for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        _t['misc'].toc()
-
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+                    vis_detections(im, imdb.classes[j], dets[j])
+            writer.add(i, dets)
+            misc_time += post_time
+
+            print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
+                  .format(k + 1, len(image_inds),
+                          _t['im_detect'].average_time, misc_time / (k + 1))
+    except:
+        # Keep the detections of the images that were done
+        writer.flush()
+        raise
+    finally:
+        for pool in (load_pool, post_pool):
+            if pool is not None:
+                pool.terminate()
+    writer.close()
+
+    if shard is not None:
+        print 'Wrote detections of shard {:d}/{:d} to {}'.format(
+            shard[0], shard[1], det_dir)
+        return
 
     print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+    imdb.evaluate_detections(Detections.load(det_dir), output_dir)
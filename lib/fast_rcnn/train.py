@@ -11,8 +11,10 @@ matplotlib.use("Agg")
 import caffe
 from fast_rcnn.config import cfg
 import roi_data_layer.roidb as rdl_roidb
+from datasets.columnar_roidb import ColumnarRoidb
 from utils.timer import Timer
 import numpy as np
+import cPickle
 import os
 
 from caffe.proto import caffe_pb2
@@ -42,6 +44,13 @@ class SolverWrapper(object):
                     rdl_roidb.add_bbox_regression_targets(roidb)
             print 'done'
 
+        if cfg.TRAIN.COLUMNAR_ROIDB:
+            roidb_dir = os.path.join(
+                output_dir, 'roidb_rank{:d}'.format(cfg.TRAIN.RANK))
+            print 'Writing columnar roidb to {:s}'.format(roidb_dir)
+            ColumnarRoidb.from_list(roidb).save(roidb_dir)
+            roidb = ColumnarRoidb.load(roidb_dir, mmap_mode='r')
+
         self.solver = caffe.SGDSolver(solver_prototxt)
         if pretrained_model is not None:
             print ('Loading pretrained model '
@@ -52,7 +61,21 @@ class SolverWrapper(object):
         with open(solver_prototxt, 'rt') as f:
             pb2.text_format.Merge(f.read(), self.solver_param)
 
-        self.solver.net.layers[0].set_roidb(roidb)
+        sampler_state = None
+        if pretrained_model is not None and starting_iters > 0:
+            # Resume minibatch sampling from the snapshot we restart from
+            state_file = self._sampler_state_file(pretrained_model)
+            if os.path.exists(state_file):
+                with open(state_file, 'rb') as f:
+                    sampler_state = cPickle.load(f)
+                print 'Resuming minibatch sampling from {:s}'.format(
+                    state_file)
+        self.solver.net.layers[0].set_roidb(roidb, sampler_state)
+
+    def _sampler_state_file(self, model_path):
+        """Return the path of the sampler state saved with a snapshot."""
+        return (os.path.splitext(model_path)[0] +
+                '_sampler_rank{:d}.pkl'.format(cfg.TRAIN.RANK))
 
     def snapshot(self):
         """Take a snapshot of the network after unnormalizing the learned
@@ -86,6 +109,11 @@ class SolverWrapper(object):
         net.save(str(filename))
         print 'Wrote snapshot to: {:s}'.format(filename)
 
+        state_file = self._sampler_state_file(filename)
+        with open(state_file, 'wb') as f:
+            cPickle.dump(net.layers[0].get_sampler_state(), f,
+                         cPickle.HIGHEST_PROTOCOL)
+
         if scale_bbox_params:
             # restore net to original state
             net.params['bbox_pred'][0].data[...] = orig_0
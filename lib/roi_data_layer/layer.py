@@ -12,73 +12,35 @@ RoIDataLayer implements a Caffe Python layer.
 
 import caffe
 from fast_rcnn.config import cfg
-from roi_data_layer.minibatch import get_minibatch
-import numpy as np
+from roi_data_layer.loader import MinibatchLoader
 import yaml
-from multiprocessing import Process, Queue
 
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
-    def _shuffle_roidb_inds(self):
-        """Randomly permute the training roidb."""
-        if cfg.TRAIN.ASPECT_GROUPING:
-            widths = np.array([r['width'] for r in self._roidb])
-            heights = np.array([r['height'] for r in self._roidb])
-            horz = (widths >= heights)
-            vert = np.logical_not(horz)
-            horz_inds = np.where(horz)[0]
-            vert_inds = np.where(vert)[0]
-            inds = np.hstack((
-                np.random.permutation(horz_inds),
-                np.random.permutation(vert_inds)))
-            inds = np.reshape(inds, (-1, 2))
-            row_perm = np.random.permutation(np.arange(inds.shape[0]))
-            inds = np.reshape(inds[row_perm, :], (-1,))
-            self._perm = inds
-        else:
-            self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds()
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
     def _get_next_minibatch(self):
         """Return the blobs to be used for the next minibatch.
 
-        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in a
-        separate process and made available through self._blob_queue.
+        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in
+        separate processes by the MinibatchLoader.
+        """
+        return self._loader.next_minibatch()
+
+    def set_roidb(self, roidb, sampler_state=None):
+        """Set the roidb to be used by this layer during training.
+
+        sampler_state, as returned by get_sampler_state(), resumes minibatch
+        sampling from where a previous run stopped.
         """
-        if cfg.TRAIN.USE_PREFETCH:
-            return self._blob_queue.get()
-        else:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            return get_minibatch(minibatch_db, self._num_classes)
-
-    def set_roidb(self, roidb):
-        """Set the roidb to be used by this layer during training."""
         self._roidb = roidb
-        self._shuffle_roidb_inds()
-        if cfg.TRAIN.USE_PREFETCH:
-            self._blob_queue = Queue(10)
-            self._prefetch_process = BlobFetcher(self._blob_queue,
-                                                 self._roidb,
-                                                 self._num_classes)
-            self._prefetch_process.start()
-            # Terminate the child process when the parent exists
-            def cleanup():
-                print 'Terminating BlobFetcher'
-                self._prefetch_process.terminate()
-                self._prefetch_process.join()
-            import atexit
-            atexit.register(cleanup)
+        self._loader = MinibatchLoader(self._roidb, self._num_classes,
+                                       sampler_state)
+
+    def get_sampler_state(self):
+        """Return the sampler state after the last minibatch consumed by
+        forward.
+        """
+        return self._loader.get_sampler_state()
 
     def setup(self, bottom, top):
         """Setup the RoIDataLayer."""
@@ -147,8 +109,8 @@ class RoIDataLayer(caffe.Layer):
             top_ind = self._name_to_top_map[blob_name]
             # Reshape net's input blobs
             top[top_ind].reshape(*(blob.shape))
-            # Copy data into net's input blobs
-            top[top_ind].data[...] = blob.astype(np.float32, copy=False)
+            # Copy data into net's input blobs (already float32)
+            top[top_ind].data[...] = blob
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -157,40 +119,3 @@ class RoIDataLayer(caffe.Layer):
     def reshape(self, bottom, top):
         """Reshaping happens during the call to forward."""
         pass
-
-class BlobFetcher(Process):
-    """Experimental class for prefetching blobs in a separate process."""
-    def __init__(self, queue, roidb, num_classes):
-        super(BlobFetcher, self).__init__()
-        self._queue = queue
-        self._roidb = roidb
-        self._num_classes = num_classes
-        self._perm = None
-        self._cur = 0
-        self._shuffle_roidb_inds()
-        # fix the random seed for reproducibility
-        np.random.seed(cfg.RNG_SEED)
-
-    def _shuffle_roidb_inds(self):
-        """Randomly permute the training roidb."""
-        # TODO(rbg): remove duplicated code
-        self._perm = np.random.permutation(np.arange(len(self._roidb)))
-        self._cur = 0
-
-    def _get_next_minibatch_inds(self):
-        """Return the roidb indices for the next minibatch."""
-        # TODO(rbg): remove duplicated code
-        if self._cur + cfg.TRAIN.IMS_PER_BATCH >= len(self._roidb):
-            self._shuffle_roidb_inds()
-
-        db_inds = self._perm[self._cur:self._cur + cfg.TRAIN.IMS_PER_BATCH]
-        self._cur += cfg.TRAIN.IMS_PER_BATCH
-        return db_inds
-
-    def run(self):
-        print 'BlobFetcher started'
-        while True:
-            db_inds = self._get_next_minibatch_inds()
-            minibatch_db = [self._roidb[i] for i in db_inds]
-            blobs = get_minibatch(minibatch_db, self._num_classes)
-            self._queue.put(blobs)
@@ -0,0 +1,141 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Produce training minibatches for the RoI data layer.
+
+MinibatchLoader builds minibatches either in the calling process or in
+cfg.TRAIN.PREFETCH_WORKERS BlobFetcher processes (if cfg.TRAIN.USE_PREFETCH
+is True). It does not depend on Caffe, so it can also be driven directly,
+e.g. by tools/benchmark_data_layer.py.
+"""
+
+from fast_rcnn.config import cfg
+from roi_data_layer.minibatch import get_minibatch, MinibatchBuffers
+from roi_data_layer.sampler import MinibatchSampler
+import numpy as np
+import time
+import atexit
+from multiprocessing import Process, Queue
+
+class MinibatchLoader(object):
+    """Deliver the minibatches planned by a MinibatchSampler in order.
+
+    If profile is True, the time spent in each stage of building minibatches
+    is accumulated in stage_times (see get_minibatch); with prefetching the
+    workers report their stage times along with every minibatch and 'ipc'
+    records how long the caller was blocked receiving minibatches.
+    """
+
+    def __init__(self, roidb, num_classes, sampler_state=None, profile=False):
+        self._roidb = roidb
+        self._num_classes = num_classes
+        self._sampler = MinibatchSampler(self._roidb)
+        if sampler_state is not None:
+            self._sampler.set_state(sampler_state)
+        if self._sampler.num_batches == 0:
+            # Plan the first epoch here, before the prefetch processes copy
+            # the sampler, so the plan is described once
+            self._sampler.shuffle()
+        print self._sampler.summary()
+        self._position = self._sampler.position
+        self.stage_times = {} if profile else None
+        # Reused by every synchronously built minibatch; the data layer
+        # copies the blobs into the net before they are overwritten
+        self._buffers = MinibatchBuffers()
+        self._queues = []
+        self._fetchers = []
+        self._next_queue = 0
+        if cfg.TRAIN.USE_PREFETCH:
+            num_workers = max(cfg.TRAIN.PREFETCH_WORKERS, 1)
+            for worker_id in xrange(num_workers):
+                queue = Queue(10)
+                fetcher = BlobFetcher(queue, self._roidb, self._num_classes,
+                                      self._sampler, worker_id=worker_id,
+                                      num_workers=num_workers,
+                                      profile=profile)
+                fetcher.start()
+                self._queues.append(queue)
+                self._fetchers.append(fetcher)
+            # Terminate the child processes when the parent exits
+            atexit.register(self.close)
+
+    def next_minibatch(self):
+        """Return the blobs of the next minibatch."""
+        if len(self._queues) == 0:
+            db_inds, scale_inds = self._sampler.next_batch()
+            minibatch_db = [self._roidb[i] for i in db_inds]
+            blobs = get_minibatch(minibatch_db, self._num_classes, scale_inds,
+                                  self._buffers, self.stage_times)
+            self._position = self._sampler.position
+            return blobs
+
+        # Worker k builds minibatches k, k + num_workers, ... so reading the
+        # queues round-robin preserves the sampler's order
+        queue = self._queues[self._next_queue]
+        self._next_queue = (self._next_queue + 1) % len(self._queues)
+        start = time.time()
+        self._position, blobs, stage_times = queue.get()
+        if self.stage_times is not None:
+            _add_stage_times(self.stage_times, stage_times)
+            _add_stage_times(self.stage_times, {'ipc': time.time() - start})
+        return blobs
+
+    def get_sampler_state(self):
+        """Return the sampler state after the last minibatch returned by
+        next_minibatch (not the last one produced by a prefetch process).
+        """
+        if len(self._queues) > 0:
+            self._sampler.seek(*self._position)
+        return self._sampler.get_state()
+
+    def close(self):
+        """Terminate the prefetch processes, if any."""
+        if len(self._fetchers) > 0:
+            print 'Terminating BlobFetcher'
+        for fetcher in self._fetchers:
+            fetcher.terminate()
+            fetcher.join()
+        self._fetchers = []
+        self._queues = []
+
+def _add_stage_times(totals, stage_times):
+    for stage, seconds in stage_times.iteritems():
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+class BlobFetcher(Process):
+    """Experimental class for prefetching blobs in a separate process."""
+    def __init__(self, queue, roidb, num_classes, sampler, worker_id=0,
+                 num_workers=1, profile=False):
+        super(BlobFetcher, self).__init__()
+        self._queue = queue
+        self._roidb = roidb
+        self._num_classes = num_classes
+        self._sampler = sampler
+        self._worker_id = worker_id
+        self._num_workers = num_workers
+        self._profile = profile
+
+    def run(self):
+        print 'BlobFetcher {:d}/{:d} started'.format(self._worker_id,
+                                                     self._num_workers)
+        # fix the random seed for reproducibility (distinct per worker)
+        np.random.seed(cfg.RNG_SEED + self._worker_id)
+        # Skip the minibatches built by the workers before this one
+        for _ in xrange(self._worker_id):
+            self._sampler.next_batch()
+        while True:
+            db_inds, scale_inds = self._sampler.next_batch()
+            minibatch_db = [self._roidb[i] for i in db_inds]
+            stage_times = {} if self._profile else None
+            # Blobs are pickled asynchronously by the queue's feeder thread,
+            # so each minibatch gets freshly allocated arrays
+            blobs = get_minibatch(minibatch_db, self._num_classes, scale_inds,
+                                  stage_times=stage_times)
+            self._queue.put((self._sampler.position, blobs, stage_times))
+            # Skip the minibatches built by the other workers
+            for _ in xrange(self._num_workers - 1):
+                self._sampler.next_batch()
@@ -10,15 +10,54 @@
 import numpy as np
 import numpy.random as npr
 import cv2
+import time
 from fast_rcnn.config import cfg
-from utils.blob import prep_im_for_blob, im_list_to_blob
+from utils.blob import prep_im_for_blob
 
-def get_minibatch(roidb, num_classes):
-    """Given a roidb, construct a minibatch sampled from it."""
+class MinibatchBuffers(object):
+    """Float32 arrays that get_minibatch fills in place.
+
+    Each named buffer only grows, so after the first few iterations building
+    a minibatch allocates nothing. Arrays returned by get() are C-contiguous
+    views into the buffers and are overwritten by the next minibatch built
+    with the same MinibatchBuffers.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape):
+        """Return an uninitialized float32 array of the given shape."""
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size:
+            buf = np.empty(size, dtype=np.float32)
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+def get_minibatch(roidb, num_classes, scale_inds=None, buffers=None,
+                  stage_times=None):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    scale_inds optionally gives the index into cfg.TRAIN.SCALES to use for
+    each image (as planned by a MinibatchSampler); by default scales are
+    sampled at random.
+
+    All blobs are float32 and laid out exactly like the data layer's top
+    blobs. If buffers (a MinibatchBuffers) is given they are written into
+    its arrays, which are reused by the next call.
+
+    If stage_times (a dict) is given, the seconds spent decoding images
+    ('decode'), resizing them into the data blob ('resize'), sampling RoIs
+    ('sample') and expanding regression targets ('targets') are added to it.
+    """
+    if buffers is None:
+        buffers = MinibatchBuffers()
     num_images = len(roidb)
-    # Sample random scales to use for each image in this batch
-    random_scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
-                                    size=num_images)
+    if scale_inds is None:
+        # Sample random scales to use for each image in this batch
+        scale_inds = npr.randint(0, high=len(cfg.TRAIN.SCALES),
+                                 size=num_images)
     assert(cfg.TRAIN.BATCH_SIZE % num_images == 0), \
         'num_images ({}) must divide BATCH_SIZE ({})'. \
         format(num_images, cfg.TRAIN.BATCH_SIZE)
@@ -26,45 +65,62 @@ def get_minibatch(roidb, num_classes):
     fg_rois_per_image = np.round(cfg.TRAIN.FG_FRACTION * rois_per_image).astype(np.int)
 
     # Get the input image blob, formatted for caffe
-    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds)
+    im_blob, im_scales = _get_image_blob(roidb, scale_inds, buffers,
+                                         stage_times)
 
     blobs = {'data': im_blob}
 
+    start_time = time.time()
     if cfg.TRAIN.HAS_RPN:
         assert len(im_scales) == 1, "Single batch only"
         assert len(roidb) == 1, "Single batch only"
         # gt boxes: (x1, y1, x2, y2, cls)
         gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
-        gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
+        gt_boxes = buffers.get('gt_boxes', (len(gt_inds), 5))
         gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
         gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
         blobs['gt_boxes'] = gt_boxes
-        blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-            dtype=np.float32)
+        im_info = buffers.get('im_info', (1, 3))
+        im_info[0, :] = [im_blob.shape[2], im_blob.shape[3], im_scales[0]]
+        blobs['im_info'] = im_info
+        _add_time(stage_times, 'sample', start_time)
     else: # not using RPN
+        # Sample the RoIs of every image first so that the blobs can be
+        # allocated at their final size
+        samples = [_sample_rois(roidb[im_i], fg_rois_per_image,
+                                rois_per_image)
+                   for im_i in xrange(num_images)]
+        num_rois = sum(sample[0].size for sample in samples)
+        _add_time(stage_times, 'sample', start_time)
+        start_time = time.time()
+
         # Now, build the region of interest and label blobs
-        rois_blob = np.zeros((0, 5), dtype=np.float32)
-        labels_blob = np.zeros((0), dtype=np.float32)
-        bbox_targets_blob = np.zeros((0, 4 * num_classes), dtype=np.float32)
-        bbox_inside_blob = np.zeros(bbox_targets_blob.shape, dtype=np.float32)
+        rois_blob = buffers.get('rois', (num_rois, 5))
+        labels_blob = buffers.get('labels', (num_rois,))
+        if cfg.TRAIN.BBOX_REG:
+            bbox_targets_blob = buffers.get('bbox_targets',
+                                            (num_rois, 4 * num_classes))
+            bbox_inside_blob = buffers.get('bbox_inside_weights',
+                                           (num_rois, 4 * num_classes))
         # all_overlaps = []
+        start = 0
         for im_i in xrange(num_images):
-            labels, overlaps, im_rois, bbox_targets, bbox_inside_weights \
-                = _sample_rois(roidb[im_i], fg_rois_per_image, rois_per_image,
-                               num_classes)
+            labels, overlaps, im_rois, bbox_target_data = samples[im_i]
+            end = start + labels.size
 
             # Add to RoIs blob
-            rois = _project_im_rois(im_rois, im_scales[im_i])
-            batch_ind = im_i * np.ones((rois.shape[0], 1))
-            rois_blob_this_image = np.hstack((batch_ind, rois))
-            rois_blob = np.vstack((rois_blob, rois_blob_this_image))
+            rois_blob[start:end, 0] = im_i
+            rois_blob[start:end, 1:] = _project_im_rois(im_rois,
+                                                        im_scales[im_i])
 
             # Add to labels, bbox targets, and bbox loss blobs
-            labels_blob = np.hstack((labels_blob, labels))
-            bbox_targets_blob = np.vstack((bbox_targets_blob, bbox_targets))
-            bbox_inside_blob = np.vstack((bbox_inside_blob, bbox_inside_weights))
+            labels_blob[start:end] = labels
+            if cfg.TRAIN.BBOX_REG:
+                _get_bbox_regression_labels(bbox_target_data,
+                                            bbox_targets_blob[start:end],
+                                            bbox_inside_blob[start:end])
             # all_overlaps = np.hstack((all_overlaps, overlaps))
+            start = end
 
         # For debug visualizations
         # _vis_minibatch(im_blob, rois_blob, labels_blob, all_overlaps)
@@ -73,16 +129,28 @@ def get_minibatch(roidb, num_classes):
         blobs['labels'] = labels_blob
 
         if cfg.TRAIN.BBOX_REG:
+            bbox_outside_blob = buffers.get('bbox_outside_weights',
+                                            bbox_inside_blob.shape)
+            np.greater(bbox_inside_blob, 0, out=bbox_outside_blob)
             blobs['bbox_targets'] = bbox_targets_blob
             blobs['bbox_inside_weights'] = bbox_inside_blob
-            blobs['bbox_outside_weights'] = \
-                np.array(bbox_inside_blob > 0).astype(np.float32)
+            blobs['bbox_outside_weights'] = bbox_outside_blob
+        _add_time(stage_times, 'targets', start_time)
 
     return blobs
 
-def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
+def _add_time(stage_times, stage, start_time):
+    """Add the time elapsed since start_time to stage_times[stage]."""
+    if stage_times is not None:
+        stage_times[stage] = (stage_times.get(stage, 0.0) +
+                              time.time() - start_time)
+
+def _sample_rois(roidb, fg_rois_per_image, rois_per_image):
     """Generate a random sample of RoIs comprising foreground and background
     examples.
+
+    Returns the labels, overlaps, boxes and compact bounding-box regression
+    targets (see _get_bbox_regression_labels) of the sampled RoIs.
     """
     # label = class RoI has max overlap with
     labels = roidb['max_classes']
@@ -121,12 +189,13 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
     overlaps = overlaps[keep_inds]
     rois = rois[keep_inds]
 
-    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
-            roidb['bbox_targets'][keep_inds, :], num_classes)
+    bbox_target_data = None
+    if cfg.TRAIN.BBOX_REG:
+        bbox_target_data = roidb['bbox_targets'][keep_inds, :]
 
-    return labels, overlaps, rois, bbox_targets, bbox_inside_weights
+    return labels, overlaps, rois, bbox_target_data
 
-def _get_image_blob(roidb, scale_inds):
+def _get_image_blob(roidb, scale_inds, buffers, stage_times=None):
     """Builds an input blob from the images in the roidb at the specified
     scales.
     """
@@ -134,17 +203,30 @@ def _get_image_blob(roidb, scale_inds):
     processed_ims = []
     im_scales = []
     for i in xrange(num_images):
+        start_time = time.time()
         im = cv2.imread(roidb[i]['image'])
         if roidb[i]['flipped']:
             im = im[:, ::-1, :]
+        _add_time(stage_times, 'decode', start_time)
+        start_time = time.time()
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
         im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
                                         cfg.TRAIN.MAX_SIZE)
         im_scales.append(im_scale)
         processed_ims.append(im)
+        _add_time(stage_times, 'resize', start_time)
 
-    # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    # Create a blob to hold the input images: N x C x H x W, zero-padded to
+    # the largest image
+    start_time = time.time()
+    max_shape = np.array([im.shape for im in processed_ims]).max(axis=0)
+    blob = buffers.get('data', (num_images, 3, max_shape[0], max_shape[1]))
+    for i, im in enumerate(processed_ims):
+        h, w = im.shape[:2]
+        blob[i, :, :h, :w] = im.transpose((2, 0, 1))
+        blob[i, :, :h, w:] = 0
+        blob[i, :, h:, :] = 0
+    _add_time(stage_times, 'resize', start_time)
 
     return blob, im_scales
 
@@ -153,30 +235,31 @@ def _project_im_rois(im_rois, im_scale_factor):
     rois = im_rois * im_scale_factor
     return rois
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
+def _get_bbox_regression_labels(bbox_target_data, bbox_targets,
+                                bbox_inside_weights):
     """Bounding-box regression targets are stored in a compact form in the
     roidb.
 
     This function expands those targets into the 4-of-4*K representation used
     by the network (i.e. only one class has non-zero targets). The loss weights
-    are similarly expanded.
+    are similarly expanded. Both are written in place into the given arrays.
 
-    Returns:
-        bbox_target_data (ndarray): N x 4K blob of regression targets
+    Arguments:
+        bbox_target_data (ndarray): N x 5 compact targets (class, dx, dy,
+            dw, dh)
+        bbox_targets (ndarray): N x 4K blob of regression targets
         bbox_inside_weights (ndarray): N x 4K blob of loss weights
     """
+    bbox_targets[...] = 0
+    bbox_inside_weights[...] = 0
     clss = bbox_target_data[:, 0]
-    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
     inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = int(clss[ind])
-        start = 4 * cls
-        end = start + 4
-
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-        bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    return bbox_targets, bbox_inside_weights
+    if inds.size == 0:
+        return
+    cols = 4 * clss[inds].astype(np.int)[:, np.newaxis] + np.arange(4)
+    rows = inds[:, np.newaxis]
+    bbox_targets[rows, cols] = bbox_target_data[inds, 1:]
+    bbox_inside_weights[rows, cols] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
 
 def _vis_minibatch(im_blob, rois_blob, labels_blob, overlaps):
     """Visualize a mini-batch for debugging."""
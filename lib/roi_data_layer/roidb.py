@@ -8,50 +8,108 @@
 """Transform a roidb into a trainable roidb by adding a bunch of metadata."""
 
 import numpy as np
+import hashlib
 from fast_rcnn.config import cfg
 from fast_rcnn.bbox_transform import bbox_transform
+import datasets.cache as cache
 from utils.cython_bbox import bbox_overlaps
-import PIL
 
 def prepare_roidb(imdb):
     """Enrich the imdb's roidb by adding some derived quantities that
-    are useful for training. This function precomputes the maximum
-    overlap, taken over ground-truth boxes, between each ROI and
-    each ground-truth box. The class with maximum overlap is also
-    recorded.
+    are useful for training. The maximum overlap of each ROI with a
+    ground-truth box and the class of that box (max_overlaps and
+    max_classes) are stored by the imdb when building the roidb; this
+    function checks them and records image metadata.
+
+    The (unnormalized) bounding-box regression targets, if
+    cfg.TRAIN.BBOX_REG, are computed once per distinct entry. For a
+    ground-truth roidb they are also cached per entry under a digest of the
+    entry's boxes and overlaps, so they are only recomputed for entries that
+    changed since the last call. Roidbs with proposals are not cached: their
+    proposals change between runs (e.g. at every alt-opt stage) and the
+    targets of all proposals would take gigabytes to store.
     """
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-             for i in xrange(imdb.num_images)]
+    sizes = imdb.image_sizes()
     roidb = imdb.roidb
-    for i in xrange(len(imdb.image_index)):
+    num_images = len(imdb.image_index)
+    gt_only = all((roidb[i]['gt_classes'] > 0).all()
+                  for i in xrange(num_images))
+    cached = None
+    if gt_only:
+        key = cache.fingerprint(cfg.TRAIN.BBOX_REG, cfg.TRAIN.BBOX_THRESH)
+        cache_file = cache.cache_file(imdb.cache_path,
+                                      imdb.name + '_prepared_gt_roidb', key)
+        cached = cache.load(cache_file, key)
+    if cached is None:
+        cached = {}
+    derived = {}
+    num_computed = 0
+    for i in xrange(num_images):
         roidb[i]['image'] = imdb.image_path_at(i)
         roidb[i]['width'] = sizes[i][0]
         roidb[i]['height'] = sizes[i][1]
-        # need gt_overlaps as a dense array for argmax
-        gt_overlaps = roidb[i]['gt_overlaps'].toarray()
-        # max overlap with gt over classes (columns)
-        max_overlaps = gt_overlaps.max(axis=1)
-        # gt class that had the max overlap
-        max_classes = gt_overlaps.argmax(axis=1)
-        roidb[i]['max_classes'] = max_classes
-        roidb[i]['max_overlaps'] = max_overlaps
-        # sanity checks
-        # max overlap of 0 => class should be zero (background)
-        zero_inds = np.where(max_overlaps == 0)[0]
-        assert all(max_classes[zero_inds] == 0)
-        # max overlap > 0 => class should not be zero (must be a fg class)
-        nonzero_inds = np.where(max_overlaps > 0)[0]
-        assert all(max_classes[nonzero_inds] != 0)
+        roidb[i]['num_classes'] = imdb.num_classes
+        digest = _entry_digest(roidb[i])
+        if digest in derived:
+            # Identical entry; do not share arrays that are modified in place
+            fields = dict((name, value.copy())
+                          for name, value in derived[digest].iteritems())
+        elif digest in cached:
+            fields = cached[digest]
+        else:
+            fields = _derive_fields(roidb[i])
+            num_computed += 1
+        derived.setdefault(digest, fields)
+        for name, value in fields.iteritems():
+            roidb[i][name] = value
+        # Identifies the entry's training inputs, e.g. to cache statistics
+        roidb[i]['digest'] = digest
+
+    if gt_only and (num_computed > 0 or len(derived) != len(cached)):
+        cache.save(derived, cache_file, key)
+        print 'Computed derived fields of {:d} / {:d} roidb entries'.format(
+            num_computed, len(roidb))
+
+def _entry_digest(entry):
+    """Return a digest of the fields that the derived fields depend on."""
+    sha1 = hashlib.sha1(str(bool(entry['flipped'])))
+    for arr in (entry['boxes'], entry['max_overlaps'], entry['max_classes']):
+        arr = np.ascontiguousarray(arr)
+        sha1.update('{}{}'.format(arr.dtype.str, arr.shape))
+        sha1.update(arr.tobytes())
+    return sha1.hexdigest()
+
+def _derive_fields(entry):
+    """Compute the derived fields of a roidb entry."""
+    max_overlaps = entry['max_overlaps']
+    max_classes = entry['max_classes']
+    # sanity checks
+    # max overlap of 0 => class should be zero (background)
+    zero_inds = np.where(max_overlaps == 0)[0]
+    assert all(max_classes[zero_inds] == 0)
+    # max overlap > 0 => class should not be zero (must be a fg class)
+    nonzero_inds = np.where(max_overlaps > 0)[0]
+    assert all(max_classes[nonzero_inds] != 0)
+    fields = {}
+    if cfg.TRAIN.BBOX_REG:
+        fields['bbox_targets'] = \
+                _compute_targets(entry['boxes'], max_overlaps, max_classes)
+    return fields
 
 def add_bbox_regression_targets(roidb):
-    """Add information needed to train bounding-box regressors."""
+    """Add information needed to train bounding-box regressors.
+
+    Targets already computed by prepare_roidb are reused. The targets are
+    normalized in place, so call this only once per roidb.
+    """
     assert len(roidb) > 0
-    assert 'max_classes' in roidb[0], 'Did you call prepare_roidb first?'
+    assert 'num_classes' in roidb[0], 'Did you call prepare_roidb first?'
 
     num_images = len(roidb)
-    # Infer number of classes from the number of columns in gt_overlaps
-    num_classes = roidb[0]['gt_overlaps'].shape[1]
+    num_classes = roidb[0]['num_classes']
     for im_i in xrange(num_images):
+        if 'bbox_targets' in roidb[im_i]:
+            continue
         rois = roidb[im_i]['boxes']
         max_overlaps = roidb[im_i]['max_overlaps']
         max_classes = roidb[im_i]['max_classes']
@@ -65,23 +123,7 @@ def add_bbox_regression_targets(roidb):
         stds = np.tile(
                 np.array(cfg.TRAIN.BBOX_NORMALIZE_STDS), (num_classes, 1))
     else:
-        # Compute values needed for means and stds
-        # var(x) = E(x^2) - E(x)^2
-        class_counts = np.zeros((num_classes, 1)) + cfg.EPS
-        sums = np.zeros((num_classes, 4))
-        squared_sums = np.zeros((num_classes, 4))
-        for im_i in xrange(num_images):
-            targets = roidb[im_i]['bbox_targets']
-            for cls in xrange(1, num_classes):
-                cls_inds = np.where(targets[:, 0] == cls)[0]
-                if cls_inds.size > 0:
-                    class_counts[cls] += cls_inds.size
-                    sums[cls, :] += targets[cls_inds, 1:].sum(axis=0)
-                    squared_sums[cls, :] += \
-                            (targets[cls_inds, 1:] ** 2).sum(axis=0)
-
-        means = sums / class_counts
-        stds = np.sqrt(squared_sums / class_counts - means ** 2)
+        means, stds = _get_target_stats(roidb, num_classes)
 
     print 'bbox target means:'
     print means
@@ -95,10 +137,11 @@ def add_bbox_regression_targets(roidb):
         print "Normalizing targets"
         for im_i in xrange(num_images):
             targets = roidb[im_i]['bbox_targets']
-            for cls in xrange(1, num_classes):
-                cls_inds = np.where(targets[:, 0] == cls)[0]
-                roidb[im_i]['bbox_targets'][cls_inds, 1:] -= means[cls, :]
-                roidb[im_i]['bbox_targets'][cls_inds, 1:] /= stds[cls, :]
+            # Background RoIs (class 0) have no targets
+            fg_inds = np.where(targets[:, 0] > 0)[0]
+            classes = targets[fg_inds, 0].astype(np.int)
+            targets[fg_inds, 1:] -= means[classes]
+            targets[fg_inds, 1:] /= stds[classes]
     else:
         print "NOT normalizing targets"
 
@@ -106,6 +149,58 @@ def add_bbox_regression_targets(roidb):
     # (the predicts will need to be unnormalized and uncentered)
     return means.ravel(), stds.ravel()
 
+def _get_target_stats(roidb, num_classes):
+    """Return the per-class means and stds of the regression targets.
+
+    If prepare_roidb recorded the entries' digests, the statistics are
+    cached under a fingerprint of them, so later stages training on the
+    same roidb reuse them.
+    """
+    key = None
+    if all('digest' in entry for entry in roidb):
+        key = cache.fingerprint([entry['digest'] for entry in roidb],
+                                num_classes, cfg.TRAIN.BBOX_THRESH)
+        # The roidb may combine several imdbs, so the stats are cached with
+        # the imdbs' caches rather than under one imdb's name
+        cache_file = cache.cache_file(cache.cache_dir(), 'bbox_target_stats',
+                                      key)
+        stats = cache.load(cache_file, key)
+        if stats is not None:
+            print 'bbox target stats loaded from {}'.format(cache_file)
+            return stats
+
+    # Compute values needed for means and stds
+    # var(x) = E(x^2) - E(x)^2
+    class_counts = np.zeros(num_classes)
+    sums = np.zeros((num_classes, 4))
+    squared_sums = np.zeros((num_classes, 4))
+    # Concatenate the targets of a chunk of images at a time to bound memory
+    chunk_size = 1000
+    for start in xrange(0, len(roidb), chunk_size):
+        end = min(start + chunk_size, len(roidb))
+        targets = np.vstack([roidb[i]['bbox_targets']
+                             for i in xrange(start, end)])
+        classes = targets[:, 0].astype(np.int)
+        class_counts += np.bincount(classes, minlength=num_classes)
+        for j in xrange(4):
+            sums[:, j] += np.bincount(classes, weights=targets[:, j + 1],
+                                      minlength=num_classes)
+            squared_sums[:, j] += np.bincount(
+                classes, weights=targets[:, j + 1] ** 2,
+                minlength=num_classes)
+    # Background RoIs (class 0) have no targets
+    class_counts[0] = 0
+    sums[0, :] = 0
+    squared_sums[0, :] = 0
+
+    class_counts = class_counts[:, np.newaxis] + cfg.EPS
+    means = sums / class_counts
+    stds = np.sqrt(squared_sums / class_counts - means ** 2)
+
+    if key is not None:
+        cache.save((means, stds), cache_file, key)
+    return means, stds
+
 def _compute_targets(rois, overlaps, labels):
     """Compute bounding-box regression targets for an image."""
     # Indices of ground-truth ROIs
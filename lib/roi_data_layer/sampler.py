@@ -0,0 +1,265 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Decide which roidb entries (and at which scales) go into each minibatch.
+
+MinibatchSampler is shared by RoIDataLayer and BlobFetcher so that the
+synchronous and the prefetch paths draw minibatches in exactly the same way.
+"""
+
+import numpy as np
+from fast_rcnn.config import cfg
+
+def blob_shapes(widths, heights, target_size, max_size):
+    """Return the (height, width) each image will have after it has been
+    resized by prep_im_for_blob to target_size (capped at max_size).
+    """
+    widths = np.asarray(widths, dtype=np.float64)
+    heights = np.asarray(heights, dtype=np.float64)
+    im_size_min = np.minimum(widths, heights)
+    im_size_max = np.maximum(widths, heights)
+    im_scales = float(target_size) / im_size_min
+    # Prevent the biggest axis from being more than max_size
+    capped = np.round(im_scales * im_size_max) > max_size
+    im_scales[capped] = float(max_size) / im_size_max[capped]
+    # cv2.resize rounds the destination size to the nearest pixel
+    shapes = np.empty((widths.size, 2), dtype=np.int32)
+    shapes[:, 0] = np.round(heights * im_scales)
+    shapes[:, 1] = np.round(widths * im_scales)
+    return shapes
+
+class MinibatchSampler(object):
+    """Plan the minibatches of a training epoch.
+
+    Grouping is controlled by cfg.TRAIN.ASPECT_GROUPING and
+    cfg.TRAIN.ASPECT_GROUPING_MODE:
+        'orientation': pair horizontal with horizontal and vertical with
+            vertical images (the original Fast R-CNN behaviour)
+        'shape': only batch together images whose resized blobs have exactly
+            the same shape, so minibatches need no zero-padding
+        'bins': batch together images that fall in the same of
+            cfg.TRAIN.ASPECT_BINS log-aspect-ratio bins
+
+    Epoch plans are a deterministic function of (seed, epoch). Every process
+    of a distributed job plans the same epoch and then keeps only its own
+    shard: rank r of world_size takes planned minibatches r, r + world_size,
+    r + 2 * world_size, ... so shards are disjoint and all ranks run the same
+    number of minibatches per epoch. get_state() / set_state() serialize the
+    plan and the position within it so a restarted job resumes exactly.
+    """
+
+    def __init__(self, roidb, ims_per_batch=None, rank=None, world_size=None,
+                 seed=None):
+        if ims_per_batch is None:
+            ims_per_batch = cfg.TRAIN.IMS_PER_BATCH
+        if rank is None:
+            rank = cfg.TRAIN.RANK
+        if world_size is None:
+            world_size = cfg.TRAIN.WORLD_SIZE
+        if seed is None:
+            seed = cfg.RNG_SEED
+        assert 0 <= rank < world_size, \
+            'Invalid rank {} for world size {}'.format(rank, world_size)
+        self._ims_per_batch = ims_per_batch
+        self._rank = rank
+        self._world_size = world_size
+        self._seed = seed
+        self._epoch = -1
+        self._num_images = len(roidb)
+        self._num_scales = len(cfg.TRAIN.SCALES)
+        # Settings the epoch plans depend on, checked when resuming
+        self._scales = tuple(cfg.TRAIN.SCALES)
+        self._aspect_grouping = cfg.TRAIN.ASPECT_GROUPING
+        self._aspect_grouping_mode = cfg.TRAIN.ASPECT_GROUPING_MODE
+        self._aspect_bins = cfg.TRAIN.ASPECT_BINS
+        widths = np.array([r['width'] for r in roidb])
+        heights = np.array([r['height'] for r in roidb])
+        # Resized blob shape of every image at every training scale:
+        # num_scales x num_images x (height, width)
+        self._shapes = np.array([blob_shapes(widths, heights, target_size,
+                                             cfg.TRAIN.MAX_SIZE)
+                                 for target_size in cfg.TRAIN.SCALES])
+        self._horz = widths >= heights
+        self._aspect_bin_inds = self._get_aspect_bins(widths, heights)
+        self._perm = None
+        self._scale_inds = None
+        self._cur = 0
+
+    def _get_aspect_bins(self, widths, heights):
+        """Quantize log(width / height) into cfg.TRAIN.ASPECT_BINS bins."""
+        num_bins = max(cfg.TRAIN.ASPECT_BINS, 1)
+        log_ratios = np.log(widths.astype(np.float64) / heights)
+        lo = log_ratios.min()
+        hi = log_ratios.max()
+        if hi - lo < cfg.EPS:
+            return np.zeros(widths.size, dtype=np.int32)
+        bins = np.floor((log_ratios - lo) / (hi - lo) * num_bins)
+        return np.minimum(bins, num_bins - 1).astype(np.int32)
+
+    @property
+    def num_batches(self):
+        """Number of minibatches in the current epoch plan."""
+        return 0 if self._perm is None else self._perm.shape[0]
+
+    def _group_keys(self, scale_inds):
+        """Return one integer grouping key per image (or None)."""
+        mode = cfg.TRAIN.ASPECT_GROUPING_MODE
+        if not cfg.TRAIN.ASPECT_GROUPING:
+            return None
+        if mode == 'orientation':
+            return self._horz.astype(np.int64)
+        if mode == 'bins':
+            return (scale_inds.astype(np.int64) * max(cfg.TRAIN.ASPECT_BINS, 1)
+                    + self._aspect_bin_inds)
+        if mode == 'shape':
+            shapes = self._shapes[scale_inds, np.arange(self._num_images)]
+            max_size = cfg.TRAIN.MAX_SIZE + 1
+            return ((scale_inds.astype(np.int64) * max_size + shapes[:, 0])
+                    * max_size + shapes[:, 1])
+        raise ValueError('Unknown ASPECT_GROUPING_MODE: {}'.format(mode))
+
+    def _plan_batches(self, keys, rng):
+        """Group image indices with equal keys into minibatches."""
+        n = self._ims_per_batch
+        if keys is None:
+            inds = rng.permutation(np.arange(self._num_images))
+            num_batches = self._num_images // n
+            return np.reshape(inds[:num_batches * n], (-1, n))
+
+        batches = []
+        leftovers = []
+        for key in np.unique(keys):
+            inds = rng.permutation(np.where(keys == key)[0])
+            num_full = inds.size // n
+            if num_full > 0:
+                batches.append(np.reshape(inds[:num_full * n], (-1, n)))
+            leftovers.append(inds[num_full * n:])
+        # Images that did not fill a batch within their group are batched
+        # with their nearest neighbours in aspect ratio to limit padding
+        leftovers = np.hstack(leftovers).astype(np.int64)
+        if leftovers.size >= n:
+            shapes = self._shapes[0, leftovers]
+            order = np.argsort(shapes[:, 1].astype(np.float64) / shapes[:, 0],
+                               kind='mergesort')
+            leftovers = leftovers[order]
+            num_full = leftovers.size // n
+            batches.append(np.reshape(leftovers[:num_full * n], (-1, n)))
+        if len(batches) == 0:
+            return np.zeros((0, n), dtype=np.int64)
+        batches = np.vstack(batches)
+        row_perm = rng.permutation(np.arange(batches.shape[0]))
+        return batches[row_perm, :]
+
+    @property
+    def epoch(self):
+        """Index of the epoch currently being drawn from."""
+        return self._epoch
+
+    def _plan_epoch(self, epoch):
+        """Return this rank's (db_inds, scale_inds) plan for an epoch."""
+        rng = np.random.RandomState([self._seed, epoch])
+        scale_inds = rng.randint(0, high=self._num_scales,
+                                 size=self._num_images)
+        keys = self._group_keys(scale_inds)
+        perm = self._plan_batches(keys, rng)
+        # Drop the last few minibatches so every rank gets the same number
+        num_per_rank = perm.shape[0] // self._world_size
+        perm = perm[self._rank:num_per_rank * self._world_size:
+                    self._world_size]
+        # Images in a 'shape' or 'bins' batch share the scale of their group;
+        # otherwise every image keeps its own randomly drawn scale
+        return perm, scale_inds[perm]
+
+    def shuffle(self, epoch=None):
+        """Plan the next (or the given) epoch of minibatches."""
+        self._epoch = self._epoch + 1 if epoch is None else epoch
+        self._perm, self._scale_inds = self._plan_epoch(self._epoch)
+        self._cur = 0
+
+    def summary(self):
+        """Return a one-line description of the current epoch plan."""
+        waste, num_shapes = self.padding_waste()
+        return ('MinibatchSampler: epoch {:d}, rank {:d}/{:d}: {:d} '
+                'minibatches, {:.1f}% padding, {:d} blob shapes').format(
+                    self._epoch, self._rank, self._world_size,
+                    self.num_batches, 100 * waste, num_shapes)
+
+    def next_batch(self):
+        """Return (db_inds, scale_inds) for the next minibatch."""
+        if self._perm is None or self._cur >= self.num_batches:
+            self.shuffle()
+        assert self.num_batches > 0, \
+            'Not enough images ({}) for a minibatch of {}'.format(
+                self._num_images, self._ims_per_batch)
+        db_inds = self._perm[self._cur]
+        scale_inds = self._scale_inds[self._cur]
+        self._cur += 1
+        return db_inds, scale_inds
+
+    @property
+    def position(self):
+        """(epoch, index of the next minibatch within the epoch)."""
+        return self._epoch, self._cur
+
+    def seek(self, epoch, cur):
+        """Move to the given position, re-planning the epoch if needed."""
+        if epoch != self._epoch:
+            self.shuffle(epoch)
+        self._cur = cur
+
+    def get_state(self):
+        """Return a picklable description of the current position."""
+        return {'seed': self._seed,
+                'rank': self._rank,
+                'world_size': self._world_size,
+                'ims_per_batch': self._ims_per_batch,
+                'num_images': self._num_images,
+                'scales': self._scales,
+                'aspect_grouping': self._aspect_grouping,
+                'aspect_grouping_mode': self._aspect_grouping_mode,
+                'aspect_bins': self._aspect_bins,
+                'epoch': self._epoch,
+                'cur': self._cur,
+                'perm': self._perm,
+                'scale_inds': self._scale_inds}
+
+    def set_state(self, state):
+        """Resume from a state returned by get_state().
+
+        The seed of the state is adopted, so a run started with a random
+        seed resumes the same sequence of epochs.
+        """
+        for key in ('rank', 'world_size', 'ims_per_batch', 'num_images',
+                    'scales', 'aspect_grouping', 'aspect_grouping_mode',
+                    'aspect_bins'):
+            value = state.get(key)
+            if isinstance(value, list):
+                value = tuple(value)
+            assert value == getattr(self, '_' + key), \
+                'Sampler state mismatch for {}: {} vs. {}'.format(
+                    key, state.get(key), getattr(self, '_' + key))
+        self._seed = state['seed']
+        self._epoch = state['epoch']
+        self._perm = state['perm']
+        self._scale_inds = state['scale_inds']
+        self._cur = state['cur']
+
+    def padding_waste(self):
+        """Return the fraction of data blob pixels that are zero-padding and
+        the number of distinct blob shapes in the current epoch plan.
+        """
+        if self.num_batches == 0:
+            return 0.0, 0
+        shapes = self._shapes[self._scale_inds, self._perm]
+        blob_h = shapes[:, :, 0].max(axis=1)
+        blob_w = shapes[:, :, 1].max(axis=1)
+        blob_area = (blob_h * blob_w).astype(np.float64) * self._ims_per_batch
+        used_area = (shapes[:, :, 0] * shapes[:, :, 1]).sum(axis=1)
+        waste = 1.0 - used_area.sum() / blob_area.sum()
+        num_shapes = np.unique(blob_h * (cfg.TRAIN.MAX_SIZE + 1) +
+                               blob_w).size
+        return waste, num_shapes
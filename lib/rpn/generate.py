@@ -6,6 +6,8 @@
 # --------------------------------------------------------
 
 from fast_rcnn.config import cfg
+from datasets.rpn_proposals import RpnProposalWriter
+from datasets.imdb import RecallAccumulator
 from utils.blob import im_list_to_blob
 from utils.timer import Timer
 import numpy as np
@@ -96,22 +98,56 @@ def im_proposals(net, im):
     scores = blobs_out['scores'].copy()
     return boxes, scores
 
-def imdb_proposals(net, imdb):
-    """Generate RPN proposals on all images in an imdb."""
+def imdb_proposals(net, imdb, rpn_file=None):
+    """Generate RPN proposals on all images in an imdb.
+
+    If rpn_file is given, the proposals (and their scores) of each image are
+    appended to an RPN proposal file (see datasets.rpn_proposals) as soon as
+    they are computed instead of being returned.
+
+    If cfg.TEST.RPN_EVAL_RECALL is set, the recall of the proposals against
+    the gt roidb is also measured as they are generated and logged every
+    cfg.TEST.RPN_RECALL_PERIOD images.
+    """
 
     _t = Timer()
-    imdb_boxes = [[] for _ in xrange(imdb.num_images)]
-    for i in xrange(imdb.num_images):
-        im = cv2.imread(imdb.image_path_at(i))
-        _t.tic()
-        imdb_boxes[i], scores = im_proposals(net, im)
-        _t.toc()
-        print 'im_proposals: {:d}/{:d} {:.3f}s' \
-              .format(i + 1, imdb.num_images, _t.average_time)
-        if 0:
-            dets = np.hstack((imdb_boxes[i], scores))
-            # from IPython import embed; embed()
-            _vis_proposals(im, dets[:3, :], thresh=0.9)
-            plt.show()
+    if cfg.TEST.RPN_EVAL_RECALL:
+        gt_roidb = imdb.gt_roidb()
+        recall = RecallAccumulator(cfg.TEST.RPN_RECALL_LIMITS)
+    else:
+        recall = None
+    imdb_boxes = [[] for _ in xrange(imdb.num_images)] \
+                 if rpn_file is None else None
+    writer = RpnProposalWriter(rpn_file) if rpn_file is not None else None
+    try:
+        for i in xrange(imdb.num_images):
+            im = cv2.imread(imdb.image_path_at(i))
+            _t.tic()
+            boxes, scores = im_proposals(net, im)
+            _t.toc()
+            if writer is not None:
+                writer.add(boxes, scores)
+            else:
+                imdb_boxes[i] = boxes
+            print 'im_proposals: {:d}/{:d} {:.3f}s' \
+                  .format(i + 1, imdb.num_images, _t.average_time)
+            if recall is not None:
+                order = np.argsort(-scores.ravel(), kind='mergesort')
+                recall.add(gt_roidb[i], boxes[order, :])
+                if (i + 1) % cfg.TEST.RPN_RECALL_PERIOD == 0:
+                    print 'Proposal recall: {}'.format(recall.summary())
+            if 0:
+                dets = np.hstack((boxes, scores))
+                # from IPython import embed; embed()
+                _vis_proposals(im, dets[:3, :], thresh=0.9)
+                plt.show()
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.close()
+    if recall is not None:
+        print 'Final proposal recall: {}'.format(recall.summary())
 
     return imdb_boxes
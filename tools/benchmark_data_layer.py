@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Measure how fast the training data pipeline produces minibatches.
+
+Builds a synthetic VOC-like dataset (JPEGs plus a roidb with ground-truth
+and proposal boxes) and drives roi_data_layer's MinibatchLoader, which is
+what RoIDataLayer uses, in its synchronous, prefetch and multi-worker modes
+for both cfg.TRAIN.HAS_RPN settings. Does not need Caffe or a GPU.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.synthetic import synthetic
+import roi_data_layer.roidb as rdl_roidb
+from roi_data_layer.loader import MinibatchLoader
+import argparse
+import pprint
+import time
+import sys
+import numpy as np
+
+STAGES = ('decode', 'resize', 'sample', 'targets', 'ipc')
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RoI data layer on a synthetic dataset')
+    parser.add_argument('--data_dir', dest='data_dir',
+                        help='where to write the synthetic images',
+                        default=None, type=str)
+    parser.add_argument('--num_images', dest='num_images',
+                        help='number of synthetic images [200]',
+                        default=200, type=int)
+    parser.add_argument('--num_classes', dest='num_classes',
+                        help='number of classes incl. background [21]',
+                        default=21, type=int)
+    parser.add_argument('--num_proposals', dest='num_proposals',
+                        help='proposals per image [2000]',
+                        default=2000, type=int)
+    parser.add_argument('--iters', dest='iters',
+                        help='minibatches to time per mode [200]',
+                        default=200, type=int)
+    parser.add_argument('--warmup', dest='warmup',
+                        help='minibatches to skip before timing [10]',
+                        default=10, type=int)
+    parser.add_argument('--workers', dest='workers',
+                        help='prefetch processes in multi-worker mode [4]',
+                        default=4, type=int)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def benchmark(roidb, num_classes, iters, warmup):
+    """Time iters minibatches from a MinibatchLoader configured by cfg."""
+    loader = MinibatchLoader(roidb, num_classes, profile=True)
+    try:
+        for _ in xrange(warmup):
+            loader.next_minibatch()
+        loader.stage_times.clear()
+        latencies = np.zeros(iters)
+        start = time.time()
+        for i in xrange(iters):
+            tic = time.time()
+            loader.next_minibatch()
+            latencies[i] = time.time() - tic
+        total = time.time() - start
+    finally:
+        loader.close()
+    stage_times = dict((stage, loader.stage_times.get(stage, 0.0) / iters)
+                       for stage in STAGES)
+    return {'ims_per_sec': iters * cfg.TRAIN.IMS_PER_BATCH / total,
+            'p50': np.percentile(latencies, 50),
+            'p99': np.percentile(latencies, 99),
+            'stage_times': stage_times}
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    np.random.seed(cfg.RNG_SEED)
+    imdb = synthetic(args.num_images, num_classes=args.num_classes,
+                     num_proposals=args.num_proposals,
+                     data_dir=args.data_dir)
+    # Same steps as fast_rcnn.train.get_training_roidb, which imports Caffe
+    if cfg.TRAIN.USE_FLIPPED:
+        print 'Appending horizontally-flipped training examples...'
+        imdb.append_flipped_images()
+        print 'done'
+    print 'Preparing training data...'
+    rdl_roidb.prepare_roidb(imdb)
+    print 'done'
+    roidb = imdb.roidb
+    print 'Computing bounding-box regression targets...'
+    rdl_roidb.add_bbox_regression_targets(roidb)
+    print 'done'
+
+    modes = [('sync', False, 1),
+             ('prefetch', True, 1),
+             ('workers={:d}'.format(args.workers), True, args.workers)]
+    results = []
+    for has_rpn in (False, True):
+        cfg.TRAIN.HAS_RPN = has_rpn
+        cfg.TRAIN.IMS_PER_BATCH = 1 if has_rpn else 2
+        for name, use_prefetch, num_workers in modes:
+            cfg.TRAIN.USE_PREFETCH = use_prefetch
+            cfg.TRAIN.PREFETCH_WORKERS = num_workers
+            print 'Benchmarking HAS_RPN={} {:s}'.format(has_rpn, name)
+            res = benchmark(roidb, imdb.num_classes, args.iters, args.warmup)
+            results.append((has_rpn, name, res))
+
+    print ''
+    header = '{:>7s} {:>10s} {:>8s} {:>8s} {:>8s}'.format(
+        'HAS_RPN', 'mode', 'ims/s', 'p50 ms', 'p99 ms')
+    header += ''.join(' {:>8s}'.format(stage + ' ms') for stage in STAGES)
+    print header
+    for has_rpn, name, res in results:
+        line = '{:>7s} {:>10s} {:8.1f} {:8.1f} {:8.1f}'.format(
+            str(has_rpn), name, res['ims_per_sec'],
+            1000 * res['p50'], 1000 * res['p99'])
+        line += ''.join(' {:8.2f}'.format(1000 * res['stage_times'][stage])
+                        for stage in STAGES)
+        print line
+    print ('Stage times are per minibatch; with prefetching they are spent in '
+           'the workers, and ipc is the time blocked receiving minibatches.')
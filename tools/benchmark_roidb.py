@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Measure how fast a proposal roidb is built.
+
+Times imdb.create_roidb_from_box_list and imdb.merge_roidbs on a synthetic
+dataset (by default 20k images with 2k proposals each, like the alt-opt
+Fast R-CNN stages with RPN proposals) with one process and with a process
+pool, and the previous construction through a dense overlap matrix and a
+scipy.sparse matrix per image for comparison. Each mode runs in a new
+process, which reports its peak RSS and the bytes held by the merged
+roidb's arrays. Does not need Caffe or a GPU.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.synthetic import synthetic
+from datasets.imdb import imdb
+from utils.cython_bbox import bbox_overlaps
+import argparse
+from multiprocessing import Process, Queue
+import pprint
+import resource
+import time
+import sys
+import numpy as np
+import scipy.sparse
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark building a proposal roidb')
+    parser.add_argument('--num_images', dest='num_images',
+                        help='number of synthetic images [20000]',
+                        default=20000, type=int)
+    parser.add_argument('--num_classes', dest='num_classes',
+                        help='number of classes incl. background [21]',
+                        default=21, type=int)
+    parser.add_argument('--num_proposals', dest='num_proposals',
+                        help='proposals per image [2000]',
+                        default=2000, type=int)
+    parser.add_argument('--processes', dest='processes',
+                        help='pool size of the parallel run '
+                             '[cfg.DATA_PARSE_PROCESSES]',
+                        default=None, type=int)
+    parser.add_argument('--skip_dense', dest='skip_dense',
+                        help='skip the dense + scipy.sparse construction',
+                        action='store_true')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def dense_roidb_from_box_list(box_list, gt_roidb, num_classes):
+    """Build a proposal roidb the way create_roidb_from_box_list used to: a
+    dense (boxes x classes) overlap matrix per image, stored as CSR.
+    """
+    roidb = []
+    for i in xrange(len(box_list)):
+        boxes = box_list[i]
+        num_boxes = boxes.shape[0]
+        overlaps = np.zeros((num_boxes, num_classes), dtype=np.float32)
+        gt_boxes = gt_roidb[i]['boxes']
+        gt_classes = gt_roidb[i]['gt_classes']
+        if gt_boxes.size > 0:
+            gt_overlaps = bbox_overlaps(boxes.astype(np.float),
+                                        gt_boxes.astype(np.float))
+            argmaxes = gt_overlaps.argmax(axis=1)
+            maxes = gt_overlaps.max(axis=1)
+            I = np.where(maxes > 0)[0]
+            overlaps[I, gt_classes[argmaxes[I]]] = maxes[I]
+        roidb.append({
+            'boxes' : boxes,
+            'gt_classes' : np.zeros((num_boxes,), dtype=np.int32),
+            'gt_overlaps' : scipy.sparse.csr_matrix(overlaps),
+            'flipped' : False,
+            'seg_areas' : np.zeros((num_boxes,), dtype=np.float32),
+        })
+    return roidb
+
+def dense_merge_roidbs(a, b):
+    """Merge roidbs with CSR gt_overlaps the way merge_roidbs used to."""
+    for i in xrange(len(a)):
+        a[i]['boxes'] = np.vstack((a[i]['boxes'], b[i]['boxes']))
+        a[i]['gt_classes'] = np.hstack((a[i]['gt_classes'],
+                                        b[i]['gt_classes']))
+        a[i]['gt_overlaps'] = scipy.sparse.vstack([a[i]['gt_overlaps'],
+                                                   b[i]['gt_overlaps']])
+        a[i]['seg_areas'] = np.hstack((a[i]['seg_areas'],
+                                       b[i]['seg_areas']))
+    return a
+
+def dense_gt_roidb(gt_roidb, num_classes):
+    """Return a copy of gt_roidb with CSR gt_overlaps, as gt roidbs used to
+    have.
+    """
+    roidb = []
+    for entry in gt_roidb:
+        num_objs = entry['boxes'].shape[0]
+        overlaps = np.zeros((num_objs, num_classes), dtype=np.float32)
+        overlaps[np.arange(num_objs), entry['gt_classes']] = 1.0
+        roidb.append({
+            'boxes' : entry['boxes'].copy(),
+            'gt_classes' : entry['gt_classes'].copy(),
+            'gt_overlaps' : scipy.sparse.csr_matrix(overlaps),
+            'flipped' : False,
+            'seg_areas' : entry['seg_areas'].copy(),
+        })
+    return roidb
+
+def copy_roidb(roidb):
+    return [dict((k, v.copy() if isinstance(v, np.ndarray) else v)
+                 for k, v in entry.iteritems()) for entry in roidb]
+
+def roidb_bytes(roidb):
+    """Return the bytes held by the arrays (and CSR matrices) of a roidb."""
+    total = 0
+    for entry in roidb:
+        for value in entry.itervalues():
+            if isinstance(value, np.ndarray):
+                total += value.nbytes
+            elif scipy.sparse.issparse(value):
+                value = value.tocsr()
+                total += (value.data.nbytes + value.indices.nbytes +
+                          value.indptr.nbytes)
+    return total
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _measure(args, mode, processes, queue):
+    ds = synthetic(args.num_images, num_classes=args.num_classes,
+                   num_proposals=args.num_proposals, write_images=False)
+    gt_roidb = ds.gt_roidb()
+    box_list = ds.proposal_box_list(gt_roidb)
+    inputs_mb = peak_rss_mb()
+    cfg.DATA_PARSE_PROCESSES = processes
+    if mode == 'dense':
+        gt_roidb = dense_gt_roidb(gt_roidb, ds.num_classes)
+        start = time.time()
+        roidb = dense_roidb_from_box_list(box_list, gt_roidb, ds.num_classes)
+        create_time = time.time() - start
+        start = time.time()
+        roidb = dense_merge_roidbs(gt_roidb, roidb)
+        merge_time = time.time() - start
+    else:
+        start = time.time()
+        roidb = ds.create_roidb_from_box_list(box_list, gt_roidb)
+        create_time = time.time() - start
+        start = time.time()
+        roidb = imdb.merge_roidbs(copy_roidb(gt_roidb), roidb)
+        merge_time = time.time() - start
+    queue.put((create_time, merge_time, inputs_mb, peak_rss_mb(),
+               roidb_bytes(roidb) / 1024.0 ** 2))
+
+def measure(args, mode, processes):
+    """Generate the dataset and build and merge its proposal roidb in a new
+    process, and return the create and merge times, the RSS after generating
+    the inputs, the peak RSS and the size of the merged roidb's arrays (MB).
+    """
+    queue = Queue()
+    p = Process(target=_measure, args=(args, mode, processes, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    num_processes = cfg.DATA_PARSE_PROCESSES if args.processes is None \
+                    else args.processes
+    modes = [('serial', 'sparse', 1),
+             ('pool={:d}'.format(num_processes), 'sparse', num_processes)]
+    if not args.skip_dense:
+        modes.append(('dense+csr', 'dense', 1))
+    # Each mode runs in its own process, so its peak RSS is its own
+    results = []
+    for name, mode, processes in modes:
+        print 'Measuring {} on {:d} x {:d} proposals...'.format(
+            name, args.num_images, args.num_proposals)
+        results.append((name, measure(args, mode, processes)))
+
+    print ''
+    print '{:>12s} {:>9s} {:>9s} {:>10s} {:>9s} {:>9s}'.format(
+        'mode', 'create s', 'merge s', 'inputs MB', 'peak MB', 'roidb MB')
+    for name, (create_time, merge_time, inputs_mb, peak_mb,
+               roidb_mb) in results:
+        print '{:>12s} {:9.2f} {:9.2f} {:10.0f} {:9.0f} {:9.0f}'.format(
+            name, create_time, merge_time, inputs_mb, peak_mb, roidb_mb)
+    print 'inputs MB is the RSS after generating the gt roidb and proposals;'
+    print 'peak MB excludes the pool workers; roidb MB is the merged roidb.'
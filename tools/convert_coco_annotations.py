@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Convert a COCO annotation file into a gt roidb in one pass.
+
+Builds the gt roidb of a COCO instances annotation file through
+datasets.coco_index.CocoIndex and writes it as a pickled roidb (--output)
+and/or a columnar roidb directory (--columnar). With --compare, also builds
+it the previous way (the pycocotools COCO API with per-image lookups) and
+reports the wall time and peak memory of both, each measured in a fresh
+process.
+"""
+
+import _init_paths
+from datasets.coco_index import CocoIndex
+import datasets.ds_utils as ds_utils
+import argparse
+import cPickle
+import hashlib
+import resource
+import time
+import sys
+from multiprocessing import Process, Queue
+import numpy as np
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert COCO annotations into a gt roidb')
+    parser.add_argument('--ann_file', dest='ann_file',
+                        help='COCO instances annotation file',
+                        default=None, type=str)
+    parser.add_argument('--output', dest='output',
+                        help='write the roidb (a pickled list) here',
+                        default=None, type=str)
+    parser.add_argument('--columnar', dest='columnar',
+                        help='write a columnar roidb to this directory',
+                        default=None, type=str)
+    parser.add_argument('--compare', dest='compare',
+                        help='also time the pycocotools per-image path',
+                        action='store_true')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+def index_gt_roidb(ann_file):
+    """Build the gt roidb through a CocoIndex."""
+    index = CocoIndex.from_json(ann_file)
+    cat_id_to_class_ind = dict((cat_id, i + 1) for i, (cat_id, _)
+                               in enumerate(index.categories))
+    return index.gt_roidb(index.image_index, cat_id_to_class_ind)
+
+def coco_api_gt_roidb(ann_file):
+    """Build the gt roidb with per-image COCO API lookups, the way
+    coco.gt_roidb used to.
+    """
+    from pycocotools.coco import COCO
+    coco = COCO(ann_file)
+    cat_ids = coco.getCatIds()
+    roidb = []
+    for index in coco.getImgIds():
+        im_ann = coco.loadImgs(index)[0]
+        width = im_ann['width']
+        height = im_ann['height']
+        objs = coco.loadAnns(coco.getAnnIds(imgIds=index, iscrowd=None))
+        # Sanitize bboxes -- some are invalid
+        valid_objs = []
+        for obj in objs:
+            x1 = np.max((0, obj['bbox'][0]))
+            y1 = np.max((0, obj['bbox'][1]))
+            x2 = np.min((width - 1, x1 + np.max((0, obj['bbox'][2] - 1))))
+            y2 = np.min((height - 1, y1 + np.max((0, obj['bbox'][3] - 1))))
+            if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
+                obj['clean_bbox'] = [x1, y1, x2, y2]
+                valid_objs.append(obj)
+        num_objs = len(valid_objs)
+        boxes = np.zeros((num_objs, 4), dtype=np.uint32)
+        gt_classes = np.zeros((num_objs), dtype=np.int32)
+        max_overlaps = np.zeros((num_objs), dtype=np.float32)
+        max_classes = np.zeros((num_objs), dtype=np.uint16)
+        seg_areas = np.zeros((num_objs), dtype=np.float32)
+        coco_cat_id_to_class_ind = dict((cat_id, i + 1) for i, cat_id
+                                        in enumerate(cat_ids))
+        for ix, obj in enumerate(valid_objs):
+            cls = coco_cat_id_to_class_ind[obj['category_id']]
+            boxes[ix, :] = obj['clean_bbox']
+            gt_classes[ix] = cls
+            seg_areas[ix] = obj['area']
+            if obj['iscrowd']:
+                max_overlaps[ix] = -1.0
+            else:
+                max_overlaps[ix] = 1.0
+                max_classes[ix] = cls
+        ds_utils.validate_boxes(boxes, width=width, height=height)
+        roidb.append({'boxes' : boxes,
+                      'gt_classes': gt_classes,
+                      'max_overlaps' : max_overlaps,
+                      'max_classes' : max_classes,
+                      'flipped' : False,
+                      'seg_areas' : seg_areas})
+    return roidb
+
+def roidb_digest(roidb):
+    """Return a digest of the contents of a roidb."""
+    sha1 = hashlib.sha1()
+    for entry in roidb:
+        for key in sorted(entry.keys()):
+            value = np.ascontiguousarray(entry[key])
+            sha1.update('{}{}{}'.format(key, value.dtype.str, value.shape))
+            sha1.update(value.tobytes())
+    return sha1.hexdigest()
+
+def _measure(build, ann_file, queue):
+    start = time.time()
+    roidb = build(ann_file)
+    wall_time = time.time() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put((wall_time, peak_mb, len(roidb), roidb_digest(roidb)))
+
+def measure(build, ann_file):
+    """Run build(ann_file) in a new process and return its wall time, peak
+    RSS, number of entries and roidb digest.
+    """
+    queue = Queue()
+    p = Process(target=_measure, args=(build, ann_file, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    assert args.ann_file is not None, 'an annotation file is required'
+    if args.compare:
+        results = [('CocoIndex', measure(index_gt_roidb, args.ann_file)),
+                   ('COCO API', measure(coco_api_gt_roidb, args.ann_file))]
+        print '{:>10s} {:>8s} {:>12s} {:>8s}'.format('path', 'time s',
+                                                     'peak RSS MB', 'images')
+        for name, (wall_time, peak_mb, num_images, _) in results:
+            print '{:>10s} {:8.2f} {:12.0f} {:8d}'.format(name, wall_time,
+                                                          peak_mb, num_images)
+        assert results[0][1][3] == results[1][1][3], \
+                'the two paths built different roidbs'
+        print 'Both paths built the same roidb'
+
+    if args.output is not None or args.columnar is not None:
+        start = time.time()
+        index = CocoIndex.from_json(args.ann_file)
+        cat_id_to_class_ind = dict((cat_id, i + 1) for i, (cat_id, _)
+                                   in enumerate(index.categories))
+        if args.output is not None:
+            roidb = index.gt_roidb(index.image_index, cat_id_to_class_ind)
+            with open(args.output, 'wb') as f:
+                cPickle.dump(roidb, f, cPickle.HIGHEST_PROTOCOL)
+            print 'Wrote roidb to {}'.format(args.output)
+        if args.columnar is not None:
+            index.gt_columnar_roidb(index.image_index,
+                                    cat_id_to_class_ind).save(args.columnar)
+            print 'Wrote columnar roidb to {}'.format(args.columnar)
+        print 'Converted in {:.2f}s, peak RSS {:.0f} MB'.format(
+            time.time() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
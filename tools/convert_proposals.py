@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast/er R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Convert precomputed proposals into a single indexed proposal store.
+
+Reads the .mat proposal files of an image set (the per-image COCO files of
+MCG, selective search or edge boxes, or the PASCAL VOC selective search
+file) in a process pool, deduplicates, filters and truncates the boxes as
+the roidb loaders do, and writes them to one proposal store file (see
+datasets.proposal_store) that the imdb then reads instead of the .mat files.
+
+MCG boxes downloaded for COCO can be read from their download directory
+with --mat_dir, without first moving them into the coco_proposals tree with
+lib/datasets/tools/mcg_munge.py.
+"""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.factory import get_imdb
+import argparse
+import pprint
+import time
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert .mat proposals into a proposal store')
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset to convert proposals of',
+                        default=None, type=str)
+    parser.add_argument('--method', dest='method',
+                        help='proposal method (MCG, selective_search, '
+                             'edge_boxes_AR, edge_boxes_70)',
+                        default='selective_search', type=str)
+    parser.add_argument('--mat_dir', dest='mat_dir',
+                        help='read the .mat files from this directory',
+                        default=None, type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    imdb = get_imdb(args.imdb_name)
+    start = time.time()
+    imdb.convert_proposals(args.method, mat_dir=args.mat_dir)
+    print 'Converted {:d} images in {:.1f}s'.format(imdb.num_images,
+                                                    time.time() - start)
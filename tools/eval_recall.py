@@ -4,6 +4,7 @@ import _init_paths
 from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
 from datasets.factory import get_imdb
 import argparse
+import json
 import time, os, sys
 import numpy as np
 
@@ -20,6 +21,16 @@ def parse_args():
                         default='selective_search', type=str)
     parser.add_argument('--rpn-file', dest='rpn_file',
                         default=None, type=str)
+    parser.add_argument('--limits', dest='limits',
+                        help='proposal budgets to evaluate (0 for all)',
+                        default=[0], type=int, nargs='+')
+    parser.add_argument('--areas', dest='areas',
+                        help='area ranges to evaluate (all, small, medium, '
+                             'large, 96-128, 128-256, 256-512, 512-inf)',
+                        default=['all'], type=str, nargs='+')
+    parser.add_argument('--output', dest='output',
+                        help='write the results to this JSON file',
+                        default=None, type=str)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -46,25 +57,43 @@ if __name__ == '__main__':
         raw_data = sio.loadmat(filename)['aboxes'].ravel()
         candidate_boxes = raw_data
 
-    ar, gt_overlaps, recalls, thresholds = \
-        imdb.evaluate_recall(candidate_boxes=candidate_boxes)
+    limits = [limit if limit > 0 else None for limit in args.limits]
+    start = time.time()
+    results = imdb.evaluate_recall_curves(candidate_boxes=candidate_boxes,
+                                          areas=args.areas, limits=limits)
+    print 'Evaluated {:d} images in {:.1f}s'.format(imdb.num_images,
+                                                    time.time() - start)
     print 'Method: {}'.format(args.method)
-    print 'AverageRec: {:.3f}'.format(ar)
 
-    def recall_at(t):
-        ind = np.where(thresholds > t - 1e-5)[0][0]
-        assert np.isclose(thresholds[ind], t)
-        return recalls[ind]
+    report_thresholds = [0.5, 0.6, 0.7, 0.8, 0.9]
+    def recall_at(res, t):
+        ind = np.where(res['thresholds'] > t - 1e-5)[0][0]
+        assert np.isclose(res['thresholds'][ind], t)
+        return res['recalls'][ind]
+
+    # One row per area range and budget, tab separated for easy spreadsheet
+    # copying
+    print '\t'.join(['area', 'limit', 'num_gt', 'AR'] +
+                    ['R@{:.1f}'.format(t) for t in report_thresholds])
+    rows = []
+    for area in args.areas:
+        for limit in limits:
+            res = results[area][limit]
+            print '\t'.join([area, 'all' if limit is None else str(limit),
+                             str(res['num_pos']), '{:.3f}'.format(res['ar'])] +
+                            ['{:.3f}'.format(recall_at(res, t))
+                             for t in report_thresholds])
+            rows.append({'area': area,
+                         'limit': limit,
+                         'num_gt': int(res['num_pos']),
+                         'ar': float(res['ar']),
+                         'thresholds': res['thresholds'].tolist(),
+                         'recalls': res['recalls'].tolist()})
 
-    print 'Recall@0.5: {:.3f}'.format(recall_at(0.5))
-    print 'Recall@0.6: {:.3f}'.format(recall_at(0.6))
-    print 'Recall@0.7: {:.3f}'.format(recall_at(0.7))
-    print 'Recall@0.8: {:.3f}'.format(recall_at(0.8))
-    print 'Recall@0.9: {:.3f}'.format(recall_at(0.9))
-    # print again for easy spreadsheet copying
-    print '{:.3f}'.format(ar)
-    print '{:.3f}'.format(recall_at(0.5))
-    print '{:.3f}'.format(recall_at(0.6))
-    print '{:.3f}'.format(recall_at(0.7))
-    print '{:.3f}'.format(recall_at(0.8))
-    print '{:.3f}'.format(recall_at(0.9))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'imdb': imdb.name,
+                       'method': args.method,
+                       'rpn_file': args.rpn_file,
+                       'results': rows}, f, indent=2)
+        print 'Wrote recall results to {}'.format(args.output)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Merge the partial detections of a sharded test and evaluate them.
+
+tools/test_net.py --shard i/N writes the detections of each shard to
+detections_shard<i>of<N> in the output directory of the net. Once all
+shards are done, this merges them into detections and evaluates them.
+"""
+
+import _init_paths
+from fast_rcnn.test import evaluate_detection_shards
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.factory import get_imdb
+import os, sys, argparse
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Merge and evaluate sharded detections')
+    parser.add_argument('output_dir', nargs=1, help='results directory',
+                        type=str)
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset the detections are of',
+                        default='voc_2007_test', type=str)
+    parser.add_argument('--shards', dest='num_shards',
+                        help='number of shards the images were split into',
+                        default=None, type=int)
+    parser.add_argument('--comp', dest='comp_mode', help='competition mode',
+                        action='store_true')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    assert args.num_shards is not None, 'the number of shards is required'
+    output_dir = os.path.abspath(args.output_dir[0])
+    imdb = get_imdb(args.imdb_name)
+    imdb.competition_mode(args.comp_mode)
+    evaluate_detection_shards(imdb, output_dir, args.num_shards)
@@ -13,6 +13,7 @@ import _init_paths
 from fast_rcnn.test import apply_nms
 from fast_rcnn.config import cfg
 from datasets.factory import get_imdb
+from datasets.detections import Detections
 import cPickle
 import os, sys, argparse
 import numpy as np
@@ -46,8 +47,13 @@ def from_dets(imdb_name, output_dir, args):
     imdb = get_imdb(imdb_name)
     imdb.competition_mode(args.comp_mode)
     imdb.config['matlab_eval'] = args.matlab_eval
-    with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
-        dets = cPickle.load(f)
+    det_dir = os.path.join(output_dir, 'detections')
+    if os.path.isdir(det_dir):
+        dets = Detections.load(det_dir)
+    else:
+        # Detections saved as a pickled all_boxes list
+        with open(os.path.join(output_dir, 'detections.pkl'), 'rb') as f:
+            dets = cPickle.load(f)
 
     if args.apply_nms:
         print 'Applying NMS to all detections'
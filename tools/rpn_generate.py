@@ -14,7 +14,6 @@ import numpy as np
 from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list, get_output_dir
 from datasets.factory import get_imdb
 from rpn.generate import imdb_proposals
-import cPickle
 import caffe
 import argparse
 import pprint
@@ -82,10 +81,7 @@ if __name__ == '__main__':
     net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
 
     imdb = get_imdb(args.imdb_name)
-    imdb_boxes = imdb_proposals(net, imdb)
-
     output_dir = get_output_dir(imdb, net)
-    rpn_file = os.path.join(output_dir, net.name + '_rpn_proposals.pkl')
-    with open(rpn_file, 'wb') as f:
-        cPickle.dump(imdb_boxes, f, cPickle.HIGHEST_PROTOCOL)
+    rpn_file = os.path.join(output_dir, net.name + '_rpn_proposals.rpn')
+    imdb_proposals(net, imdb, rpn_file=rpn_file)
     print 'Wrote RPN proposals to {}'.format(rpn_file)
@@ -7,14 +7,25 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-"""Test a Fast R-CNN network on an image database."""
+"""Test a Fast R-CNN network on an image database.
+
+With --shard i/N, only shard i of N of the images is tested and its
+detections are written to a directory of partial detections, which
+tools/merge_detections.py merges and evaluates once all shards are done.
+With --procs P, the job runs P processes, each holding one net on its own
+GPU (--gpu, --gpu + 1, ...) and testing one shard; --shard i/N then splits
+the images into N * P shards.
+"""
 
 import _init_paths
-from fast_rcnn.test import test_net
-from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from fast_rcnn.test import test_net, evaluate_detection_shards
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list, \
+                             get_output_dir
 from datasets.factory import get_imdb
 import caffe
 import argparse
+import multiprocessing as mp
+import pipes
 import pprint
 import time, os, sys
 
@@ -49,6 +60,12 @@ def parse_args():
     parser.add_argument('--num_dets', dest='max_per_image',
                         help='max number of detections per image',
                         default=100, type=int)
+    parser.add_argument('--shard', dest='shard',
+                        help='test only shard i/N of the images',
+                        default=None, type=str)
+    parser.add_argument('--procs', dest='num_procs',
+                        help='number of test processes (one per GPU)',
+                        default=1, type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -57,6 +74,33 @@ def parse_args():
     args = parser.parse_args()
     return args
 
+def parse_shard(shard):
+    """Parse a shard given as 'i/N' into (i, N)."""
+    if shard is None:
+        return (0, 1)
+    shard_index, num_shards = [int(x) for x in shard.split('/')]
+    assert 0 <= shard_index < num_shards, 'invalid shard {}'.format(shard)
+    return (shard_index, num_shards)
+
+def load_imdb(args):
+    imdb = get_imdb(args.imdb_name)
+    imdb.competition_mode(args.comp_mode)
+    if not cfg.TEST.HAS_RPN:
+        imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
+    return imdb
+
+def run_test(args, gpu_id, shard):
+    """Load the net on gpu_id and test shard (None for all images)."""
+    cfg.GPU_ID = gpu_id
+    caffe.set_mode_gpu()
+    caffe.set_device(gpu_id)
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+
+    imdb = load_imdb(args)
+    test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis,
+             shard=shard, model_files=[args.prototxt, args.caffemodel])
+
 if __name__ == '__main__':
     args = parse_args()
 
@@ -77,14 +121,42 @@ if __name__ == '__main__':
         print('Waiting for {} to exist...'.format(args.caffemodel))
         time.sleep(10)
 
-    caffe.set_mode_gpu()
-    caffe.set_device(args.gpu_id)
-    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
-    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+    if args.shard is None and args.num_procs == 1:
+        run_test(args, args.gpu_id, None)
+        sys.exit(0)
 
-    imdb = get_imdb(args.imdb_name)
-    imdb.competition_mode(args.comp_mode)
-    if not cfg.TEST.HAS_RPN:
-        imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
+    # Process k of job shard i/N tests shard i * P + k of N * P
+    job_index, num_jobs = parse_shard(args.shard)
+    num_shards = num_jobs * args.num_procs
+    shards = [(job_index * args.num_procs + k, num_shards)
+              for k in xrange(args.num_procs)]
+    if args.num_procs == 1:
+        run_test(args, args.gpu_id, shards[0])
+    else:
+        procs = [mp.Process(target=run_test,
+                            args=(args, args.gpu_id + k, shards[k]))
+                 for k in xrange(args.num_procs)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        assert all(p.exitcode == 0 for p in procs), 'a test process failed'
 
-    test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis)
+    imdb = load_imdb(args)
+    net_name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+    output_dir = os.path.join(get_output_dir(imdb), net_name)
+    if num_jobs == 1:
+        # All shards were tested by this job
+        evaluate_detection_shards(imdb, output_dir, num_shards)
+    else:
+        command = ['tools/merge_detections.py', output_dir,
+                   '--imdb', args.imdb_name, '--shards', str(num_shards)]
+        if args.comp_mode:
+            command.append('--comp')
+        if args.cfg_file is not None:
+            command += ['--cfg', args.cfg_file]
+        if args.set_cfgs is not None:
+            command += ['--set'] + args.set_cfgs
+        print 'Merge the detections of all {:d} shards with:'.format(
+            num_shards)
+        print ' '.join(pipes.quote(arg) for arg in command)
@@ -25,9 +25,11 @@ import sys, os
 from os import listdir
 from os.path import isfile, join
 import multiprocessing as mp
-import cPickle
 import shutil
 
+# Proposal files of earlier runs: RpnProposalWriter files and legacy pickles
+PROPOSAL_SUFFIXES = ('_proposals.rpn', '_proposals.pkl')
+
 def parse_args():
     """
     Parse input arguments
@@ -161,15 +163,13 @@ def rpn_generate(queue=None, imdb_name=None, rpn_model_path=None, cfg=None,
     rpn_net = caffe.Net(rpn_test_prototxt, rpn_model_path, caffe.TEST)
     output_dir = get_output_dir(imdb)
     print 'Output will be saved to `{:s}`'.format(output_dir)
-    # Generate proposals on the imdb
-    rpn_proposals = imdb_proposals(rpn_net, imdb)
-    # Write proposals to disk and send the proposal file path through the
-    # multiprocessing queue
+    # Generate proposals on the imdb, writing them to disk as they are
+    # computed, and send the proposal file path through the multiprocessing
+    # queue
     rpn_net_name = os.path.splitext(os.path.basename(rpn_model_path))[0]
     rpn_proposals_path = os.path.join(
-        output_dir, rpn_net_name + '_proposals.pkl')
-    with open(rpn_proposals_path, 'wb') as f:
-        cPickle.dump(rpn_proposals, f, cPickle.HIGHEST_PROTOCOL)
+        output_dir, rpn_net_name + '_proposals.rpn')
+    imdb_proposals(rpn_net, imdb, rpn_file=rpn_proposals_path)
     print 'Wrote RPN proposals to {}'.format(rpn_proposals_path)
     queue.put({'proposal_path': rpn_proposals_path})
 
@@ -278,7 +278,7 @@ if __name__ == '__main__':
     print 'Stage 1 RPN, generate proposals'
     print '~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~'
 
-    prev_proposals_stage_1 = [f for f in prev_saved_models if "rpn_stage1" in f and f[-14:] == '_proposals.pkl']
+    prev_proposals_stage_1 = [f for f in prev_saved_models if "rpn_stage1" in f and f.endswith(PROPOSAL_SUFFIXES)]
 
     found_prev_proposal = False
     if len(prev_proposals_stage_1) > 0:
@@ -382,7 +382,7 @@ if __name__ == '__main__':
     print '~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~'
 
 
-    prev_proposals_stage_2 = [f for f in prev_saved_models if "rpn_stage2" in f and f[-14:] == '_proposals.pkl']
+    prev_proposals_stage_2 = [f for f in prev_saved_models if "rpn_stage2" in f and f.endswith(PROPOSAL_SUFFIXES)]
 
     found_prev_proposal = False
     if len(prev_proposals_stage_2) > 0:
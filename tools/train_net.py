@@ -48,6 +48,12 @@ def parse_args():
     parser.add_argument('--rand', dest='randomize',
                         help='randomize (do not use a fixed seed)',
                         action='store_true')
+    parser.add_argument('--rank', dest='rank',
+                        help='rank of this process in a distributed job [0]',
+                        default=None, type=int)
+    parser.add_argument('--world_size', dest='world_size',
+                        help='number of processes in a distributed job [1]',
+                        default=None, type=int)
     parser.add_argument('--set', dest='set_cfgs',
                         help='set config keys', default=None,
                         nargs=argparse.REMAINDER)
@@ -90,6 +96,17 @@ if __name__ == '__main__':
         cfg_from_list(args.set_cfgs)
 
     cfg.GPU_ID = args.gpu_id
+    if args.rank is not None:
+        cfg.TRAIN.RANK = args.rank
+    if args.world_size is not None:
+        cfg.TRAIN.WORLD_SIZE = args.world_size
+    if args.randomize:
+        # The minibatch sampler plans epochs from cfg.RNG_SEED, so draw a
+        # fresh one; all ranks of a distributed job must share theirs
+        assert cfg.TRAIN.WORLD_SIZE == 1, \
+                '--rand needs a single process; give the ranks a shared ' \
+                'seed with --set RNG_SEED <seed> instead'
+        cfg.RNG_SEED = int(np.random.RandomState().randint(2**31 - 1))
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -15,6 +15,7 @@ traditional R-CNN.
 import _init_paths
 from fast_rcnn.config import cfg, cfg_from_file
 from datasets.factory import get_imdb
+import datasets.ds_utils as ds_utils
 from fast_rcnn.test import im_detect
 from utils.timer import Timer
 import caffe
@@ -145,11 +146,12 @@ class SVMTrainer(object):
             scores, boxes = im_detect(self.net, im, roidb[i]['boxes'])
             _t.toc()
             feat = self.net.blobs[self.layer].data
+            gt_overlaps = ds_utils.dense_overlaps(roidb[i],
+                                                  self.imdb.num_classes)
             for j in xrange(1, self.imdb.num_classes):
                 hard_inds = \
                     np.where((scores[:, j] > self.hard_thresh) &
-                             (roidb[i]['gt_overlaps'][:, j].toarray().ravel() <
-                              self.neg_iou_thresh))[0]
+                             (gt_overlaps[:, j] < self.neg_iou_thresh))[0]
                 if len(hard_inds) > 0:
                     hard_feat = feat[hard_inds, :].copy()
                     new_w_b = \